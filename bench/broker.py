@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Бот и воркеры сбора раздельно (BROKER_URL): пропускная способность при 1, 2, 4… процессах
+`python main.py worker` на одном брокере и стенде bench/standin.py.
+
+    python bench/broker.py                                  # 1, 2, 4 воркера, 24 задачи, SQLite-брокер
+    python bench/broker.py --workers 1,3 --jobs 60 --delay 0.3
+    python bench/broker.py --kill 1.0                       # через 1 с убить воркер посреди сбора
+    python bench/broker.py --broker redis://127.0.0.1:6379/15 --collector selenium
+
+Задачи ставит BrokerClient из этого процесса (как бот), все сразу; воркеры берут их, пока есть
+места (--capacity на воркер). По умолчанию COLLECTOR=http — Chrome не нужен, меряется сам брокер
+и масштабирование; --delay у стенда изображает медленный портал. С --kill один воркер получает
+SIGKILL: его задачи по истечении аренды (BROKER_LEASE, здесь 3 с) должны уйти другим —
+все задачи готовы, max вырастает примерно на срок аренды.
+"""
+import argparse
+import concurrent.futures
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from cryptography.fernet import Fernet
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MAIN = os.path.join(os.path.dirname(HERE), "main.py")
+sys.path.insert(0, os.path.dirname(HERE))
+
+from run import percentiles  # noqa: E402
+from standin import StandIn  # noqa: E402
+
+
+def wait_workers(client, n, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        client._checked = float("-inf")      # мимо кэша списка воркеров
+        if len(client.workers()) >= n:
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def round_(bot, url, n, args):
+    """Поднимает n воркеров, гонит args.jobs задач, останавливает воркеры; словарь с итогами."""
+    procs = [subprocess.Popen([sys.executable, MAIN, "worker"], env={**os.environ, "WORKER_NAME": f"bench-{n}-{i}"})
+             for i in range(n)]
+    broker = bot.open_broker(url, bot.BROKER_KEY)
+    client = bot.BrokerClient(broker, wait_sec=120)
+    try:
+        if not wait_workers(client, n):
+            raise RuntimeError(f"за 60 с на связь вышли не все воркеры ({len(client.workers())}/{n})")
+        if args.kill:
+            victim = procs[0]
+            killer = concurrent.futures.ThreadPoolExecutor(1)
+            killer.submit(lambda: (time.sleep(args.kill), victim.send_signal(signal.SIGKILL)))
+
+        def one(i):
+            t0 = time.perf_counter()
+            try:
+                data = client.run("megafon", f"bench{i}", "bench")
+                ok = data.main.request_number != "—"
+            except Exception as e:
+                print(f"  задача {i}: {type(e).__name__}: {e}")
+                ok = False
+            return ok, (time.perf_counter() - t0) * 1000
+
+        t0 = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(args.jobs) as ex:
+            results = list(ex.map(one, range(args.jobs)))
+        wall = time.perf_counter() - t0
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.send_signal(signal.SIGTERM)
+        codes = [p.wait(60) for p in procs]
+        broker.close()
+    return {
+        "workers": n,
+        "ok": sum(ok for ok, _ in results),
+        "wall_s": wall,
+        "jobs_per_s": args.jobs / wall,
+        "ms": percentiles([ms for _, ms in results]),
+        "exit_codes": codes,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--fixtures", default=os.path.join(HERE, "fixtures"))
+    ap.add_argument("--workers", default="1,2,4", help="сколько воркеров в каждом прогоне, через запятую")
+    ap.add_argument("--capacity", type=int, default=1, help="мест на воркер (WORKER_CAPACITY)")
+    ap.add_argument("--jobs", type=int, default=24)
+    ap.add_argument("--delay", type=float, default=0.2, help="задержка ответа стенда, сек")
+    ap.add_argument("--collector", default="http", choices=("http", "selenium"))
+    ap.add_argument("--broker", help="BROKER_URL (по умолчанию — SQLite во временной папке)")
+    ap.add_argument("--kill", type=float, default=0.0, help="через N сек убить первый воркер (SIGKILL)")
+    ap.add_argument("--log", default=os.path.join(HERE, "bench.log"))
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="okc-broker-")
+    url = args.broker or f"sqlite://{os.path.join(tmp, 'broker.db')}"
+    with StandIn(args.fixtures, delay=args.delay) as srv:
+        os.environ.update({
+            "LOGIN_URL": srv.login_url,
+            "LOG_FILE": args.log,
+            "BROKER_URL": url,
+            "BROKER_KEY": os.environ.get("BROKER_KEY") or Fernet.generate_key().decode(),
+            "BROKER_HEARTBEAT": "1",
+            "BROKER_LEASE": "3",
+            "COLLECTOR": args.collector,
+            "WORKER_CAPACITY": str(args.capacity),
+            "DRIVER_POOL_SIZE": str(args.capacity),
+            "DRIVER_WARMUP": "0",
+            "SESSION_TTL": "0",
+            "JOURNAL_DB": "",
+        })
+        import main as bot
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+
+        rows = [round_(bot, url, int(n), args) for n in args.workers.split(",")]
+
+    print(f"\nЗадач: {args.jobs}, мест на воркер: {args.capacity}, задержка стенда: {args.delay * 1000:.0f} мс, "
+          f"сборщик: {args.collector}, брокер: {url.partition('://')[0]}\n")
+    print(f"{'воркеров':<10}{'готово':>8}{'задач/с':>10}{'p50, мс':>10}{'p90, мс':>10}{'max, мс':>10}")
+    for r in rows:
+        ms = r["ms"]
+        print(f"{r['workers']:<10}{r['ok']:>8}{r['jobs_per_s']:>10.2f}{ms['p50']:>10.0f}{ms['p90']:>10.0f}"
+              f"{ms['max']:>10.0f}")
+    base = rows[0]["jobs_per_s"]
+    for r in rows[1:]:
+        print(f"{r['workers']} воркер(а): ×{r['jobs_per_s'] / base:.2f} к {rows[0]['workers']}")
+    failed = [r for r in rows if r["ok"] < args.jobs or any(r["exit_codes"][1 if args.kill else 0:])]
+    if failed:
+        print("\n❌ Не все задачи выполнены или воркеры завершились с ошибкой:",
+              ", ".join(f"{r['workers']} ({r['ok']}/{args.jobs}, коды {r['exit_codes']})" for r in failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
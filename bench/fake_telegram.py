@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный фейковый Telegram Bot API: бот ходит к нему вместо api.telegram.org
+(TELEGRAM_API_URL в .env), а мы подкидываем ему апдейты и смотрим ответы.
+
+Поддерживает оба режима бота:
+- polling — апдейты отдаются через getUpdates (long poll);
+- webhook — после setWebhook апдейты POST-ятся на адрес бота с заголовком
+  X-Telegram-Bot-Api-Secret-Token, как это делает настоящий Telegram.
+
+Отвечает на getMe, getUpdates, setWebhook/deleteWebhook, sendMessage, editMessageText
+и sendDocument (файл — в параметре document как (имя, байты)); на прочие методы — true.
+Все вызовы бота складываются в calls.
+
+    python bench/fake_telegram.py      # печатает TELEGRAM_API_URL, строки из stdin уходят боту от чата 1
+"""
+import itertools
+import json
+import threading
+import time
+import urllib.request
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+_BOT_USER = {"id": 1, "is_bot": True, "first_name": "bot", "username": "okc_test_bot"}
+
+
+def _multipart(ctype: str, raw: bytes) -> dict:
+    """multipart/form-data → {поле: строка}; файлы → {поле: (имя файла, байты)}."""
+    msg = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {ctype}\r\n\r\n".encode() + raw)
+    out = {}
+    for part in msg.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        data = part.get_payload(decode=True) or b""
+        filename = part.get_filename()
+        out[name] = (filename, data) if filename else data.decode("utf-8")
+    # PTB кладёт файл отдельной частью и ссылается на неё как attach://<имя>
+    for k, v in list(out.items()):
+        if isinstance(v, str) and v.startswith("attach://"):
+            out[k] = out.get(v[len("attach://"):], v)
+    return out
+
+
+class FakeTelegram:
+    """HTTP-сервер на 127.0.0.1; push() кладёт апдейт, calls — список (метод, параметры)."""
+
+    def __init__(self):
+        self.updates = []
+        self.calls = []
+        self.webhook = None            # (url, secret) после setWebhook
+        self.files = {}                # file_id -> байты для документов из push(document=...)
+        self._update_id = itertools.count(1)
+        self._message_id = itertools.count(100)
+        self._cond = threading.Condition()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def _handle(self, method: str, params: dict):
+        if method == "getMe":
+            return _BOT_USER
+        if method == "getFile":
+            file_id = params.get("file_id")
+            data = self.files.get(file_id, b"")
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(data), "file_path": file_id}
+        if method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            deadline = time.time() + min(float(params.get("timeout") or 0), 1.0)
+            with self._cond:
+                while True:
+                    ups = [u for u in self.updates if u["update_id"] >= offset]
+                    if ups or time.time() >= deadline:
+                        return ups
+                    self._cond.wait(0.05)
+        with self._cond:
+            self.calls.append((method, params))
+            self._cond.notify_all()
+        if method == "setWebhook":
+            self.webhook = (params.get("url"), params.get("secret_token"))
+        elif method == "deleteWebhook":
+            self.webhook = None
+        elif method in ("sendMessage", "editMessageText", "sendDocument"):
+            msg = {
+                "message_id": int(params.get("message_id") or next(self._message_id)),
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "from": _BOT_USER,
+            }
+            if method == "sendDocument":
+                name, data = params.get("document") or ("", b"")
+                msg["document"] = {"file_id": f"doc{msg['message_id']}", "file_unique_id": f"u{msg['message_id']}",
+                                   "file_name": name, "file_size": len(data)}
+            else:
+                msg["text"] = params.get("text", "")
+            return msg
+        return True
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                if "/file/" in self.path:
+                    data = fake.files.get(self.path.rsplit("/", 1)[-1])
+                    self.send_response(200 if data is not None else 404)
+                    self.send_header("Content-Length", str(len(data or b"")))
+                    self.end_headers()
+                    self.wfile.write(data or b"")
+                    return
+                raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                ctype = self.headers.get("Content-Type", "")
+                params = {}
+                if raw:
+                    if "json" in ctype:
+                        params = json.loads(raw)
+                    elif "multipart" in ctype:
+                        params = _multipart(ctype, raw)
+                    else:
+                        params = {k: v[0] for k, v in parse_qs(raw.decode("utf-8")).items()}
+                result = fake._handle(self.path.rsplit("/", 1)[-1], params)
+                data = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+        return Handler
+
+    def push(self, chat_id: int, text: str = None, callback_data: str = None, document=None) -> dict:
+        """
+        Апдейт от пользователя: текст (команды размечаются), нажатие inline-кнопки
+        или файл document=(имя, байты) — бот скачает его через getFile.
+        """
+        user = {"id": chat_id, "is_bot": False, "first_name": "Тест"}
+        msg = {
+            "message_id": next(self._message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        update = {"update_id": next(self._update_id)}
+        if document is not None:
+            name, data = document
+            file_id = f"up{update['update_id']}"
+            self.files[file_id] = data
+            msg.update({"from": user, "document": {"file_id": file_id, "file_unique_id": file_id,
+                                                   "file_name": name, "file_size": len(data)}})
+            update["message"] = msg
+        elif callback_data is None:
+            msg.update({"from": user, "text": text})
+            if text.startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            update["message"] = msg
+        else:
+            msg.update({"from": _BOT_USER, "text": "…"})
+            update["callback_query"] = {
+                "id": str(update["update_id"]), "from": user, "chat_instance": str(chat_id),
+                "message": msg, "data": callback_data,
+            }
+        if self.webhook:
+            self._deliver(update)
+        else:
+            with self._cond:
+                self.updates.append(update)
+                self._cond.notify_all()
+        return update
+
+    def _deliver(self, update: dict):
+        url, secret = self.webhook
+        req = urllib.request.Request(url, data=json.dumps(update).encode("utf-8"), method="POST")
+        req.add_header("Content-Type", "application/json")
+        if secret:
+            req.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+        urllib.request.urlopen(req, timeout=10).read()
+
+    def wait_call(self, method: str, since: int = 0, timeout: float = 10.0):
+        """Ждёт вызов method начиная с calls[since]; возвращает (индекс, параметры) или None."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                for i in range(since, len(self.calls)):
+                    if self.calls[i][0] == method:
+                        return i, self.calls[i][1]
+                left = deadline - time.time()
+                if left <= 0:
+                    return None
+                self._cond.wait(left)
+
+    def start(self) -> "FakeTelegram":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import sys
+
+    with FakeTelegram() as tg:
+        print(f"TELEGRAM_API_URL={tg.api_url}")
+        print("Строка — сообщение от чата 1, «cb:<data>» — нажатие кнопки. Ctrl+D — выход.")
+        seen = 0
+        for line in sys.stdin:
+            line = line.strip()
+            if line.startswith("cb:"):
+                tg.push(1, callback_data=line[3:])
+            elif line:
+                tg.push(1, line)
+            time.sleep(0.5)
+            for method, params in tg.calls[seen:]:
+                print(f"← {method}: {params.get('text', '')}")
+            seen = len(tg.calls)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Полный профиль Chrome против облегчённого (LEAN_BROWSER=1): время до готовности
+страницы и пиковый RSS Chrome + chromedriver на стенде bench/standin.py.
+
+    python bench/lean.py                          # 10 загрузок, 30 «картинок» по 50 мс
+    python bench/lean.py --runs 20 --assets 60 --asset-delay 0.1
+    python bench/lean.py --fixtures bench/fixtures/recorded
+
+Каждый профиль — в отдельном процессе: настройки браузера читаются при импорте main.
+Готовность — wait_ready по маркеру профиля, как при настоящем сборе; «ресурсов» — сколько
+запросов статики дошло до стенда за одну загрузку (заблокированные не доходят).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from run import RssSampler, percentiles  # noqa: E402
+from standin import StandIn  # noqa: E402
+
+MODES = {
+    "полный": {"LEAN_BROWSER": "0"},
+    # «счётчик» стенда лежит на том же хосте, поэтому режется маской, а не BLOCK_HOSTS
+    "облегчённый": {"LEAN_BROWSER": "1", "BLOCK_URLS": "*.png,*.jpg,*.gif,*.svg,*.woff,*.woff2,*.ttf,*/counter/*"},
+}
+
+
+def child(args):
+    """Один профиль: грузит /detail args.runs раз одним браузером, печатает JSON."""
+    with StandIn(args.fixtures, assets=args.assets, asset_delay=args.asset_delay) as srv:
+        os.environ.update({"LOGIN_URL": srv.login_url, "LOG_FILE": args.log, "BROWSER_DISK_CACHE": args.cache})
+        import main as bot
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+
+        marker = bot.PROFILES["megafon"].spec.ready_marker
+        t0 = time.perf_counter()
+        d = bot.build_driver(True)
+        start_s = time.perf_counter() - t0
+        sampler = RssSampler(lambda: [d.service.process.pid] if d.service.process else [])
+        sampler.start()
+        times, assets = [], []
+        try:
+            for _ in range(args.runs):
+                d.get("about:blank")
+                n0 = srv.asset_requests
+                t0 = time.perf_counter()
+                d.get(srv.base_url + "/detail")
+                bot.wait_ready(d, "detail", marker)
+                times.append((time.perf_counter() - t0) * 1000)
+                assets.append(srv.asset_requests - n0)
+        finally:
+            sampler.stop()
+            d.quit()
+    print(json.dumps({"ready_ms": percentiles(times), "rss_kb": sampler.peak_kb,
+                      "assets": sum(assets) / len(assets), "start_s": start_s}))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--fixtures", default=os.path.join(HERE, "fixtures"))
+    ap.add_argument("--runs", type=int, default=10)
+    ap.add_argument("--assets", type=int, default=30, help="картинок на страницу")
+    ap.add_argument("--asset-delay", type=float, default=0.05, help="задержка ответа на статику, сек")
+    ap.add_argument("--cache", default=os.path.join(HERE, ".chrome_cache"), help="дисковый кэш облегчённого профиля")
+    ap.add_argument("--json", help="сохранить результаты в файл")
+    ap.add_argument("--log", default=os.path.join(HERE, "bench.log"))
+    ap.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.child:
+        # полному профилю кэш не положен — как в прежнем build_driver
+        if args.child == "полный":
+            args.cache = ""
+        return child(args)
+
+    results = {}
+    for mode, env in MODES.items():
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", mode, "--fixtures", args.fixtures,
+               "--runs", str(args.runs), "--assets", str(args.assets), "--asset-delay", str(args.asset_delay),
+               "--cache", args.cache, "--log", args.log]
+        out = subprocess.run(cmd, env={**os.environ, **env}, capture_output=True, text=True)
+        if out.returncode:
+            print(f"❌ {mode}: процесс завершился с кодом {out.returncode}\n{out.stderr[-2000:]}")
+            return 1
+        results[mode] = json.loads(out.stdout.strip().splitlines()[-1])
+
+    print(f"Снимки: {args.fixtures}, загрузок: {args.runs}, статики на страницу: {args.assets} "
+          f"по {args.asset_delay * 1000:.0f} мс\n")
+    print(f"{'профиль':<14}{'p50, мс':>10}{'p90, мс':>10}{'max, мс':>10}{'RSS, МБ':>10}{'ресурсов':>10}{'старт, с':>10}")
+    for mode, r in results.items():
+        pc = r["ready_ms"]
+        print(f"{mode:<14}{pc['p50']:>10.0f}{pc['p90']:>10.0f}{pc['max']:>10.0f}"
+              f"{r['rss_kb'] / 1024:>10.0f}{r['assets']:>10.1f}{r['start_s']:>10.2f}")
+    full, lean = results["полный"], results["облегчённый"]
+    print(f"\nГотовность (p50): {lean['ready_ms']['p50'] / full['ready_ms']['p50']:.0%} от полного профиля, "
+          f"RSS: {lean['rss_kb'] / max(full['rss_kb'], 1):.0%}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Память и сериализация моделей результата: текущие (frozen + __slots__, to_bytes)
+против прежних (обычные dataclass, services списком, to_json со словарями).
+
+    python bench/models_mem.py                 # 100 000 записей
+    python bench/models_mem.py --count 20000
+
+Память меряется tracemalloc как прирост после построения count записей (строки в записях
+уникальные, как у настоящих заявок), время — построение, сериализация и разбор обратно.
+"""
+import argparse
+import json
+import gc
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from typing import List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+
+# ── Прежние модели (как были до slots/frozen) ──
+@dataclass
+class OldServiceRow:
+    product: str
+    tariff: str
+
+
+@dataclass
+class OldMainPageData:
+    request_number: str = "—"
+    account_number: str = "—"
+    address: str = "—"
+    temp_password: str = "—"
+    services: List[OldServiceRow] = None
+
+
+@dataclass
+class OldClientData:
+    abonent_number: str = "—"
+    contact_mobile: str = "—"
+    client_mobile: str = "—"
+    lastname: str = "—"
+    firstname: str = "—"
+    middlename: str = "—"
+
+
+@dataclass
+class OldPppoeData:
+    login: str = "—"
+    password: str = "—"
+
+
+@dataclass
+class OldCollected:
+    main: OldMainPageData
+    client: OldClientData
+    pppoe: OldPppoeData
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, raw: str) -> "OldCollected":
+        d = json.loads(raw)
+        main = dict(d["main"])
+        main["services"] = [OldServiceRow(**r) for r in (main.get("services") or [])]
+        return cls(main=OldMainPageData(**main), client=OldClientData(**d["client"]), pppoe=OldPppoeData(**d["pppoe"]))
+
+
+def build_old(i):
+    return OldCollected(
+        OldMainPageData(f"Req{i:07d}", f"77{i:07d}", f"г. Москва, ул. Тестовая, д. {i % 300}", f"Tmp{i}",
+                        [OldServiceRow("Интернет", "Домашний 500"), OldServiceRow("ТВ", "Базовый")]),
+        OldClientData(f"9{i:09d}", f"+79{i:09d}", f"+79{i:09d}", "Тестов", "Тест", "Тестович"),
+        OldPppoeData(f"ppp_{i:07d}", f"Pp{i:07d}"),
+    )
+
+
+def build_new(bot, i):
+    return bot.Collected(
+        bot.MainPageData(f"Req{i:07d}", f"77{i:07d}", f"г. Москва, ул. Тестовая, д. {i % 300}", f"Tmp{i}",
+                         (bot.ServiceRow("Интернет", "Домашний 500"), bot.ServiceRow("ТВ", "Базовый"))),
+        bot.ClientData(f"9{i:09d}", f"+79{i:09d}", f"+79{i:09d}", "Тестов", "Тест", "Тестович"),
+        bot.PppoeData(f"ppp_{i:07d}", f"Pp{i:07d}"),
+    )
+
+
+def measure(name, build, dump, load, count):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    items = [build(i) for i in range(count)]
+    t_build = time.perf_counter() - t0
+    mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    t0 = time.perf_counter()
+    blobs = [dump(x) for x in items]
+    t_dump = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    back = [load(b) for b in blobs]
+    t_load = time.perf_counter() - t0
+    assert back[-1] == items[-1], f"{name}: разбор не совпал с исходной записью"
+    size = sum(len(b) for b in blobs)
+    pickled = sum(len(pickle.dumps(x, pickle.HIGHEST_PROTOCOL)) for x in items[:1000]) / min(count, 1000)
+    return {
+        "name": name,
+        "bytes_per_record": mem / count,
+        "build_s": t_build,
+        "dump_s": t_dump,
+        "load_s": t_load,
+        "wire_bytes": size / count,
+        "pickle_bytes": pickled,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--count", type=int, default=100_000)
+    ap.add_argument("--log", default=os.path.join(HERE, "bench.log"))
+    args = ap.parse_args()
+
+    os.environ["LOG_FILE"] = args.log
+    import main as bot
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+
+    rows = [
+        measure("прежние (dict JSON)", build_old, lambda x: x.to_json().encode("utf-8"),
+                lambda b: OldCollected.from_json(b.decode("utf-8")), args.count),
+        measure("slots+frozen (to_bytes)", lambda i: build_new(bot, i), lambda x: x.to_bytes(),
+                bot.Collected.from_bytes, args.count),
+    ]
+    print(f"Записей: {args.count}\n")
+    print(f"{'модели':<26}{'Б/запись':>10}{'постр., с':>11}{'сериал., с':>12}{'разбор, с':>11}{'Б на провод':>13}{'pickle, Б':>11}")
+    for r in rows:
+        print(f"{r['name']:<26}{r['bytes_per_record']:>10.0f}{r['build_s']:>11.2f}{r['dump_s']:>12.2f}"
+              f"{r['load_s']:>11.2f}{r['wire_bytes']:>13.0f}{r['pickle_bytes']:>11.0f}")
+    old, new = rows
+    print(f"\nПамять: {new['bytes_per_record'] / old['bytes_per_record']:.0%} от прежней, "
+          f"сериализация: {new['wire_bytes'] / old['wire_bytes']:.0%} от прежнего размера")
+
+
+if __name__ == "__main__":
+    main()
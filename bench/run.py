@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Офлайн-бенчмарк и регрессия разбора без живого портала.
+
+Поднимает bench/standin.py со снимками страниц, направляет на него бота (LOGIN_URL)
+и гоняет collect_megafon, collect_http, table_services, extract_tables, _main_field, _value_in_panel
+и разбор снимка (PageSnapshot). Печатает перцентили по стадиям, число RPC к WebDriver
+на вызов и пиковый RSS (Chrome + chromedriver и сам Python).
+
+    python bench/run.py                          # синтетические снимки из bench/fixtures
+    python bench/run.py --fixtures bench/fixtures/recorded --runs 20
+    python bench/run.py --update-baseline        # сохранить текущие p50 как эталон (bench/baseline.json)
+    python bench/run.py --tolerance 0.25         # упасть, если p50 стадии хуже эталона на 25%
+    python bench/run.py --no-baseline            # только замеры, без сравнения с эталоном
+
+Эталон зависит от машины, поэтому в репозитории его нет: на своей машине сначала --update-baseline.
+Реальные снимки: RECORD_FIXTURES_DIR=bench/fixtures/recorded в .env и один запрос через бота.
+Код возврата 1 — регрессия по скорости, эталона нет (без --no-baseline) или результат разбора
+отличается от первого прогона.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from dataclasses import asdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from standin import StandIn  # noqa: E402
+
+
+def percentiles(xs):
+    xs = sorted(xs)
+    if not xs:
+        return {}
+    def q(p):
+        return xs[min(len(xs) - 1, max(0, int(round(p * len(xs) + 0.5)) - 1))]
+    return {"n": len(xs), "p50": q(0.50), "p90": q(0.90), "p99": q(0.99), "max": xs[-1]}
+
+
+class RssSampler(threading.Thread):
+    """
+    Раз в interval сек меряет RSS дерева процессов от chromedriver (main._tree_rss_mb, Linux /proc);
+    хранит пик. Запускать после `import main` — бот читает окружение при импорте.
+    """
+
+    def __init__(self, pid_getter, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid_getter = pid_getter
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+
+    def run(self):
+        from main import _tree_rss_mb
+        while not self._stop.wait(self.interval):
+            for pid in self.pid_getter():
+                self.peak_kb = max(self.peak_kb, int(_tree_rss_mb(pid) * 1024))
+
+    def stop(self):
+        self._stop.set()
+        self.join()
+
+
+# ── Прогон ──
+class Recorder:
+    def __init__(self, rpc):
+        self.rpc = rpc
+        self.times = {}
+        self.calls = {}
+
+    def run(self, stage, fn, *args):
+        n0 = self.rpc[0]
+        t0 = time.perf_counter()
+        res = fn(*args)
+        self.times.setdefault(stage, []).append((time.perf_counter() - t0) * 1000)
+        self.calls.setdefault(stage, []).append(self.rpc[0] - n0)
+        return res
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--fixtures", default=os.path.join(HERE, "fixtures"))
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--delay", type=float, default=0.0, help="задержка ответа стенда, сек")
+    ap.add_argument("--baseline", default=os.path.join(HERE, "baseline.json"))
+    ap.add_argument("--update-baseline", action="store_true")
+    ap.add_argument("--no-baseline", action="store_true", help="не сравнивать с эталоном")
+    ap.add_argument("--tolerance", type=float, default=0.2)
+    ap.add_argument("--json", help="сохранить результаты в файл")
+    ap.add_argument("--log", default=os.path.join(HERE, "bench.log"))
+    args = ap.parse_args()
+
+    with StandIn(args.fixtures, delay=args.delay) as srv:
+        os.environ.update({
+            "LOGIN_URL": srv.login_url,
+            "LOG_FILE": args.log,
+            "DRIVER_POOL_SIZE": "1",
+            "DRIVER_WARMUP": "0",
+            "SESSION_TTL": "0",
+            "RESULT_TTL": "0",
+        })
+        import main as bot
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+
+        rpc = [0]
+        drivers = []
+
+        def factory():
+            d = bot.build_driver(True)
+            orig = d.execute
+
+            def execute(command, params=None):
+                rpc[0] += 1
+                return orig(command, params)
+
+            d.execute = execute
+            drivers.append(d)
+            return d
+
+        bot.DRIVER_POOL._factory = factory
+        profile = bot.PROFILES["megafon"]
+        sections = {sec.name: (sec, fields) for sec, fields in profile.sections}
+        rec = Recorder(rpc)
+        sampler = RssSampler(lambda: [d.service.process.pid for d in drivers if d.service.process])
+        sampler.start()
+        mismatches = []
+        try:
+            first = None
+            for _ in range(args.runs):
+                data = rec.run("collect_megafon", bot.collect_megafon, "bench", "bench")
+                if first is None:
+                    first = data
+                elif data != first:
+                    mismatches.append("collect_megafon")
+            http = rec.run("collect_http", bot.collect_http, profile, "bench", "bench")
+            if http is not None and http != first:
+                mismatches.append("collect_http")
+
+            with bot.DRIVER_POOL.lease() as d:
+                main_sec, main_fields = sections["main"]
+                d.get(srv.base_url + "/detail")
+                for _ in range(args.runs):
+                    rec.run("table_services", bot.table_services, d)
+                    rec.run("extract_tables", bot.extract_tables, d, main_sec.tables)
+                    for f in main_fields:
+                        rec.run("_main_field", bot._main_field, d, f.label)
+                    snap = rec.run("snapshot:capture", bot.PageSnapshot.capture, d)
+                    rec.run("snapshot:main", bot.extract_snapshot, snap, None, main_sec, main_fields)
+
+                cl_sec, cl_fields = sections["client"]
+                d.get(srv.base_url + "/tab/client")
+                for _ in range(args.runs):
+                    panel = bot.get_active_tab_panel(d)
+                    for f in cl_fields:
+                        rec.run("_value_in_panel", bot._value_in_panel, panel, f.label)
+                    snap = rec.run("snapshot:capture", bot.PageSnapshot.capture, d)
+                    rec.run("snapshot:client", bot.extract_snapshot, snap, snap.active_panel(), cl_sec, cl_fields)
+        finally:
+            sampler.stop()
+            bot.DRIVER_POOL.close()
+
+    print(f"Снимки: {args.fixtures}, прогонов: {args.runs}\n")
+    print(f"{'стадия':<20}{'n':>5}{'p50, мс':>10}{'p90, мс':>10}{'p99, мс':>10}{'max, мс':>10}{'RPC/вызов':>11}")
+    report = {"stages": {}, "rss_kb": {}}
+    for stage, xs in rec.times.items():
+        pc = percentiles(xs)
+        calls = rec.calls[stage]
+        pc["rpc"] = sum(calls) / len(calls)
+        report["stages"][stage] = pc
+        print(f"{stage:<20}{pc['n']:>5}{pc['p50']:>10.1f}{pc['p90']:>10.1f}{pc['p99']:>10.1f}{pc['max']:>10.1f}{pc['rpc']:>11.1f}")
+    report["rss_kb"] = {
+        "chrome_peak": sampler.peak_kb,
+        "python_peak": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    print(f"\nПиковый RSS: Chrome+chromedriver {sampler.peak_kb / 1024:.0f} МБ, "
+          f"Python {report['rss_kb']['python_peak'] / 1024:.0f} МБ")
+    if first is not None:
+        print("\nРезультат разбора:\n" + json.dumps(asdict(first), ensure_ascii=False, indent=2))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failed = False
+    if mismatches:
+        print(f"\n❌ Результат разбора отличается между прогонами/сборщиками: {', '.join(mismatches)}")
+        failed = True
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({k: {"p50": v["p50"]} for k, v in report["stages"].items()}, f, ensure_ascii=False, indent=2)
+        print(f"\nЭталон сохранён: {args.baseline}")
+    elif args.no_baseline:
+        print("\nСравнение с эталоном пропущено (--no-baseline)")
+    elif not os.path.exists(args.baseline):
+        print(f"\n❌ Эталона нет ({args.baseline}) — регрессию по скорости не проверить. "
+              "Сохраните его: python bench/run.py --update-baseline (или запустите с --no-baseline)")
+        failed = True
+    else:
+        with open(args.baseline, encoding="utf-8") as f:
+            base = json.load(f)
+        for stage, ref in base.items():
+            cur = report["stages"].get(stage)
+            if cur and cur["p50"] > ref["p50"] * (1 + args.tolerance):
+                print(f"❌ {stage}: p50 {cur['p50']:.1f} мс > эталона {ref['p50']:.1f} мс (+{args.tolerance:.0%})")
+                failed = True
+        if not failed:
+            print("\n✅ Не медленнее эталона")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
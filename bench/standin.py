@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Локальная замена портала для бенчмарка: отдаёт сохранённые HTML (login/detail/tab_*.html)
+и имитирует вход и переключение вкладок.
+
+Снимки пишет сам бот: RECORD_FIXTURES_DIR=bench/fixtures/recorded в .env, один реальный запрос.
+Скрипты портала из снимков вырезаются; вместо них — маленький скрипт:
+- клик «Войти» → /detail;
+- клик по названию вкладки → содержимое tab_<имя>.html подменяет body (как SPA);
+- клик по «Последние заявки клиента» / «Показать удаленные подключения» → раскрывает
+  следующий за ссылкой скрытый блок, текст «Показать…» меняется на «Скрыть…».
+POST на адрес логина отвечает редиректом на /detail — для HTTP-сборщика.
+
+assets=N добавляет в каждую страницу N картинок, шрифт и «счётчик» с задержкой
+asset_delay — как тяжёлая статика настоящего портала (для bench/lean.py).
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Название вкладки на странице → имя секции (tab_<имя>.html)
+TABS = {
+    "Данные клиента": "client",
+    "Настройки и активация услуг": "pppoe",
+}
+
+_SCRIPT_RE = re.compile(r"<script\b.*?</script>", re.I | re.S)
+
+_INJECT = """<script>
+(function () {
+  const TABS = %s;
+  document.addEventListener('click', function (e) {
+    const el = e.target.closest('a,button');
+    if (!el) return;
+    const text = el.textContent.replace(/\\s+/g, ' ').trim();
+    if (text.indexOf('Войти') !== -1) {
+      e.preventDefault();
+      location.href = '/detail';
+      return;
+    }
+    const box = el.nextElementSibling;
+    if (box && /Последние заявки|удаленные подключения/.test(text)) {
+      e.preventDefault();
+      box.hidden = !box.hidden;
+      el.textContent = text.replace(box.hidden ? 'Скрыть' : 'Показать', box.hidden ? 'Показать' : 'Скрыть');
+      return;
+    }
+    for (const title in TABS) {
+      if (text.indexOf(title) !== -1) {
+        e.preventDefault();
+        fetch('/tab/' + TABS[title]).then(r => r.text()).then(html => {
+          const doc = new DOMParser().parseFromString(html, 'text/html');
+          document.body.innerHTML = doc.body.innerHTML;
+        });
+        return;
+      }
+    }
+  }, true);
+})();
+</script>"""
+
+
+def _assets(n: int) -> str:
+    imgs = "".join(f'<img src="/asset/img{i}.png" width="1" height="1">' for i in range(n))
+    return ('<style>@font-face{font-family:Portal;src:url(/asset/font.woff2)}body{font-family:Portal}</style>'
+            f'{imgs}<script src="/asset/counter/tag.js"></script>')
+
+
+class _QuietServer(ThreadingHTTPServer):
+    """Клиент, оборвавший соединение (убитый воркер и его Chrome), — не ошибка стенда."""
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _prepare(html: str, assets: int = 0) -> str:
+    html = _SCRIPT_RE.sub("", html)
+    inject = _INJECT % json.dumps(TABS, ensure_ascii=False)
+    if assets:
+        inject = _assets(assets) + inject
+    if "</body>" in html:
+        return html.replace("</body>", inject + "</body>", 1)
+    return html + inject
+
+
+class StandIn:
+    """HTTP-сервер на 127.0.0.1 со снимками из fixtures_dir; delay — искусственная задержка ответа, сек."""
+
+    def __init__(self, fixtures_dir: str, login_path: str = "/loginTemp", delay: float = 0.0,
+                 assets: int = 0, asset_delay: float = 0.05):
+        self.fixtures_dir = fixtures_dir
+        self.login_path = login_path
+        self.delay = delay
+        self.asset_delay = asset_delay
+        self.requests = 0
+        self.asset_requests = 0
+        self._pages = {}
+        for name in os.listdir(fixtures_dir):
+            if name.endswith(".html"):
+                with open(os.path.join(fixtures_dir, name), encoding="utf-8") as f:
+                    self._pages[name[:-5]] = _prepare(f.read(), assets)
+        missing = {"login", "detail"} - set(self._pages)
+        if missing:
+            raise FileNotFoundError(f"В {fixtures_dir} нет снимков: {', '.join(sorted(missing))}")
+        self._server = _QuietServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    @property
+    def login_url(self) -> str:
+        return self.base_url + self.login_path
+
+    def _route(self, path: str):
+        path = path.split("?", 1)[0]
+        if path == self.login_path:
+            return self._pages["login"]
+        if path == "/detail":
+            return self._pages["detail"]
+        if path.startswith("/tab/"):
+            return self._pages.get("tab_" + path[len("/tab/"):])
+        return None
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code: int, body: str = "", headers=None):
+                data = body.encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.startswith("/asset/"):
+                    standin.asset_requests += 1
+                    time.sleep(standin.asset_delay)
+                    self.send_response(200)
+                    self.send_header("Content-Length", "2048")
+                    self.send_header("Cache-Control", "max-age=3600")
+                    self.end_headers()
+                    self.wfile.write(b"\0" * 2048)
+                    return
+                standin.requests += 1
+                if standin.delay:
+                    time.sleep(standin.delay)
+                page = standin._route(self.path)
+                if page is None:
+                    self._send(404, "not found")
+                else:
+                    self._send(200, page)
+
+            def do_POST(self):
+                standin.requests += 1
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if standin.delay:
+                    time.sleep(standin.delay)
+                self._send(303, headers={"Location": "/detail"})
+
+        return Handler
+
+    def start(self) -> "StandIn":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Локальная замена портала для ручной проверки")
+    ap.add_argument("--fixtures", default=os.path.join(os.path.dirname(__file__), "fixtures"))
+    ap.add_argument("--delay", type=float, default=0.0)
+    args = ap.parse_args()
+    with StandIn(args.fixtures, delay=args.delay) as s:
+        print(f"LOGIN_URL={s.login_url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -1,22 +1,57 @@
 # main.py
 # -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import time
+_T_START = time.perf_counter()   # от запуска интерпретатора до готовности бота (метрика startup)
+
 import os
 import re
-import time
 import logging
-from logging.handlers import RotatingFileHandler
+import asyncio
+import concurrent.futures
+import importlib
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
+import atexit
+import contextvars
 import threading
-from dataclasses import dataclass
-from typing import List
+import multiprocessing
+import signal
+import socket
+import hashlib
+import hmac
+import secrets
+import json
+import csv
+import io
+import sqlite3
+import requests
+from requests.adapters import HTTPAdapter
+import math
+import random
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import astuple, dataclass, field
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Set, Tuple
 import subprocess
+try:
+    import fcntl
+except ImportError:   # Windows: слоты кэша без блокировки не раздаём
+    fcntl = None
 import shutil
 from pathlib import Path
+from html import escape as html_escape
+from urllib.parse import urljoin, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bisect import bisect_right
 
 # ── .env загружаем из той же папки, где лежит main.py ──
 from dotenv import load_dotenv
 load_dotenv(dotenv_path=Path(__file__).with_name(".env"))
 
-# ── Тишина в консоли: весь мусор в лог ──
+# ── Тишина в консоли: весь мусор в лог (до настройки логирования — в никуда) ──
 try:
     import sys
     sys.stdout = open(os.devnull, "w", buffering=1)
@@ -24,65 +59,379 @@ try:
 except Exception:
     pass
 
-from bs4 import BeautifulSoup
+class _LazyName:
+    """
+    Имя из тяжёлого модуля, которое импортируется при первом обращении: selenium,
+    webdriver_manager и bs4 не нужны, пока бот стартует и отвечает на команды.
+    """
+    __slots__ = ("_module", "_attr", "_obj")
+
+    def __init__(self, module: str, attr: str = ""):
+        self._module = module
+        self._attr = attr
+        self._obj = None
+
+    def _load(self):
+        if self._obj is None:
+            obj = importlib.import_module(self._module)
+            self._obj = getattr(obj, self._attr) if self._attr else obj
+        return self._obj
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+BeautifulSoup = _LazyName("bs4", "BeautifulSoup")
+try:
+    import lxml  # noqa: F401  — ускоряет разбор снимков страницы, если установлен
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+try:
+    import openpyxl  # по желанию: /batch отдаёт XLSX вместо CSV
+except ImportError:
+    openpyxl = None
+try:
+    from cryptography.fernet import Fernet, InvalidToken  # по желанию: шифрование логина/пароля в журнале задач
+except ImportError:
+    Fernet = InvalidToken = None
+try:
+    import redis  # по желанию: брокер задач на Redis (BROKER_URL=redis://…)
+except ImportError:
+    redis = None
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait, Select
-from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.chrome import ChromeDriverManager
+webdriver = _LazyName("selenium.webdriver")
+By = _LazyName("selenium.webdriver.common.by", "By")
+Service = _LazyName("selenium.webdriver.chrome.service", "Service")
+Options = _LazyName("selenium.webdriver.chrome.options", "Options")
+WebDriverWait = _LazyName("selenium.webdriver.support.ui", "WebDriverWait")
+Select = _LazyName("selenium.webdriver.support.ui", "Select")
+EC = _LazyName("selenium.webdriver.support.expected_conditions")
+ChromeDriverManager = _LazyName("webdriver_manager.chrome", "ChromeDriverManager")
+# лёгкие; нужны настоящие классы для except
+from selenium.common.exceptions import StaleElementReferenceException, TimeoutException, WebDriverException
 
 from telegram import (
-    Update, InlineKeyboardMarkup, InlineKeyboardButton, ParseMode, BotCommand
+    Update, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
 )
+from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from telegram.ext import (
-    Updater, CallbackContext, CommandHandler, MessageHandler, Filters,
-    CallbackQueryHandler, ConversationHandler
+    Application, ContextTypes, CommandHandler, MessageHandler, filters,
+    CallbackQueryHandler, ConversationHandler, BaseUpdateProcessor
 )
 
 # ── Настройки ──
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-LOGIN_URL = "https://mlkm.netbynet.ru/loginTemp"
+# polling = long polling (по умолчанию); webhook = Telegram сам присылает апдейты на наш HTTP
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")            # внешний адрес, напр. https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")                 # пусто = случайный при каждом запуске
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "8" if BOT_MODE == "webhook" else "1"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")              # для локального фейкового Bot API
+LOGIN_URL = os.getenv("LOGIN_URL", "https://mlkm.netbynet.ru/loginTemp")
+# Куда сохранять HTML логина/заявки/вкладок для офлайн-бенчмарка (bench/); пусто = не сохранять.
+# В снимках реальные персональные данные — не коммитить!
+RECORD_FIXTURES_DIR = os.getenv("RECORD_FIXTURES_DIR", "")
 
 HARD_WAIT_AFTER_LOGIN_SEC = int(os.getenv("HARD_WAIT", "12"))
+# adaptive = ждём маркер + тишину в сети/спиннеры; sleep = старые фиксированные паузы
+READY_MODE = os.getenv("READY_MODE", "adaptive").strip().lower()
+READY_TIMEOUT = int(os.getenv("READY_TIMEOUT", "0"))      # потолок ожидания, сек (0 = пауза + SELENIUM_TIMEOUT)
+READY_IDLE_MS = int(os.getenv("READY_IDLE_MS", "500"))    # сколько мс без новых запросов считаем «сеть затихла»
+# snapshot = один снимок HTML на вкладку и разбор офлайн; live = поиск через WebDriver по каждому полю
+EXTRACT_MODE = os.getenv("EXTRACT_MODE", "snapshot").strip().lower()
+# 1 = вкладки заявки открываются в отдельных окнах той же сессии и грузятся одновременно
+PARALLEL_TABS = os.getenv("PARALLEL_TABS", "0") not in ("0", "false", "False")
+# 1 = раскрывать «Последние заявки клиента» и «Показать удаленные подключения» и добавлять их в ответ;
+# выключено, пока подписи ссылок и заголовки таблиц не сверены с настоящим порталом
+HISTORY_TABLES = os.getenv("HISTORY_TABLES", "0") not in ("0", "false", "False")
+TABLE_WAIT_SEC = float(os.getenv("TABLE_WAIT", "5"))      # сколько ждать таблицу после раскрытия, сек
+# selenium = всегда браузер; http = сначала лёгкий сбор через requests, при пробелах — браузер
+COLLECTOR = os.getenv("COLLECTOR", "selenium").strip().lower()
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "15"))
 HEADLESS = os.getenv("HEADLESS", "1") not in ("0", "false", "False")
+# найденные Chrome и chromedriver с версиями; при следующих запусках сеть не нужна
+BROWSER_CACHE_FILE = os.getenv("BROWSER_CACHE_FILE", str(Path(__file__).with_name(".browser_cache.json")))
 SELENIUM_TIMEOUT = 30
+# Облегчённый браузер: без картинок, шрифтов, медиа и счётчиков, с общим дисковым кэшем.
+# Читаем только текст, поэтому на портале ничего не теряется; 0 — прежний полный профиль.
+LEAN_BROWSER = os.getenv("LEAN_BROWSER", "0") not in ("0", "false", "False")
+_LEAN_BLOCK_URLS = ("*.png,*.jpg,*.jpeg,*.gif,*.webp,*.svg,*.ico,*.bmp,"
+                    "*.woff,*.woff2,*.ttf,*.otf,*.eot,*.mp4,*.webm,*.mp3,*.ogg")
+_LEAN_BLOCK_HOSTS = ("google-analytics.com,googletagmanager.com,doubleclick.net,mc.yandex.ru,"
+                     "top-fwz1.mail.ru,counter.yadro.ru")
+BLOCK_URLS = [u.strip() for u in os.getenv("BLOCK_URLS", _LEAN_BLOCK_URLS if LEAN_BROWSER else "").split(",") if u.strip()]
+BLOCK_HOSTS = [h.strip() for h in os.getenv("BLOCK_HOSTS", _LEAN_BLOCK_HOSTS if LEAN_BROWSER else "").split(",") if h.strip()]
+BLOCK_IMAGES = os.getenv("BLOCK_IMAGES", "1" if LEAN_BROWSER else "0") not in ("0", "false", "False")
+# дисковый кэш Chrome, общий для драйверов пула (у каждого одновременно живого — свой слот внутри)
+BROWSER_DISK_CACHE = os.getenv("BROWSER_DISK_CACHE", str(Path(__file__).with_name(".chrome_cache")) if LEAN_BROWSER else "")
+RENDERER_PROCESS_LIMIT = int(os.getenv("RENDERER_PROCESS_LIMIT", "2" if LEAN_BROWSER else "0"))  # 0 = без ограничения
+# normal = ждать все ресурсы, eager = только DOM (картинки/стили догружаются без нас)
+PAGE_LOAD_STRATEGY = os.getenv("PAGE_LOAD_STRATEGY", "eager" if LEAN_BROWSER else "normal").strip().lower()
+WINDOW_SIZE = os.getenv("WINDOW_SIZE", "1920,1080").strip()
+
+# Портал: повторы стадий при временных сбоях и автомат, который не пускает запросы на лежащий портал
+PORTAL_RETRIES = int(os.getenv("PORTAL_RETRIES", "1"))              # повторов стадии (таймаут, устаревший элемент)
+PORTAL_RETRY_BASE = float(os.getenv("PORTAL_RETRY_BASE", "2.0"))    # пауза перед повтором: base·2^n со случайным разбросом, сек
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "3"))          # сбоев портала подряд до размыкания (0 = без автомата)
+BREAKER_COOLDOWN = int(os.getenv("BREAKER_COOLDOWN", "60"))         # сколько не ходить на портал после размыкания, сек
+BREAKER_PROBE_TIMEOUT = int(os.getenv("BREAKER_PROBE_TIMEOUT", "10"))  # проверка портала перед замыканием, сек
+
+# Пул браузеров: сколько Chrome держим прогретыми и когда их пересоздаём
+DRIVER_POOL_SIZE = max(1, int(os.getenv("DRIVER_POOL_SIZE", "2")))
+DRIVER_MAX_USES = int(os.getenv("DRIVER_MAX_USES", "20"))        # 0 = без ограничения
+DRIVER_MAX_AGE_SEC = int(os.getenv("DRIVER_MAX_AGE", "1800"))    # 0 = без ограничения
+DRIVER_WARMUP = os.getenv("DRIVER_WARMUP", "1") not in ("0", "false", "False")
+DRIVER_LEASE_TIMEOUT = int(os.getenv("DRIVER_LEASE_TIMEOUT", "300"))
+# thread = браузеры в потоках процесса бота; process = каждый браузер в своём процессе-воркере
+SCRAPE_ISOLATION = os.getenv("SCRAPE_ISOLATION", "thread").strip().lower()
+WORKER_JOB_TIMEOUT = int(os.getenv("WORKER_JOB_TIMEOUT", "180"))  # жёсткий предел на один сбор, сек (process)
+WORKER_MAX_RSS_MB = int(os.getenv("WORKER_MAX_RSS_MB", "1500"))   # перезапуск воркера тяжелее N МБ вместе с Chrome (0 = нет)
+
+# Брокер задач: бот только принимает запросы, собирают воркеры (python main.py worker) — хоть на других машинах
+BROKER_URL = os.getenv("BROKER_URL", "").strip()      # пусто = собирать в процессе бота; sqlite:///путь/broker.db | redis://host:6379/0
+BROKER_KEY = os.getenv("BROKER_KEY", "").strip()      # ключ Fernet, обязателен с BROKER_URL: задачи и ответы в брокере шифруются
+BROKER_LEASE_SEC = int(os.getenv("BROKER_LEASE", "60"))            # задача без продления аренды возвращается в очередь, сек
+BROKER_HEARTBEAT_SEC = float(os.getenv("BROKER_HEARTBEAT", "5"))   # воркер отмечается и продлевает аренды раз в N сек
+BROKER_MAX_ATTEMPTS = int(os.getenv("BROKER_MAX_ATTEMPTS", "2"))   # сколько раз выдавать задачу, если воркер пропал
+BROKER_WAIT_SEC = int(os.getenv("BROKER_WAIT", "600"))             # бот ждёт ответа воркеров не дольше, сек
+WORKER_CAPACITY = max(1, int(os.getenv("WORKER_CAPACITY", str(DRIVER_POOL_SIZE))))  # worker: одновременных сборов
+WORKER_NAME = os.getenv("WORKER_NAME", "").strip()   # пусто = хост:pid
+
+# Очередь задач: сколько сборов идёт одновременно и сколько ждёт (с брокером — сколько задач бот держит у воркеров)
+SCRAPE_WORKERS = max(1, int(os.getenv("SCRAPE_WORKERS", str(16 if BROKER_URL else DRIVER_POOL_SIZE))))
+SCRAPE_QUEUE_MAX = int(os.getenv("SCRAPE_QUEUE_MAX", "20"))
+SCRAPE_PER_CHAT_MAX = int(os.getenv("SCRAPE_PER_CHAT_MAX", "3"))
+SCRAPE_DRAIN_TIMEOUT = int(os.getenv("SCRAPE_DRAIN_TIMEOUT", "120"))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "20"))            # сколько исходящих сообщений отправлять за раз
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "1.0"))  # не чаще одной правки ответа, сек
+BATCH_MAX = int(os.getenv("BATCH_MAX", "50"))                  # максимум пар логин/пароль в одном /batch
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", str(DRIVER_POOL_SIZE)))  # одновременных сборов в пакете
+BATCH_FILE_MAX = 1024 * 1024                                    # файл со списком — не больше 1 МБ
+
+# Кэш авторизованных сессий портала (cookies) по логину
+SESSION_TTL_SEC = int(os.getenv("SESSION_TTL", "600"))          # 0 = кэш выключен
+SESSION_CACHE_MAX = int(os.getenv("SESSION_CACHE_MAX", "32"))
+SESSION_CHECK_TIMEOUT = int(os.getenv("SESSION_CHECK_TIMEOUT", "10"))
+
+# Кэш готовых ответов по HMAC логина/пароля
+RESULT_TTL_SEC = int(os.getenv("RESULT_TTL", "120"))            # 0 = кэш выключен
+RESULT_CACHE_MAX = int(os.getenv("RESULT_CACHE_MAX", "256"))
+RESULT_CACHE_DB = os.getenv("RESULT_CACHE_DB", "")              # путь к SQLite, пусто = только в памяти
+RESULT_CACHE_KEY = os.getenv("RESULT_CACHE_KEY", "").strip()    # ключ Fernet; без него RESULT_CACHE_DB не используется
+
+# Журнал задач: переживает перезапуск, недоделанные запросы продолжаются или пользователю приходит отказ
+JOURNAL_DB = os.getenv("JOURNAL_DB", str(Path(__file__).with_name("jobs.db")))  # пусто = без журнала
+JOURNAL_FLUSH_MS = int(os.getenv("JOURNAL_FLUSH_MS", "200"))    # записи пишутся пачкой раз в N мс
+JOURNAL_KEY = os.getenv("JOURNAL_KEY", "").strip()               # ключ Fernet; без него логин/пароль не сохраняются
+JOURNAL_RESUME_MAX_AGE = int(os.getenv("JOURNAL_RESUME_MAX_AGE", "900"))  # старше — не продолжать, а извиниться, сек
+JOURNAL_KEEP_DAYS = int(os.getenv("JOURNAL_KEEP_DAYS", "30"))    # сколько хранить историю задач
+
+# Метрики: админы для /stats и (по желанию) локальный HTTP с текстом для Prometheus
+ADMIN_IDS = {int(x) for x in re.split(r"[,\s]+", os.getenv("ADMIN_IDS", "")) if x.strip().isdigit()}
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "500"))        # сколько последних замеров на стадию
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))              # 0 = не поднимать /metrics
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
 
 LOG_FILE = os.getenv("LOG_FILE", "bot.log")
 LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
 LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "2"))
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").strip().lower()    # json = строка JSON на запись, text = как раньше
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+# доля запросов, для которых пишется подробная отладка разбора (DEBUG: модели, таблицы, ненайденные поля);
+# при LOG_LEVEL=DEBUG отладка пишется для всех запросов и выборка не нужна
+LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", "0"))
+DUMP_ON_FAIL_DIR = os.getenv("DUMP_ON_FAIL_DIR", "")            # куда сохранять HTML страницы при сбое разбора
 
 # ── Логирование ──
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-    handlers=[RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)],
-    force=True,
+# Потоки сбора только кладут запись в очередь; в файл (с ротацией) пишет отдельный поток
+# QueueListener. У записи — id запроса из контекста, пароли из него же и по шаблонам маскируются.
+_LOG_CTX: contextvars.ContextVar = contextvars.ContextVar("log_ctx", default=None)
+_LOG_DEBUG_ALL = LOG_LEVEL == "DEBUG"
+_MASK_RE = re.compile(r"(?i)((?:пароль|password|passwd|pwd)[\w ]{0,20}?[\"']?\s*[:=]\s*[\"']?)([^\s\"',;<]+)")
+
+@contextmanager
+def log_context(rid: str = "", secret_values=()):
+    """
+    Контекст одного запроса: id (попадает в каждую запись лога, в том числе из вложенных
+    стадий), значения, которые надо маскировать, и решение о подробной отладке (LOG_DEBUG_SAMPLE).
+    """
+    ctx = {
+        "rid": rid or secrets.token_hex(4),
+        "secrets": {v for v in secret_values if v and len(v) >= 4},
+        "secrets_re": None,
+        "debug": LOG_DEBUG_SAMPLE > 0 and random.random() < LOG_DEBUG_SAMPLE,
+    }
+    token = _LOG_CTX.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _LOG_CTX.reset(token)
+
+def request_id() -> str:
+    ctx = _LOG_CTX.get()
+    return ctx["rid"] if ctx else ""
+
+def log_sampled() -> bool:
+    """Писать ли подробную отладку для текущего запроса — чтобы не собирать её зря."""
+    if _LOG_DEBUG_ALL:
+        return True
+    ctx = _LOG_CTX.get()
+    return bool(ctx and ctx["debug"])
+
+def mask_secret(*values: str):
+    """Добавляет значения (пароль PPPoE, временный пароль) к маскируемым в текущем запросе."""
+    ctx = _LOG_CTX.get()
+    if ctx is not None:
+        ctx["secrets"].update(v for v in values if v and v != "—" and len(v) >= 4)
+        ctx["secrets_re"] = None
+
+def mask(text: str) -> str:
+    """
+    Пароли — в подписанных полях («пароль: …», password=…) и значения из контекста запроса,
+    но только целым словом: пароль «1234» не портит номер заявки 512345.
+    """
+    ctx = _LOG_CTX.get()
+    if ctx and ctx["secrets"]:
+        if ctx["secrets_re"] is None:
+            alts = "|".join(re.escape(v) for v in sorted(ctx["secrets"], key=len, reverse=True))
+            ctx["secrets_re"] = re.compile(rf"(?<!\w)(?:{alts})(?!\w)")
+        text = ctx["secrets_re"].sub("***", text)
+    return _MASK_RE.sub(r"\1***", text)
+
+class _RequestQueueHandler(QueueHandler):
+    """В очередь — уже готовый текст: id запроса, маскировка, отбор DEBUG по выборке (если LOG_LEVEL выше DEBUG)."""
+    def filter(self, record):
+        if record.levelno < logging.INFO and not log_sampled():
+            return False
+        return super().filter(record)
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = mask(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = mask(logging.Formatter().formatException(record.exc_info))
+        record.exc_info = None
+        if not getattr(record, "rid", ""):
+            record.rid = request_id() or "-"
+        return record
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        d = {
+            "ts": f"{self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "rid": getattr(record, "rid", "-"),
+            "msg": record.getMessage(),
+        }
+        if record.processName != "MainProcess":
+            d["proc"] = record.processName
+        if record.exc_text:
+            d["exc"] = record.exc_text
+        return json.dumps(d, ensure_ascii=False)
+
+class _LogStream:
+    """sys.stdout/stderr → лог построчно: трейсбеки потоков и печать библиотек больше не теряются."""
+    def __init__(self, logger: logging.Logger, level: int):
+        self.logger = logger
+        self.level = level
+        self._buf = ""
+
+    def write(self, text: str) -> int:
+        self._buf += text
+        while "\n" in self._buf:
+            line, self._buf = self._buf.split("\n", 1)
+            if line.strip():
+                self.logger.log(self.level, line.rstrip())
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+_LOG_FILE_HANDLER = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+_LOG_FILE_HANDLER.setFormatter(
+    _JsonFormatter() if LOG_FORMAT == "json"
+    else logging.Formatter("%(asctime)s | %(levelname)s | %(name)s | %(rid)s | %(message)s")
 )
+_LOG_QUEUE: "queue.SimpleQueue" = queue.SimpleQueue()
+_LOG_LISTENER = QueueListener(_LOG_QUEUE, _LOG_FILE_HANDLER)
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)
+logging.basicConfig(level=LOG_LEVEL, handlers=[_RequestQueueHandler(_LOG_QUEUE)], force=True)
+logging.raiseExceptions = False     # ошибка записи лога ушла бы в stderr, то есть снова в лог
 log = logging.getLogger("mlkm-bot")
-for noisy in ["apscheduler", "urllib3", "WDM", "selenium", "telegram"]:
+if LOG_DEBUG_SAMPLE > 0:
+    log.setLevel(logging.DEBUG)
+for noisy in ["apscheduler", "urllib3", "WDM", "selenium", "telegram", "httpx"]:
     logging.getLogger(noisy).setLevel(logging.WARNING)
+sys.stdout = _LogStream(logging.getLogger("stdout"), logging.INFO)
+sys.stderr = _LogStream(logging.getLogger("stderr"), logging.WARNING)
+
+_WORKER_LOG = []     # [multiprocessing.Queue, QueueListener] — записи процессов-воркеров пишет основной процесс
+
+def _worker_log_queue():
+    if not _WORKER_LOG:
+        q = multiprocessing.get_context("spawn").Queue()
+        listener = QueueListener(q, _LOG_FILE_HANDLER)
+        listener.start()
+        atexit.register(listener.stop)
+        _WORKER_LOG.extend((q, listener))
+    return _WORKER_LOG[0]
+
+def _log_to_parent(q):
+    """В процессе-воркере: свой файл не трогаем (ротация из двух процессов портит лог), всё — в очередь родителя."""
+    _LOG_LISTENER.stop()
+    _LOG_FILE_HANDLER.close()
+    logging.basicConfig(level=LOG_LEVEL, handlers=[_RequestQueueHandler(q)], force=True)
 
 # ── Диалоговые состояния ──
-OPERATOR, LOGIN, PASS = range(3)
+OPERATOR, LOGIN, PASS, BATCH = range(4)
 
 # ── Модели ──
-@dataclass
+# Результаты неизменяемые и со __slots__: их много в кэшах, очередях и пакетных выгрузках.
+# Версия схемы сериализации: менять при любом изменении состава или порядка полей ниже.
+RESULT_SCHEMA = 2
+
+@dataclass(frozen=True, slots=True)
 class ServiceRow:
     product: str
     tariff: str
 
-@dataclass
+@dataclass(frozen=True, slots=True)
+class RemovedConnection:
+    product: str
+    tariff: str
+    closed: str
+
+@dataclass(frozen=True, slots=True)
+class RequestRow:
+    number: str
+    date: str
+    kind: str
+    status: str
+
+@dataclass(frozen=True, slots=True)
 class MainPageData:
     request_number: str = "—"
     account_number: str = "—"
     address: str = "—"
     temp_password: str = "—"
-    services: List[ServiceRow] = None
+    services: Tuple[ServiceRow, ...] = ()
+    removed: Tuple[RemovedConnection, ...] = ()     # «Показать удаленные подключения»
+    history: Tuple[RequestRow, ...] = ()            # «Последние заявки клиента»
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ClientData:
     abonent_number: str = "—"
     contact_mobile: str = "—"
@@ -91,18 +440,254 @@ class ClientData:
     firstname: str = "—"
     middlename: str = "—"
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class PppoeData:
     login: str = "—"
     password: str = "—"
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Collected:
     main: MainPageData
     client: ClientData
     pppoe: PppoeData
 
+    def to_bytes(self) -> bytes:
+        """Компактно: JSON-массив [версия схемы, main, client, pppoe] со значениями полей по порядку, без имён."""
+        return json.dumps([RESULT_SCHEMA, *astuple(self)], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    @classmethod
+    def from_bytes(cls, raw) -> "Collected":
+        """Обратное к to_bytes; запись другой версии схемы — ValueError (в кэше это просто промах)."""
+        d = json.loads(raw)
+        if not isinstance(d, list) or not d or d[0] != RESULT_SCHEMA:
+            raise ValueError(f"неизвестная версия схемы результата: {d[0] if isinstance(d, list) and d else None}")
+        _, main, client, pppoe = d
+        return cls(
+            main=cls.section_from_list("main", main),
+            client=cls.section_from_list("client", client),
+            pppoe=cls.section_from_list("pppoe", pppoe),
+        )
+
+    @staticmethod
+    def section_from_list(name: str, values: list):
+        """Одна секция из списка значений (astuple) — из to_bytes и из ответов воркеров через брокер."""
+        if name == "main":
+            *head, services, removed, history = values
+            return MainPageData(*head, tuple(ServiceRow(*r) for r in services),
+                                tuple(RemovedConnection(*r) for r in removed),
+                                tuple(RequestRow(*r) for r in history))
+        return {"client": ClientData, "pppoe": PppoeData}[name](*values)
+
+# ── Метрики ──
+class Metrics:
+    """Скользящие окна замеров по стадиям (p50/p95/p99) и счётчики событий."""
+    def __init__(self, window: int):
+        self.window = window
+        self._hist: Dict[str, deque] = {}
+        self._counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            self._hist.setdefault(name, deque(maxlen=self.window)).append(value)
+        self._capture(name, value)
+
+    def _capture(self, name: str, value: float):
+        stages = getattr(self._local, "stages", None)
+        if stages is not None:
+            stages[name] = stages.get(name, 0.0) + value
+
+    @contextmanager
+    def capture(self):
+        """Замеры этого потока за время блока: {стадия: сумма} — длительности стадий одной задачи."""
+        prev = getattr(self._local, "stages", None)
+        stages = self._local.stages = {}
+        try:
+            yield stages
+        finally:
+            self._local.stages = prev
+
+    def inc(self, name: str, n: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    @contextmanager
+    def timed(self, name: str):
+        t0 = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.inc(f"{name}_errors")
+            raise
+        finally:
+            self.observe(name, time.monotonic() - t0)
+
+    def export(self) -> Tuple[Dict[str, List[float]], Dict[str, int]]:
+        """Сырые замеры и счётчики — чтобы перенести их из процесса-воркера в основной (merge)."""
+        with self._lock:
+            return {k: list(v) for k, v in self._hist.items()}, dict(self._counters)
+
+    def merge(self, hist: Dict[str, List[float]], counters: Dict[str, int]):
+        with self._lock:
+            for k, xs in hist.items():
+                self._hist.setdefault(k, deque(maxlen=self.window)).extend(xs)
+            for k, n in counters.items():
+                self._counters[k] = self._counters.get(k, 0) + n
+        for k, xs in hist.items():
+            self._capture(k, sum(xs))
+
+    @staticmethod
+    def _q(xs: List[float], q: float) -> float:
+        return xs[min(len(xs) - 1, max(0, math.ceil(q * len(xs)) - 1))]
+
+    def snapshot(self) -> Tuple[Dict[str, dict], Dict[str, int]]:
+        with self._lock:
+            hist = {k: sorted(v) for k, v in self._hist.items() if v}
+            counters = dict(self._counters)
+        summary = {
+            k: {"n": len(xs), "p50": self._q(xs, 0.5), "p95": self._q(xs, 0.95), "p99": self._q(xs, 0.99)}
+            for k, xs in hist.items()
+        }
+        return summary, counters
+
+    def prometheus(self) -> str:
+        summary, counters = self.snapshot()
+        lines = ["# TYPE mlkm_stage summary"]
+        for name, s in sorted(summary.items()):
+            for q, label in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99")):
+                lines.append(f'mlkm_stage{{stage="{name}",quantile="{label}"}} {s[q]:.6f}')
+            lines.append(f'mlkm_stage_count{{stage="{name}"}} {s["n"]}')
+        lines.append("# TYPE mlkm_events_total counter")
+        for name, v in sorted(counters.items()):
+            lines.append(f'mlkm_events_total{{event="{name}"}} {v}')
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics(METRICS_WINDOW)
+
+def start_metrics_server(host: str, port: int) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = METRICS.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    srv = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=srv.serve_forever, name="metrics", daemon=True).start()
+    log.info("Метрики Prometheus: http://%s:%d/metrics", host, port)
+    return srv
+
+# ── Процессы (Linux /proc; на других ОС функции ничего не находят) ──
+def _ppid_map() -> Dict[int, int]:
+    out = {}
+    try:
+        names = os.listdir("/proc")
+    except OSError:
+        return out
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "rb") as f:
+                stat = f.read().decode("utf-8", "replace")
+            out[int(name)] = int(stat.rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            pass
+    return out
+
+def _process_tree(pid: int) -> List[int]:
+    """pid и все его потомки (chromedriver → chrome → renderer…)."""
+    children: Dict[int, List[int]] = {}
+    for child, parent in _ppid_map().items():
+        children.setdefault(parent, []).append(child)
+    out, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        out.append(p)
+        stack.extend(children.get(p, ()))
+    return out
+
+def _tree_rss_mb(pid: int) -> float:
+    total = 0
+    for p in _process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            pass
+    return total / 1024
+
+def _kill_tree(pid: int):
+    """SIGKILL процессу и всем его потомкам — чтобы после сбоя не оставались висящие Chrome."""
+    for p in reversed(_process_tree(pid)):
+        try:
+            os.kill(p, signal.SIGKILL)
+        except OSError:
+            pass
+
 # ── Selenium helpers ──
+def _origin(url: str) -> str:
+    u = urlsplit(url)
+    return f"{u.scheme}://{u.netloc}"
+
+class _CacheSlots:
+    """
+    Каталоги дискового кэша Chrome: один Chrome не делит кэш с другим одновременно
+    живым (кэш Chrome не рассчитан на общий доступ), но слот переходит к следующему
+    драйверу — после пересоздания браузера статика портала уже на диске.
+    Занятость — flock на .lock в слоте, поэтому работает и между процессами-воркерами.
+    """
+    def __init__(self, base: str):
+        self.base = base
+
+    def acquire(self) -> Tuple[str, Optional[int]]:
+        for i in range(64):
+            path = os.path.join(self.base, str(i))
+            try:
+                os.makedirs(path, exist_ok=True)
+                fd = os.open(os.path.join(path, ".lock"), os.O_CREAT | os.O_RDWR, 0o600)
+            except OSError as e:
+                log.warning("Дисковый кэш браузера недоступен (%s): %s", self.base, e)
+                return "", None
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return path, fd
+            except OSError:
+                os.close(fd)
+        return "", None
+
+    @staticmethod
+    def release(fd: Optional[int]):
+        if fd is not None:
+            try:
+                os.close(fd)   # закрытие снимает flock
+            except OSError:
+                pass
+
+CACHE_SLOTS = _CacheSlots(BROWSER_DISK_CACHE) if BROWSER_DISK_CACHE and fcntl else None
+
+def _apply_blocking(driver):
+    """Блокировка URL по маске (картинки, шрифты, медиа) через CDP — действует на текущее окно."""
+    if not BLOCK_URLS:
+        return
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCK_URLS})
+    except Exception as e:
+        log.warning("Не удалось включить блокировку ресурсов: %s", e)
+
 def _find_chrome_binary() -> str:
     """Ищем установленный Chrome/Chromium (Ubuntu, snap и т.п.). Можно задать CHROME_BIN в .env."""
     env_bin = os.getenv("CHROME_BIN")
@@ -125,6 +710,100 @@ def _find_chrome_binary() -> str:
             return p
     return ""
 
+_VERSION_RE = re.compile(r"\d+(?:\.\d+){2,3}")
+_BROWSER: Optional[dict] = None
+_BROWSER_LOCK = threading.Lock()
+
+def _binary_version(path: str) -> str:
+    try:
+        out = subprocess.run([path, "--version"], capture_output=True, text=True, timeout=30).stdout
+    except (OSError, subprocess.SubprocessError):
+        return ""
+    m = _VERSION_RE.search(out)
+    return m.group(0) if m else ""
+
+def _file_sig(path: str) -> list:
+    """Размер и mtime: если файл не менялся, его версия тоже — без запуска `--version`."""
+    try:
+        st = os.stat(path)
+        return [st.st_size, int(st.st_mtime)]
+    except OSError:
+        return []
+
+def _same_major(a: str, b: str) -> bool:
+    return bool(a and b) and a.split(".", 1)[0] == b.split(".", 1)[0]
+
+def _load_browser_cache() -> Optional[dict]:
+    try:
+        with open(BROWSER_CACHE_FILE, encoding="utf-8") as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(info, dict) or info.get("schema") != 1:
+        return None
+    return info
+
+def _browser_cache_valid(info: dict) -> bool:
+    env_bin = os.getenv("CHROME_BIN")
+    if env_bin and env_bin != info.get("chrome_bin"):
+        return False
+    return (
+        bool(info.get("chrome_bin")) and _file_sig(info["chrome_bin"]) == info.get("chrome_sig")
+        and bool(info.get("driver_path")) and _file_sig(info["driver_path"]) == info.get("driver_sig")
+        and _same_major(info.get("chrome_version", ""), info.get("driver_version", ""))
+    )
+
+def resolve_browser(refresh: bool = False) -> Tuple[str, str]:
+    """
+    (путь к Chrome, путь к chromedriver) — один раз на процесс. Между запусками берётся из
+    BROWSER_CACHE_FILE, пока оба файла не менялись; при обновлении Chrome драйвер подбирается
+    заново (сеть нужна только в этот момент). Несовпадение мажорных версий — предупреждение,
+    такой результат в кэш не пишется.
+    """
+    global _BROWSER
+    with _BROWSER_LOCK:
+        if _BROWSER is not None and not refresh:
+            return _BROWSER["chrome_bin"], _BROWSER["driver_path"]
+        t0 = time.monotonic()
+        cached = None if refresh else _load_browser_cache()
+        if cached and _browser_cache_valid(cached):
+            _BROWSER = cached
+            log.info("Браузер из кэша: Chrome %s, chromedriver %s", cached["chrome_version"], cached["driver_version"])
+            return cached["chrome_bin"], cached["driver_path"]
+
+        chrome_bin = _find_chrome_binary()
+        chrome_version = _binary_version(chrome_bin) if chrome_bin else ""
+        try:
+            driver_path = ChromeDriverManager().install()
+        except Exception as e:
+            # без сети: прежний драйвер годится, если подходит к установленному Chrome
+            if not (cached and _same_major(chrome_version, cached.get("driver_version", ""))
+                    and _file_sig(cached.get("driver_path", ""))):
+                raise
+            log.warning("chromedriver не скачать (%s), беру из кэша %s", e, cached["driver_path"])
+            driver_path = cached["driver_path"]
+        driver_version = _binary_version(driver_path)
+        info = {
+            "schema": 1,
+            "chrome_bin": chrome_bin, "chrome_version": chrome_version, "chrome_sig": _file_sig(chrome_bin),
+            "driver_path": driver_path, "driver_version": driver_version, "driver_sig": _file_sig(driver_path),
+        }
+        if _same_major(chrome_version, driver_version):
+            try:
+                tmp = BROWSER_CACHE_FILE + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(info, f, ensure_ascii=False, indent=2)
+                os.replace(tmp, BROWSER_CACHE_FILE)
+            except OSError as e:
+                log.warning("Не удалось сохранить %s: %s", BROWSER_CACHE_FILE, e)
+        else:
+            log.warning("Версии не совпадают: Chrome %s, chromedriver %s", chrome_version or "?", driver_version or "?")
+        METRICS.observe("resolve_browser", time.monotonic() - t0)
+        log.info("Браузер: %s (%s), chromedriver %s (%s), %.2f с", chrome_bin or "—", chrome_version or "?",
+                 driver_path, driver_version or "?", time.monotonic() - t0)
+        _BROWSER = info
+        return chrome_bin, driver_path
+
 def build_driver(headless: bool = True) -> webdriver.Chrome:
     chrome_options = Options()
     if headless:
@@ -132,28 +811,237 @@ def build_driver(headless: bool = True) -> webdriver.Chrome:
     chrome_options.add_argument("--no-sandbox")
     chrome_options.add_argument("--disable-gpu")
     chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument("--window-size=1920,1080")
+    chrome_options.add_argument(f"--window-size={WINDOW_SIZE}")
     chrome_options.add_argument("--lang=ru-RU")
     chrome_options.add_argument("--log-level=3")
     chrome_options.add_argument("--disable-logging")
+    # фоновые окна (PARALLEL_TABS) не должны притормаживаться
+    chrome_options.add_argument("--disable-background-timer-throttling")
+    chrome_options.add_argument("--disable-backgrounding-occluded-windows")
+    chrome_options.add_argument("--disable-renderer-backgrounding")
     chrome_options.add_experimental_option("excludeSwitches", ["enable-automation", "enable-logging"])
     chrome_options.add_experimental_option("useAutomationExtension", False)
+    chrome_options.page_load_strategy = PAGE_LOAD_STRATEGY
+    if BLOCK_IMAGES:
+        chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+        chrome_options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+    if LEAN_BROWSER:
+        chrome_options.add_argument("--disable-remote-fonts")
+        chrome_options.add_argument("--disable-extensions")
+        chrome_options.add_argument("--mute-audio")
+        chrome_options.add_argument("--disable-features=Translate,MediaRouter,OptimizationHints,AutofillServerCommunication")
+    if BLOCK_HOSTS:
+        # счётчики режем на уровне DNS — это действует и на окна PARALLEL_TABS, куда CDP не дотягивается
+        rules = ", ".join(f"MAP {h} ~NOTFOUND, MAP *.{h} ~NOTFOUND" for h in BLOCK_HOSTS)
+        chrome_options.add_argument(f"--host-resolver-rules={rules}")
+    if RENDERER_PROCESS_LIMIT:
+        chrome_options.add_argument(f"--renderer-process-limit={RENDERER_PROCESS_LIMIT}")
 
-    bin_path = _find_chrome_binary()
+    bin_path, driver_path = resolve_browser()
     if bin_path:
         chrome_options.binary_location = bin_path
     else:
         log.warning("Chrome/Chromium не найден. Установите браузер (google-chrome-stable или chromium).")
 
     try:
-        service = Service(ChromeDriverManager().install(), log_output=subprocess.DEVNULL)
+        service = Service(driver_path, log_output=subprocess.DEVNULL)
     except TypeError:
-        service = Service(ChromeDriverManager().install())
+        service = Service(driver_path)
+
+    cache_dir, cache_fd = CACHE_SLOTS.acquire() if CACHE_SLOTS else ("", None)
+    if cache_dir:
+        chrome_options.add_argument(f"--disk-cache-dir={cache_dir}")
+    try:
+        driver = webdriver.Chrome(service=service, options=chrome_options)
+    except Exception:
+        _CacheSlots.release(cache_fd)
+        raise
+    if cache_fd is not None:
+        orig_quit = driver.quit
 
-    driver = webdriver.Chrome(service=service, options=chrome_options)
+        def quit():
+            try:
+                orig_quit()
+            finally:
+                _CacheSlots.release(cache_fd)
+
+        driver.quit = quit
     driver.set_page_load_timeout(60)
+    _apply_blocking(driver)
     return driver
 
+# ── Пул прогретых браузеров ──
+class _PooledDriver:
+    def __init__(self, driver):
+        self.driver = driver
+        self.created = time.monotonic()
+        self.uses = 0
+        self.rpc = 0
+        # считаем все команды WebDriver (элементы ходят через driver.execute)
+        orig = driver.execute
+
+        def execute(command, params=None):
+            self.rpc += 1
+            return orig(command, params)
+
+        driver.execute = execute
+
+class DriverPool:
+    """
+    Ограниченный пул Chrome: драйверы создаются заранее (или по требованию до size),
+    между выдачами чистятся cookies/storage, пересоздаются по числу выдач и возрасту.
+    """
+    def __init__(self, size: int, max_uses: int = 0, max_age: int = 0, factory=None):
+        self.size = size
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self._factory = factory or (lambda: build_driver(HEADLESS))
+        self._idle: List[_PooledDriver] = []
+        self._total = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _expired(self, pd: _PooledDriver) -> bool:
+        if self.max_uses and pd.uses >= self.max_uses:
+            return True
+        if self.max_age and time.monotonic() - pd.created >= self.max_age:
+            return True
+        return False
+
+    @staticmethod
+    def _healthy(pd: _PooledDriver) -> bool:
+        try:
+            pd.driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def _create(self) -> _PooledDriver:
+        try:
+            with METRICS.timed("build_driver"):
+                return _PooledDriver(self._factory())
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            raise
+
+    def _destroy(self, pd: _PooledDriver):
+        try:
+            pd.driver.quit()
+        except Exception as e:
+            log.warning("driver.quit() завершился с ошибкой, добиваю chromedriver и Chrome: %s", e)
+            proc = getattr(getattr(pd.driver, "service", None), "process", None)
+            if proc is not None and proc.poll() is None:
+                _kill_tree(proc.pid)
+                try:
+                    proc.wait(5)
+                except Exception:
+                    pass
+        with self._cond:
+            self._total -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _reset(pd: _PooledDriver) -> bool:
+        """Изоляция между выдачами: лишние окна, cookies, storage портала, пустая страница."""
+        d = pd.driver
+        try:
+            handles = d.window_handles
+            for h in handles[1:]:
+                d.switch_to.window(h)
+                d.close()
+            d.switch_to.window(handles[0])
+            try:
+                d.execute_cdp_cmd("Network.clearBrowserCookies", {})
+                for origin in {_origin(p.spec.login_url) for p in PROFILES.values()}:
+                    d.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+            except Exception:
+                d.delete_all_cookies()
+            d.get("about:blank")
+            return True
+        except Exception as e:
+            log.warning("Не удалось очистить браузер, пересоздаю: %s", e)
+            return False
+
+    def _acquire(self, timeout: float) -> _PooledDriver:
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("Пул браузеров закрыт")
+                pd = self._idle.pop() if self._idle else None
+                if pd is None:
+                    if self._total < self.size:
+                        self._total += 1
+                    else:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            raise TimeoutError("Нет свободного браузера в пуле")
+                        self._cond.wait(left)
+                        continue
+            if pd is None:
+                return self._create()
+            if self._expired(pd) or not self._healthy(pd):
+                self._destroy(pd)
+                continue
+            return pd
+
+    def _release(self, pd: _PooledDriver):
+        pd.uses += 1
+        if self._expired(pd) or not self._reset(pd):
+            self._destroy(pd)
+            return
+        with self._cond:
+            # закрытие могло пройти, пока чистился браузер: в пул после close() не возвращаем
+            closed = self._closed
+            if not closed:
+                self._idle.append(pd)
+                self._cond.notify()
+        if closed:
+            self._destroy(pd)
+
+    @contextmanager
+    def lease(self, timeout: float = DRIVER_LEASE_TIMEOUT):
+        with METRICS.timed("lease_wait"):
+            pd = self._acquire(timeout)
+        rpc0 = pd.rpc
+        try:
+            yield pd.driver
+        finally:
+            METRICS.observe("webdriver_calls", pd.rpc - rpc0)
+            self._release(pd)
+
+    def stats(self) -> Tuple[int, int]:
+        """(всего браузеров, свободных)."""
+        with self._cond:
+            return self._total, len(self._idle)
+
+    def warm_up(self):
+        while True:
+            with self._cond:
+                if self._closed or self._total >= self.size:
+                    return
+                self._total += 1
+            try:
+                pd = self._create()
+            except Exception as e:
+                log.warning("Прогрев пула браузеров не удался: %s", e)
+                return
+            with self._cond:
+                self._idle.append(pd)
+                self._cond.notify()
+            log.info("Браузер прогрет (%d/%d)", self._total, self.size)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for pd in idle:
+            self._destroy(pd)
+
+DRIVER_POOL = DriverPool(DRIVER_POOL_SIZE, DRIVER_MAX_USES, DRIVER_MAX_AGE_SEC)
+
 def _wait(driver, timeout=SELENIUM_TIMEOUT):
     return WebDriverWait(driver, timeout)
 
@@ -174,19 +1062,29 @@ BAD_SINGLE_TOKENS = {
     "Показать удаленные подключения", "Скрыть удаленные подключения"
 }
 
+_WS_RE = re.compile(r"\s+")
+_WS2_RE = re.compile(r"\s{2,}")
+_BAD_TOKENS_RE = re.compile(
+    r"\b(?:" + "|".join(re.escape(t) for t in sorted(BAD_SINGLE_TOKENS, key=len, reverse=True)) + r")\b", re.I
+)
+_CLEAN_STRIP = " \u200b\t\r\n:;–—"
+
 def _clean(v: str) -> str:
-    v = re.sub(r"\s+", " ", (v or "")).strip(" \u200b\t\r\n:;–—")
-    for t in BAD_SINGLE_TOKENS:
-        v = re.sub(rf"\b{re.escape(t)}\b", "", v, flags=re.I)
-    v = re.sub(r"\s{2,}", " ", v).strip(" \u200b\t\r\n:;–—")
+    v = _WS_RE.sub(" ", (v or "")).strip(_CLEAN_STRIP)
+    v = _BAD_TOKENS_RE.sub("", v)
+    v = _WS2_RE.sub(" ", v).strip(_CLEAN_STRIP)
     return v or "—"
 
+@lru_cache(maxsize=None)
+def _label_prefix_re(lab: str):
+    return re.compile(rf"(?i)^{re.escape(lab)}\s*[:\-–—]?\s*")
+
 def _strip_label(label: str, value: str) -> str:
     if not value:
         return "—"
     lab = label.strip().replace("ё","е").replace("Ё","Е")
     val = value.strip().replace("ё","е").replace("Ё","Е")
-    val = re.sub(rf"(?i)^{re.escape(lab)}\s*[:\-–—]?\s*", "", val).strip()
+    val = _label_prefix_re(lab).sub("", val).strip()
     return val or value
 
 def _save_dump(filename: str, html: str):
@@ -196,23 +1094,143 @@ def _save_dump(filename: str, html: str):
     except Exception:
         pass
 
+def _record_fixture(driver, name: str):
+    if RECORD_FIXTURES_DIR:
+        os.makedirs(RECORD_FIXTURES_DIR, exist_ok=True)
+        _save_dump(os.path.join(RECORD_FIXTURES_DIR, f"{name}.html"), driver.page_source)
+
+def _dump_failure(driver, stage: str):
+    """HTML страницы при сбое разбора — в DUMP_ON_FAIL_DIR; пароли запроса в снимке маскируются."""
+    if not DUMP_ON_FAIL_DIR:
+        return
+    try:
+        html = driver.page_source
+        os.makedirs(DUMP_ON_FAIL_DIR, exist_ok=True)
+    except Exception as e:
+        log.warning("Не удалось снять страницу при сбое [%s]: %s", stage, e)
+        return
+    name = f"{time.strftime('%Y%m%d_%H%M%S')}_{request_id() or '-'}_{stage}.html"
+    _save_dump(os.path.join(DUMP_ON_FAIL_DIR, name), mask(html))
+    log.info("Страница при сбое [%s] сохранена: %s", stage, name)
+
 def get_active_tab_panel(driver):
     try:
         return driver.find_element(By.XPATH, "//*[contains(@class,'tab-pane') and contains(@class,'active')]")
     except Exception:
         return driver.find_element(By.TAG_NAME, "body")
 
-def click_tab(driver, title):
+# ── Готовность страницы ──
+# Видимые элементы по XPath сообщения об отказе. Скрытый шаблон (display:none, visibility:hidden)
+# не считается; видимые до отправки формы помечаются _MARK_FAIL_JS и тоже не считаются —
+# отказ засчитывается, только если сообщение показано после отправки (новая страница или перерисовка).
+_FAIL_NODES_JS = """
+const failNodes = fx => {
+  const r = document.evaluate(fx, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+  const out = [];
+  for (let i = 0; i < r.snapshotLength; i++) {
+    const e = r.snapshotItem(i);
+    if (e.getClientRects().length && getComputedStyle(e).visibility !== 'hidden') out.push(e);
+  }
+  return out;
+};
+const failShown = fx => !!fx && failNodes(fx).some(e => !e.hasAttribute('data-okc-before-submit'));
+"""
+_MARK_FAIL_JS = _FAIL_NODES_JS + "failNodes(arguments[0]).forEach(e => e.setAttribute('data-okc-before-submit', ''));"
+_FAIL_JS = _FAIL_NODES_JS + "return failShown(arguments[0]);"
+
+# Один вызов на опрос: readyState, маркер, видимые спиннеры, активные XHR jQuery, число загруженных ресурсов
+_READY_JS = _FAIL_NODES_JS + """
+const xp = arguments[0], fx = arguments[1];
+const marker = xp ? document.evaluate(xp, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue : document.body;
+const failed = failShown(fx);
+const spin = Array.from(document.querySelectorAll(
+    "[class*='spinner'],[class*='loader'],[class*='loading'],[class*='preloader']"
+)).some(e => e.offsetParent !== null);
+const jq = (window.jQuery && window.jQuery.active) || 0;
+return [document.readyState, !!marker, spin, jq, performance.getEntriesByType('resource').length, failed];
+"""
+
+# при eager/none «load» не ждём: картинки и стили для разбора текста не нужны
+_READY_STATES = ("complete",) if PAGE_LOAD_STRATEGY == "normal" else ("interactive", "complete")
+
+def _record_ready(stage: str, sec: float):
+    METRICS.observe(f"ready:{stage}", sec)
+    log.info("Готовность [%s]: %.2f с (%s)", stage, sec, READY_MODE)
+
+def wait_ready(driver, stage: str, marker: str, timeout: float = SELENIUM_TIMEOUT, sleep_before: float = 0.0,
+               fail_marker: str = None) -> float:
+    """
+    Ждёт, пока страница готова: маркер есть в DOM, документ загружен, спиннеров нет,
+    новых сетевых запросов не было READY_IDLE_MS. Если маркер есть, но страница не затихла
+    до потолка — идём дальше; если маркера нет — TimeoutException, как у WebDriverWait.
+    fail_marker — XPath сообщения об отказе во входе: показан после отправки формы — сразу
+    BadCredentials (видимые до отправки помечает _MARK_FAIL_JS, скрытые не считаются).
+    В режиме READY_MODE=sleep — старое поведение: пауза sleep_before и ожидание маркера.
+    Возвращает фактическое время до готовности и пишет его в METRICS (ready:<стадия>).
+    """
+    t0 = time.monotonic()
+    if READY_MODE == "sleep":
+        if sleep_before:
+            time.sleep(sleep_before)
+        found = _wait(driver, timeout).until(lambda d: (
+            (fail_marker and d.execute_script(_FAIL_JS, fail_marker) and "fail")
+            or (d.find_elements(By.XPATH, marker) and "ok")
+        ))
+        if found == "fail":
+            raise BadCredentials(f"[{stage}] портал отказал во входе")
+        dt = time.monotonic() - t0
+        _record_ready(stage, dt)
+        return dt
+
+    ceiling = READY_TIMEOUT or (sleep_before + timeout)
+    deadline = t0 + ceiling
+    last_res, quiet_since, seen = -1, t0, False
+    while True:
+        now = time.monotonic()
+        try:
+            state, seen, spin, jq, res, failed = driver.execute_script(_READY_JS, marker, fail_marker)
+        except Exception:
+            state, seen, spin, jq, res, failed = "loading", False, True, 1, last_res, False
+        if failed:
+            raise BadCredentials(f"[{stage}] портал отказал во входе")
+        if res != last_res or jq:
+            last_res, quiet_since = res, now
+        if (seen and state in _READY_STATES and not spin and not jq
+                and (now - quiet_since) * 1000 >= READY_IDLE_MS):
+            break
+        if now >= deadline:
+            if not seen:
+                raise TimeoutException(f"[{stage}] маркер не появился за {ceiling:.0f} с: {marker}")
+            log.warning("[%s] страница не затихла за %.0f с, продолжаю", stage, ceiling)
+            break
+        time.sleep(0.2)
+    dt = time.monotonic() - t0
+    _record_ready(stage, dt)
+    return dt
+
+def _click_tab_button(driver, title):
     _wait(driver).until(EC.element_to_be_clickable(
         (By.XPATH, f"//*[self::a or self::button][contains(normalize-space(.), '{title}')]")
     )).click()
-    time.sleep(1.0)
+
+def click_tab(driver, title, marker: str = None, timeout: float = SELENIUM_TIMEOUT):
+    _click_tab_button(driver, title)
+    if marker:
+        wait_ready(driver, title, marker, timeout, sleep_before=1.0)
+    else:
+        time.sleep(1.0)
     _wait(driver).until(lambda d: get_active_tab_panel(d))
 
 # ── Главная: берём значение из той же строки таблицы ──
-def _main_field(driver, label: str) -> str:
-    xp1 = f"//tr[./td[normalize-space()='{label}']]/td[2]"
-    xp2 = f"//td[normalize-space()='{label}']/following-sibling::td[1]"
+def _main_field_xpaths(label: str) -> Tuple[str, str, str]:
+    return (
+        f"//tr[./td[normalize-space()='{label}']]/td[2]",
+        f"//td[normalize-space()='{label}']/following-sibling::td[1]",
+        f"//*[self::div or self::span][normalize-space()='{label}']/following-sibling::*[1]",
+    )
+
+def _main_field(driver, label: str, xpaths: Tuple[str, str, str] = None) -> str:
+    xp1, xp2, xp3 = xpaths or _main_field_xpaths(label)
     for xp in (xp1, xp2):
         try:
             td = driver.find_element(By.XPATH, xp)
@@ -222,7 +1240,6 @@ def _main_field(driver, label: str) -> str:
         except Exception:
             pass
     # Не таблица: соседний div/span
-    xp3 = f"//*[self::div or self::span][normalize-space()='{label}']/following-sibling::*[1]"
     try:
         sib = driver.find_element(By.XPATH, xp3)
         val = _clean(sib.get_attribute("textContent") or sib.text)
@@ -282,7 +1299,14 @@ def _value_from_same_row(group, label_node):
         pass
     return "—"
 
-def _value_in_panel(panel, label: str) -> str:
+def _panel_label_xpath(label: str) -> str:
+    norm = label.replace("ё","е").replace("Ё","Е")
+    return (
+        f".//*[self::label or self::td or self::th or self::div or self::span]"
+        f"[starts-with(translate(normalize-space(), 'Ёё','Ее'), '{norm}')]"
+    )
+
+def _value_in_panel(panel, label: str, lbl_xp: str = None) -> str:
     """
     Устойчиво вытаскивает значение по лейблу внутри активной вкладки:
     - label starts-with (учёт ё/е)
@@ -294,12 +1318,8 @@ def _value_in_panel(panel, label: str) -> str:
     if panel is None:
         return "—"
     norm = label.replace("ё","е").replace("Ё","Е")
-    lbl_xp = (
-        f".//*[self::label or self::td or self::th or self::div or self::span]"
-        f"[starts-with(translate(normalize-space(), 'Ёё','Ее'), '{norm}')]"
-    )
     try:
-        lbl = panel.find_element(By.XPATH, lbl_xp)
+        lbl = panel.find_element(By.XPATH, lbl_xp or _panel_label_xpath(label))
     except Exception:
         return "—"
 
@@ -359,243 +1379,3135 @@ def _value_in_panel(panel, label: str) -> str:
         pass
     return "—"
 
-# ── Услуги ──
+# ── Таблицы: весь <table> одним execute_script ──
+# На каждую TableSpec — первая таблица, в заголовках которой есть все подстроки колонок
+# (и нет exclude); с after — только таблицы после ссылки/кнопки с этим текстом.
+# Ответ: {headers: [...], rows: [[ячейка, ...], ...]} или null, если таблицы нет.
+_TABLES_JS = r"""
+const specs = arguments[0];
+const norm = s => (s || '').replace(/\s+/g, ' ').trim();
+const low = s => norm(s).toLowerCase();
+function findText(texts) {
+  const w = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT);
+  for (let n = w.nextNode(); n; n = w.nextNode()) {
+    const t = low(n.nodeValue);
+    if (texts.some(x => t.includes(x))) return n.parentElement;
+  }
+  return null;
+}
+function headers(t) { return Array.from(t.querySelectorAll('th')).map(th => norm(th.innerText)); }
+function rows(t) {
+  const out = [];
+  for (const tr of t.querySelectorAll('tbody > tr')) {
+    if (tr.closest('table') !== t) continue;
+    const tds = Array.from(tr.children).filter(c => c.tagName === 'TD');
+    if (tds.length) out.push(tds.map(td => norm(td.innerText)));
+  }
+  return out;
+}
+return specs.map(spec => {
+  let anchor = null;
+  if (spec.after.length) {
+    anchor = findText(spec.after);
+    if (!anchor) return null;
+  }
+  for (const t of document.querySelectorAll('table')) {
+    if (anchor && !(anchor.compareDocumentPosition(t) & Node.DOCUMENT_POSITION_FOLLOWING)) continue;
+    const hs = headers(t).map(h => h.toLowerCase());
+    if (!spec.needles.every(n => hs.some(h => h.includes(n)))) continue;
+    if (spec.exclude.some(n => hs.some(h => h.includes(n)))) continue;
+    return {headers: headers(t), rows: rows(t)};
+  }
+  return null;
+});
+"""
+
+# Кликает по элементу с первым текстовым узлом, содержащим каждый из текстов; возвращает, какие нажаты
+_CLICK_TEXTS_JS = r"""
+const low = s => (s || '').replace(/\s+/g, ' ').trim().toLowerCase();
+return arguments[0].map(text => {
+  const w = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT);
+  for (let n = w.nextNode(); n; n = w.nextNode()) {
+    if (low(n.nodeValue).includes(text)) { n.parentElement.click(); return true; }
+  }
+  return false;
+});
+"""
+
+def table_rows(spec: "TableSpec", found: Optional[dict]) -> tuple:
+    """Матрица из _TABLES_JS / PageSnapshot.table → модели строк: колонки сопоставляются по заголовкам."""
+    if not found:
+        return ()
+    headers = [h.lower() for h in found["headers"]]
+    idx = {attr: next((i for i, h in enumerate(headers) if needle.lower() in h), None)
+           for attr, needle in spec.columns}
+    out = []
+    for cells in found["rows"]:
+        vals = {attr: (cells[i] if i is not None and i < len(cells) else "") for attr, i in idx.items()}
+        if not vals[spec.key] or any(w in " ".join(vals.values()).lower() for w in spec.skip):
+            continue
+        out.append(spec.row(**{k: v or "—" for k, v in vals.items()}))
+        if spec.limit and len(out) >= spec.limit:
+            break
+    return tuple(out)
+
+def _find_tables(driver, specs) -> list:
+    return driver.execute_script(_TABLES_JS, [t.js_spec() for t in specs]) or [None] * len(specs)
+
+def extract_tables(driver, specs) -> Dict[str, tuple]:
+    """
+    Таблицы секции за один вызов WebDriver. Скрытые за ссылкой (toggle) раскрываются
+    кликом, и таблица ждётся до TABLE_WAIT_SEC; ссылки на странице нет или таблица
+    не нашлась — пустой кортеж без ожидания.
+    """
+    specs = [t for t in specs if HISTORY_TABLES or not t.toggle]
+    if not specs:
+        return {}
+    with METRICS.timed("tables"):
+        found = _find_tables(driver, specs)
+        hidden = [i for i, f in enumerate(found) if f is None and specs[i].toggle]
+        pending = []
+        if hidden:
+            clicked = driver.execute_script(_CLICK_TEXTS_JS, [specs[i].toggle.lower() for i in hidden]) or []
+            pending = [i for i, ok in zip(hidden, clicked) if ok]
+        deadline = time.monotonic() + TABLE_WAIT_SEC
+        while pending and time.monotonic() < deadline:
+            time.sleep(0.25)
+            again = _find_tables(driver, [specs[i] for i in pending])
+            for i, f in zip(list(pending), again):
+                if f is not None:
+                    found[i] = f
+                    pending.remove(i)
+        for i, f in enumerate(found):
+            if f is None:
+                log.info("Таблица «%s» не найдена", specs[i].title)
+        if log_sampled():
+            for t, f in zip(specs, found):
+                log.debug("Таблица «%s»: %s", t.title, json.dumps(f, ensure_ascii=False))
+        return {t.name: table_rows(t, f) for t, f in zip(specs, found)}
+
 def table_services(driver) -> List[ServiceRow]:
-    out: List[ServiceRow] = []
-    try:
-        table = _wait(driver).until(EC.presence_of_element_located(
-            (By.XPATH, "//table[.//th[contains(., 'Продукт')] and .//th[contains(., 'Тариф')]]")
-        ))
-        headers = table.find_elements(By.XPATH, ".//th")
-        idx = {h.text.strip(): i for i, h in enumerate(headers)}
-        def col(needle):
-            for k,i in idx.items():
-                if needle.lower() in k.lower(): return i
-        pi, ti = col("Продукт"), col("Тариф")
-        for r in table.find_elements(By.XPATH, ".//tbody/tr[td]"):
-            tds = r.find_elements(By.XPATH, "./td")
-            prod = (tds[pi].text.strip() if pi is not None and pi < len(tds) else "")
-            tarf = (tds[ti].text.strip() if ti is not None and ti < len(tds) else "")
-            if not prod or "итого" in (tarf or "").lower(): continue
-            out.append(ServiceRow(prod or "—", tarf or "—"))
-    except Exception as e:
-        log.warning("Не удалось распарсить таблицу услуг: %s", e)
-    return out
+    with METRICS.timed("table_services"):
+        try:
+            return list(table_rows(SERVICES_TABLE, _find_tables(driver, [SERVICES_TABLE])[0]))
+        except Exception as e:
+            log.warning("Не удалось распарсить таблицу услуг: %s", e)
+            return []
+
+# ── Поле после текста (PPPoE и т.п.) ──
+def _after_text_xpath(needle: str, tag: str) -> str:
+    return f".//*[contains(normalize-space(.), '{needle}')]/following::{tag}[1]"
 
-# ── PPPoE ──
-def _pppoe_read(panel) -> PppoeData:
-    p = PppoeData()
+def _control_after_text(panel, xp: str) -> Optional[str]:
+    """Значение первого input/select после текста; None — если такого поля нет."""
     try:
-        inp = panel.find_element(By.XPATH, ".//*[contains(normalize-space(.), 'Логин PPPoE')]/following::input[1]")
-        p.login = _clean(inp.get_attribute("value") or inp.text)
+        ctrl = panel.find_element(By.XPATH, xp)
     except Exception:
+        return None
+    if ctrl.tag_name.lower() == "select":
         try:
-            sel = panel.find_element(By.XPATH, ".//*[contains(normalize-space(.), 'Логин PPPoE')]/following::select[1]")
-            try:
-                p.login = _clean(Select(sel).first_selected_option.text)
-            except Exception:
-                p.login = _clean(sel.get_attribute("value") or sel.text)
+            return _clean(Select(ctrl).first_selected_option.text)
         except Exception:
             pass
-    try:
-        inp = panel.find_element(By.XPATH, ".//*[contains(normalize-space(.), 'Пароль PPPoE')]/following::input[1]")
-        p.password = _clean(inp.get_attribute("value") or inp.text)
-    except Exception:
-        pass
-    return p
+    return _clean(ctrl.get_attribute("value") or ctrl.text)
 
-# ── Основной сбор ──
-def collect_megafon(login: str, password: str) -> Collected:
-    driver = build_driver(HEADLESS)
-    try:
-        driver.get(LOGIN_URL)
-
-        login_input = _wait(driver).until(EC.presence_of_element_located(
-            (By.XPATH, "//label[contains(., 'Логин')]/following::input[1]")))
-        pass_input = _wait(driver).until(EC.presence_of_element_located(
-            (By.XPATH, "//label[contains(., 'Пароль')]/following::input[1]")))
-        login_input.clear(); login_input.send_keys(login)
-        pass_input.clear(); pass_input.send_keys(password)
-
-        _wait(driver).until(EC.element_to_be_clickable((By.XPATH, "//button[contains(., 'Войти')]"))).click()
-
-        time.sleep(HARD_WAIT_AFTER_LOGIN_SEC)
-        _wait(driver).until(EC.presence_of_element_located((By.XPATH, "//*[contains(., 'Детализация заявки')]")))
-
-        # —— Главная ——
-        main = MainPageData()
-        main.request_number = _main_field(driver, "Номер заявки")
-        main.account_number = _main_field(driver, "Лицевой счет")
-        main.address = _main_field(driver, "Адрес подключения")
-        main.temp_password = _main_field(driver, "Временный пароль")
-        # маски
-        m = re.search(r"\b(?:Req\d{6,}|\d{6,})\b", main.request_number or "")
-        if m: main.request_number = m.group(0)
-        m = re.search(r"\b\d{4,}\b", main.account_number or "")
-        if m: main.account_number = m.group(0)
-        if main.temp_password and main.temp_password != "—":
-            m = re.search(r"[A-Za-z0-9]{4,64}", main.temp_password)
-            if m: main.temp_password = m.group(0)
-
-        main.services = table_services(driver)
-
-        # —— Данные клиента ——
-        click_tab(driver, "Данные клиента")
-        _wait(driver).until(EC.presence_of_element_located((By.XPATH, "//*[contains(., 'Абонентский номер')]")))
-        panel = get_active_tab_panel(driver)
-
-        client = ClientData()
-        client.abonent_number = _value_in_panel(panel, "Абонентский номер")
-        client.contact_mobile = _value_in_panel(panel, "Контактный мобильный телефон")
-        client.client_mobile = _value_in_panel(panel, "Мобильный телефон клиента")
-        client.lastname = _value_in_panel(panel, "Фамилия")
-        client.firstname = _value_in_panel(panel, "Имя")
-        client.middlename = _value_in_panel(panel, "Отчество")
-
-        # —— PPPoE ——
-        click_tab(driver, "Настройки и активация услуг")
-        _wait(driver, 40).until(EC.presence_of_element_located((By.XPATH, "//*[contains(., 'Логин PPPoE')]")))
-        ppp_panel = get_active_tab_panel(driver)
-        p = _pppoe_read(ppp_panel)
-
-        return Collected(main=main, client=client, pppoe=p)
+# ── Снимок страницы: один RPC на вкладку, разбор офлайн ──
+# Синхронизируем текущие значения полей в атрибуты и забираем весь документ одним вызовом
+_SNAPSHOT_JS = """
+document.querySelectorAll('input').forEach(e => e.setAttribute('value', e.value));
+document.querySelectorAll('textarea').forEach(e => { e.textContent = e.value; });
+document.querySelectorAll('select').forEach(s => Array.from(s.options).forEach(
+    o => o.selected ? o.setAttribute('selected', '') : o.removeAttribute('selected')));
+return document.documentElement.outerHTML;
+"""
 
-    finally:
-        try:
-            driver.quit()
-        except Exception:
-            pass
+_CONTROLS = ("input", "textarea", "select")
 
-# ── Форматирование ──
-def format_collected(data: Collected) -> str:
-    services_lines = []
-    if data.main.services:
-        for i, s in enumerate(data.main.services, 1):
-            services_lines.append(f"{i}) Продукт — {s.product}; Тарифный план — {s.tariff}")
-    else:
-        services_lines.append("—")
-    text = (
-        "📌 <b>Детализация заявки</b>\n"
-        f"• Номер заявки: <b>{data.main.request_number}</b>\n"
-        f"• Лицевой счёт: <b>{data.main.account_number}</b>\n"
-        f"• Адрес подключения: <b>{data.main.address}</b>\n"
-        f"• Временный пароль: <b>{data.main.temp_password}</b>\n"
-        f"• Услуги:\n" + "\n".join(services_lines) + "\n\n"
-        "👤 <b>Данные клиента</b>\n"
-        f"• Абонентский номер: <b>{data.client.abonent_number}</b>\n"
-        f"• Контактный мобильный телефон: <b>{data.client.contact_mobile}</b>\n"
-        f"• Мобильный телефон клиента: <b>{data.client.client_mobile}</b>\n"
-        f"• Фамилия: <b>{data.client.lastname}</b>\n"
-        f"• Имя: <b>{data.client.firstname}</b>\n"
-        f"• Отчество: <b>{data.client.middlename}</b>\n\n"
-        "🌐 <b>PPPoE</b>\n"
-        f"• Логин PPPoE: <b>{data.pppoe.login}</b>\n"
-        f"• Пароль PPPoE: <b>{data.pppoe.password}</b>"
-    )
-    return text
+def _xml_space(s: str) -> str:
+    """normalize-space() из XPath: схлопывает только пробел/таб/переводы строк."""
+    return re.sub(r"[ \t\r\n]+", " ", s or "").strip(" \t\r\n")
 
-# ── Telegram ──
-def start(update: Update, context: CallbackContext) -> int:
-    user = update.effective_user
-    name = user.first_name or user.username or "друг"
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🟢 Мегафон", callback_data="op_megafon"),
-         InlineKeyboardButton("🔴 МТС", callback_data="op_mts")],
-        [InlineKeyboardButton("🆘 Помощь /help", callback_data="op_help")]
-    ])
-    (update.message or update.callback_query.message).reply_text(
-        f"Привет👋, {name}, какой оператор тебе нужен?",
-        reply_markup=kb
-    )
-    return OPERATOR
+def _yo(s: str) -> str:
+    return s.replace("Ё", "Е").replace("ё", "е")
 
-def help_cmd(update: Update, context: CallbackContext):
-    (update.message or update.callback_query.message).reply_text(
-        "Подсказки:\n"
-        "1️⃣ Нажмите на нужного оператора.\n"
-        "2️⃣ Введите логин и пароль, когда бот попросит.\n"
-        "3️⃣ Подождите ~10–15 секунд — бот соберёт данные и пришлёт ответ.\n"
-        "Команды: /start — начать заново, /cancel — отмена."
-    )
+def _classes(el) -> str:
+    c = el.get("class") or ""
+    return " ".join(c) if isinstance(c, list) else c
 
-def cancel(update: Update, context: CallbackContext) -> int:
-    (update.message or update.callback_query.message).reply_text("Ок, отменил. Наберите /start, чтобы начать заново.")
-    return ConversationHandler.END
+class PageSnapshot:
+    """
+    Разобранный снимок страницы. Повторяет семантику XPath-поиска из _main_field,
+    _value_in_panel, _control_after_text и table_services, но без обращений к WebDriver.
+    """
+    def __init__(self, html: str):
+        self.soup = BeautifulSoup(html, HTML_PARSER)
+        self._els = self.soup.find_all(True)
+        self._pos = {id(el): i for i, el in enumerate(self._els)}
+        self._end: Dict[int, int] = {}
+        self._by_tag: Dict[str, List[int]] = {}
+        for i, el in enumerate(self._els):
+            self._by_tag.setdefault(el.name, []).append(i)
 
-def operator_choice(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    query.answer()
-    data = query.data
-    if data == "op_help":
-        help_cmd(update, context)
-        return ConversationHandler.END
-    if data == "op_mts":
-        query.edit_message_text("Профиль МТС пока в разработке.")
-        return ConversationHandler.END
-    context.user_data["operator"] = "megafon"
-    query.edit_message_text("Введите логин для входа.")
-    return LOGIN
+    @classmethod
+    def capture(cls, driver) -> "PageSnapshot":
+        return cls(driver.execute_script(_SNAPSHOT_JS))
 
-def get_login(update: Update, context: CallbackContext) -> int:
-    context.user_data["login"] = update.message.text.strip()
-    update.message.reply_text("Теперь введите временный пароль.")
-    return PASS
+    def pos(self, el) -> int:
+        return self._pos[id(el)]
 
-def scrape_worker(chat_id: int, login: str, pwd: str, context: CallbackContext):
-    try:
-        context.bot.send_message(chat_id, "Принято. Захожу в систему… Подождите некоторое время... ⏳")
-        data = collect_megafon(login, pwd)
-        text = format_collected(data)
-        context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-    except Exception as e:
-        log.exception("Ошибка при сборе данных: %s", e)
-        context.bot.send_message(
-            chat_id,
-            "Не удалось собрать данные. Возможные причины: сайт недоступен или неверные логин/пароль. Попробуйте ещё раз (/start)."
-        )
+    def end(self, el) -> int:
+        """Позиция последнего потомка (для оси following::)."""
+        k = id(el)
+        if k not in self._end:
+            last = None
+            for last in el.find_all(True):
+                pass
+            self._end[k] = self.pos(last) if last is not None else self.pos(el)
+        return self._end[k]
+
+    def following(self, after: int, names):
+        """Первый элемент с тегом из names, начинающийся после позиции after."""
+        best = None
+        for n in names:
+            lst = self._by_tag.get(n, [])
+            i = bisect_right(lst, after)
+            if i < len(lst) and (best is None or lst[i] < best):
+                best = lst[i]
+        return self._els[best] if best is not None else None
+
+    def active_panel(self):
+        p = self.soup.find(lambda t: "tab-pane" in _classes(t) and "active" in _classes(t))
+        return p or self.soup.body or self.soup
+
+    # — значения элементов —
+    @staticmethod
+    def control_value(ctrl) -> str:
+        if ctrl.name == "select":
+            opts = ctrl.find_all("option")
+            if opts:
+                sel = next((o for o in opts if o.has_attr("selected")), opts[0])
+                return _clean(sel.get_text())
+        if ctrl.name == "textarea":
+            return _clean(ctrl.get_text())
+        return _clean(ctrl.get("value") or ctrl.get_text())
+
+    # — главная —
+    def main_field(self, label: str) -> str:
+        soup = self.soup
+        for tr in soup.find_all("tr"):
+            tds = tr.find_all("td", recursive=False)
+            if len(tds) > 1 and any(_xml_space(td.get_text()) == label for td in tds):
+                val = _clean(tds[1].get_text())
+                if val and val != "—":
+                    return _strip_label(label, val)
+                break
+        for td in soup.find_all("td"):
+            if _xml_space(td.get_text()) != label:
+                continue
+            sib = td.find_next_sibling("td")
+            if sib is not None:
+                val = _clean(sib.get_text())
+                if val and val != "—":
+                    return _strip_label(label, val)
+                break
+        for el in soup.find_all(["div", "span"]):
+            if _xml_space(el.get_text()) != label:
+                continue
+            sib = el.find_next_sibling()
+            if sib is not None:
+                val = _clean(sib.get_text())
+                if val and val != "—":
+                    return _strip_label(label, val)
+                break
+        for n in soup.find_all(string=lambda s: s and s.strip() == label):
+            p = n.find_parent()
+            if not p:
+                continue
+            sib = p.find_next_sibling()
+            if sib:
+                v = _clean(sib.get_text(" ", strip=True))
+                if v and v != "—":
+                    return _strip_label(label, v)
+        return "—"
+
+    # — вкладки —
+    def _closest_group(self, node, panel):
+        tr = node.find_parent("tr")
+        if tr is not None:
+            return tr
+        for needle in ("form-group", "row"):
+            g = node.find_parent(lambda t: needle in _classes(t))
+            if g is not None:
+                return g
+        return node.parent or panel
+
+    def _value_from_same_row(self, group, label_node) -> str:
+        tr = group if group.name == "tr" else label_node.find_parent("tr")
+        if tr is None:
+            return "—"
+        cells = tr.find_all(True, recursive=False)
+        label_idx = None
+        for i, c in enumerate(cells):
+            if c is label_node or any(p is c for p in label_node.parents):
+                label_idx = i
+                break
+        if label_idx is not None:
+            for c in cells[label_idx + 1:]:
+                txt = _clean(c.get_text())
+                if txt and txt != "—" and txt not in BAD_SINGLE_TOKENS:
+                    return txt
+        return "—"
+
+    def value_in_panel(self, panel, label: str) -> str:
+        if panel is None:
+            return "—"
+        norm = _yo(label)
+        lbl = next((el for el in panel.find_all(["label", "td", "th", "div", "span"])
+                    if _yo(_xml_space(el.get_text())).startswith(norm)), None)
+        if lbl is None:
+            return "—"
+
+        # 1) label[for]
+        for_attr = lbl.get("for")
+        if for_attr:
+            ctrl = panel.find(id=for_attr)
+            if ctrl is not None:
+                return self.control_value(ctrl)
+
+        group = self._closest_group(lbl, panel)
+
+        # 2) input/select/textarea рядом
+        nodes = [lbl] + list(lbl.descendants)
+        found = [s for s in (n.find_next_sibling(_CONTROLS) for n in nodes) if s is not None]
+        if not found:
+            found = [self.following(self.end(n), _CONTROLS) if n.name else n.find_next(_CONTROLS)
+                     for n in nodes]
+            found = [c for c in found if c is not None]
+        ctrl = min(found, key=self.pos) if found else lbl.find(_CONTROLS)
+        if ctrl is not None:
+            return self.control_value(ctrl)
+
+        # 3) Табличная строка
+        val = self._value_from_same_row(group, lbl)
+        if val != "—":
+            return val
+
+        # 4) Соседи текстового узла в пределах группы
+        nodes = group.find_all(string=lambda s: s and s.strip().lower().replace("ё", "е").startswith(norm.lower()))
+        for n in nodes:
+            sib = n.find_parent()
+            while sib:
+                sib = sib.find_next_sibling()
+                if not sib:
+                    break
+                v = _clean(sib.get_text(" ", strip=True))
+                if v and v != "—":
+                    return v
+        return "—"
+
+    def control_after_text(self, panel, needle: str, tag: str) -> Optional[str]:
+        hits = [el for el in panel.find_all(True) if needle in _xml_space(el.get_text())]
+        if not hits:
+            return None
+        ctrl = self.following(min(self.end(el) for el in hits), (tag,))
+        return self.control_value(ctrl) if ctrl is not None else None
+
+    def _text_element(self, texts: List[str]):
+        """Элемент первого текстового узла, где есть одна из строк (как findText в _TABLES_JS)."""
+        node = self.soup.find(string=lambda t: any(x in _WS_RE.sub(" ", t).lower() for x in texts))
+        return node.parent if node is not None else None
+
+    def table(self, spec: "TableSpec") -> Optional[dict]:
+        """То же, что _TABLES_JS для одной TableSpec, по снимку: {headers, rows} или None."""
+        js = spec.js_spec()
+        if js["after"]:
+            anchor = self._text_element(js["after"])
+            if anchor is None:
+                return None
+            tables = anchor.find_all_next("table")
+        else:
+            tables = self.soup.find_all("table")
+        for t in tables:
+            headers = [th.get_text(" ", strip=True) for th in t.find_all("th")]
+            hs = [h.lower() for h in headers]
+            if not all(any(n in h for h in hs) for n in js["needles"]):
+                continue
+            if any(any(n in h for h in hs) for n in js["exclude"]):
+                continue
+            rows = []
+            for r in t.find_all("tr"):
+                if r.parent.name != "tbody" or r.find_parent("table") is not t:
+                    continue
+                tds = r.find_all("td", recursive=False)
+                if tds:
+                    rows.append([td.get_text(" ", strip=True) for td in tds])
+            return {"headers": headers, "rows": rows}
+        return None
+
+    def tables(self, specs) -> Dict[str, tuple]:
+        return {t.name: table_rows(t, self.table(t)) for t in specs if HISTORY_TABLES or not t.toggle}
+
+# ── Профили операторов: декларативное описание полей ──
+_HIDDEN_STYLE = re.compile(r"display\s*:\s*none|visibility\s*:\s*hidden", re.I)
+
+@dataclass(frozen=True)
+class FieldSpec:
+    attr: str                              # поле модели
+    label: str                             # подпись на странице
+    strategies: Tuple[str, ...] = ("row",) # порядок способов поиска, см. _LIVE_STRATEGIES
+    mask: Optional[str] = None             # регулярка: если нашлась — берём только совпадение
+    required: bool = False                 # «—» в этом поле = HTTP-сбор не справился, нужен браузер
+
+@dataclass(frozen=True)
+class TableSpec:
+    name: str                              # поле модели секции (кортеж строк)
+    title: str                             # подпись в ответе и в выгрузке /batch
+    row: type                              # модель строки
+    columns: Tuple[Tuple[str, str], ...]   # (поле строки, подстрока заголовка колонки)
+    key: str                               # строка без этого значения пропускается
+    fmt: str                               # строка в ответе: str.format по полям строки
+    toggle: Optional[str] = None           # ссылка/кнопка, которая раскрывает таблицу
+    after: Tuple[str, ...] = ()            # искать таблицу только после элемента с таким текстом
+    exclude: Tuple[str, ...] = ()          # заголовки, которых в таблице быть не должно
+    skip: Tuple[str, ...] = ("итого",)     # служебные строки
+    limit: int = 0                         # 0 = все строки
+
+    def js_spec(self) -> dict:
+        return {
+            "needles": [needle.lower() for _, needle in self.columns],
+            "exclude": [x.lower() for x in self.exclude],
+            "after": [x.lower() for x in self.after],
+        }
+
+    def lines(self, rows) -> List[str]:
+        return [self.fmt.format_map({a: getattr(r, a) for a, _ in self.columns}) for r in rows]
+
+SERVICES_TABLE = TableSpec(
+    "services", "Услуги", ServiceRow,
+    columns=(("product", "Продукт"), ("tariff", "Тариф")),
+    key="product", fmt="Продукт — {product}; Тарифный план — {tariff}",
+    exclude=("Дата отключ",),
+)
+# Обе таблицы раскрываются ссылками под таблицей услуг; после клика текст ссылки
+# меняется на «Скрыть удаленные подключения», поэтому after ищет по любому из двух.
+REMOVED_TABLE = TableSpec(
+    "removed", "Удалённые подключения", RemovedConnection,
+    columns=(("product", "Продукт"), ("tariff", "Тариф"), ("closed", "Дата отключ")),
+    key="product", fmt="{product}; {tariff}; отключено {closed}",
+    toggle="Показать удаленные подключения",
+    after=("Показать удаленные подключения", "Скрыть удаленные подключения"),
+)
+HISTORY_TABLE = TableSpec(
+    "history", "Последние заявки", RequestRow,
+    columns=(("number", "Номер"), ("date", "Дата"), ("kind", "Тип"), ("status", "Статус")),
+    key="number", fmt="{number} от {date} — {kind}, {status}",
+    toggle="Последние заявки клиента", after=("Последние заявки клиента",), limit=10,
+)
+
+@dataclass(frozen=True)
+class SectionSpec:
+    name: str                              # атрибут Collected
+    model: type
+    fields: Tuple[FieldSpec, ...]
+    tab: Optional[str] = None              # None = главная страница
+    marker: Optional[str] = None           # XPath готовности вкладки
+    timeout: int = SELENIUM_TIMEOUT
+    tables: Tuple[TableSpec, ...] = ()     # таблицы секции, см. extract_tables
+
+@dataclass(frozen=True)
+class OperatorProfile:
+    key: str
+    title: str
+    login_url: str
+    login_xp: str
+    password_xp: str
+    submit_xp: str
+    ready_marker: str
+    sections: Tuple[SectionSpec, ...]
+    # подсказки для HTTP-сбора (без браузера)
+    login_label: str = "Логин"
+    password_label: str = "Пароль"
+    ready_text: str = "Детализация заявки"
+    # сообщения портала об отказе во входе: появились — неверные логин/пароль, повторять нельзя
+    bad_login_texts: Tuple[str, ...] = ("Неверный логин", "Неверный пароль", "Неверное имя пользователя",
+                                        "Неправильный логин", "Неправильный пароль", "Неверные учетные данные")
+
+    @property
+    def bad_login_xp(self) -> str:
+        cond = " or ".join(f"contains(text(), '{t}')" for t in self.bad_login_texts)
+        return f"//*[not(self::script)][{cond}]"
+
+    def is_bad_login(self, html: str) -> bool:
+        """Есть ли сообщение об отказе среди показанного текста: скрытые шаблоны не считаются."""
+        soup = BeautifulSoup(html, HTML_PARSER)
+        for e in soup.find_all(["script", "style", "template", "noscript"]):
+            e.decompose()
+        for e in soup.find_all(lambda t: t.has_attr("hidden") or _HIDDEN_STYLE.search(t.get("style", ""))):
+            e.decompose()
+        text = soup.get_text(" ").lower()
+        return any(t.lower() in text for t in self.bad_login_texts)
+
+MEGAFON_PROFILE = OperatorProfile(
+    key="megafon",
+    title="Мегафон",
+    login_url=LOGIN_URL,
+    login_xp="//label[contains(., 'Логин')]/following::input[1]",
+    password_xp="//label[contains(., 'Пароль')]/following::input[1]",
+    submit_xp="//button[contains(., 'Войти')]",
+    ready_marker="//*[contains(., 'Детализация заявки')]",
+    sections=(
+        SectionSpec("main", MainPageData, tables=(SERVICES_TABLE, REMOVED_TABLE, HISTORY_TABLE), fields=(
+            FieldSpec("request_number", "Номер заявки", mask=r"\b(?:Req\d{6,}|\d{6,})\b", required=True),
+            FieldSpec("account_number", "Лицевой счет", mask=r"\b\d{4,}\b", required=True),
+            FieldSpec("address", "Адрес подключения"),
+            FieldSpec("temp_password", "Временный пароль", mask=r"[A-Za-z0-9]{4,64}"),
+        )),
+        SectionSpec("client", ClientData, tab="Данные клиента",
+                    marker="//*[contains(., 'Абонентский номер')]", fields=(
+            FieldSpec("abonent_number", "Абонентский номер", ("panel",)),
+            FieldSpec("contact_mobile", "Контактный мобильный телефон", ("panel",)),
+            FieldSpec("client_mobile", "Мобильный телефон клиента", ("panel",)),
+            FieldSpec("lastname", "Фамилия", ("panel",)),
+            FieldSpec("firstname", "Имя", ("panel",)),
+            FieldSpec("middlename", "Отчество", ("panel",)),
+        )),
+        SectionSpec("pppoe", PppoeData, tab="Настройки и активация услуг",
+                    marker="//*[contains(., 'Логин PPPoE')]", timeout=40, fields=(
+            FieldSpec("login", "Логин PPPoE", ("input_after", "select_after"), required=True),
+            FieldSpec("password", "Пароль PPPoE", ("input_after",)),
+        )),
+    ),
+)
+
+class CompiledField:
+    """FieldSpec с заранее собранными XPath и скомпилированной маской."""
+    __slots__ = ("attr", "label", "strategies", "mask", "required", "xpaths")
+
+    def __init__(self, spec: FieldSpec):
+        self.attr = spec.attr
+        self.label = spec.label
+        self.required = spec.required
+        self.strategies = spec.strategies
+        self.mask = re.compile(spec.mask) if spec.mask else None
+        self.xpaths = {}
+        for st in spec.strategies:
+            if st not in _LIVE_STRATEGIES:
+                raise ValueError(f"Неизвестная стратегия поиска поля {spec.attr}: {st}")
+            if st == "row":
+                self.xpaths[st] = _main_field_xpaths(spec.label)
+            elif st == "panel":
+                self.xpaths[st] = _panel_label_xpath(spec.label)
+            else:
+                self.xpaths[st] = _after_text_xpath(spec.label, st.split("_")[0])
+
+    def finish(self, value: str) -> str:
+        if self.mask and value and value != "—":
+            m = self.mask.search(value)
+            if m:
+                return m.group(0)
+        return value
+
+class CompiledProfile:
+    def __init__(self, p: OperatorProfile):
+        self.spec = p
+        self.key, self.title = p.key, p.title
+        self.sections = [(sec, [CompiledField(f) for f in sec.fields]) for sec in p.sections]
+
+# Стратегии поиска: (источник, поле) → значение или None, если элемент не найден.
+# Источник: драйвер/панель для live, (снимок, панель) для snapshot.
+_LIVE_STRATEGIES: Dict[str, Callable] = {
+    "row": lambda src, f: _main_field(src, f.label, f.xpaths["row"]),
+    "panel": lambda src, f: _value_in_panel(src, f.label, f.xpaths["panel"]),
+    "input_after": lambda src, f: _control_after_text(src, f.xpaths["input_after"]),
+    "select_after": lambda src, f: _control_after_text(src, f.xpaths["select_after"]),
+}
+_SNAPSHOT_STRATEGIES: Dict[str, Callable] = {
+    "row": lambda src, f: src[0].main_field(f.label),
+    "panel": lambda src, f: src[0].value_in_panel(src[1], f.label),
+    "input_after": lambda src, f: src[0].control_after_text(src[1], f.label, "input"),
+    "select_after": lambda src, f: src[0].control_after_text(src[1], f.label, "select"),
+}
+
+PROFILES: Dict[str, CompiledProfile] = {p.key: CompiledProfile(p) for p in (MEGAFON_PROFILE,)}
+
+# ── Доступность портала: ошибки, повторы, автомат ──
+class BadCredentials(Exception):
+    """Портал отказал во входе: логин/пароль неверные, повторять бессмысленно."""
+
+class PortalError(Exception):
+    """Портал не ответил или ответил ошибкой — сбор не удался не по вине пользователя."""
+
+class PortalUnavailable(PortalError):
+    """Автомат разомкнут: портал недавно падал, сбор даже не запускаем."""
+    def __init__(self, retry_in: float):
+        super().__init__(f"портал недоступен, следующая проверка через {retry_in:.0f} с")
+        self.retry_in = retry_in
+
+# Временные сбои: их есть смысл повторить (стадия целиком, с паузой)
+_TRANSIENT = (TimeoutException, StaleElementReferenceException, requests.Timeout)
+
+def portal_fault(e: BaseException) -> bool:
+    """Сбой на стороне портала (или сети до него) — считается автоматом; ошибки разбора и пула — нет."""
+    if isinstance(e, (BadCredentials, PortalUnavailable)):
+        return False
+    if isinstance(e, WebDriverException) and not isinstance(e, TimeoutException):
+        return "net::ERR_" in str(e)      # сеть до портала; прочее (упал Chrome и т.п.) — не портал
+    return isinstance(e, (PortalError, TimeoutException, requests.RequestException))
+
+def with_retries(stage: str, fn, *args, **kwargs):
+    """
+    Стадия сбора с повторами только при временных сбоях (_TRANSIENT): до PORTAL_RETRIES раз,
+    пауза PORTAL_RETRY_BASE·2^n со случайным разбросом (full jitter) — чтобы воркеры
+    не били в портал одновременно. Неверный логин/пароль и прочие ошибки — сразу наверх.
+    """
+    for attempt in range(PORTAL_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except _TRANSIENT as e:
+            if attempt >= PORTAL_RETRIES:
+                raise
+            delay = random.uniform(0, PORTAL_RETRY_BASE * 2 ** attempt)
+            METRICS.inc("portal_retries")
+            log.info("Стадия [%s]: временный сбой (%s), повтор %d через %.1f с",
+                     stage, type(e).__name__, attempt + 1, delay)
+            time.sleep(delay)
+
+class CircuitBreaker:
+    """
+    Автомат на портал: после BREAKER_FAILURES сбоев подряд размыкается, и сборы сразу
+    получают PortalUnavailable, не занимая браузер. Через BREAKER_COOLDOWN один запрос
+    проверяет портал лёгким GET; ответил — автомат замыкается, нет — пауза удваивается
+    (до 10 × BREAKER_COOLDOWN).
+    """
+    def __init__(self, url: str, threshold: int, cooldown: int, probe_timeout: int):
+        self.url = url
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.failures = 0
+        self._opened_at = 0.0
+        self._pause = cooldown
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return "open" if self._opened_at else "closed"
+
+    def retry_in(self) -> float:
+        with self._lock:
+            return max(0.0, self._opened_at + self._pause - time.monotonic()) if self._opened_at else 0.0
+
+    def before(self):
+        """Перед сбором: PortalUnavailable, если автомат разомкнут и портал ещё не ожил."""
+        if not self.threshold:
+            return
+        with self._lock:
+            if not self._opened_at:
+                return
+            left = self._opened_at + self._pause - time.monotonic()
+            if left > 0 or self._probing:
+                raise PortalUnavailable(max(left, 1.0))
+            self._probing = True
+        ok = False
+        try:
+            ok = self.probe()
+        finally:
+            with self._lock:
+                self._probing = False
+                if ok:
+                    log.info("Портал снова отвечает — автомат замкнут")
+                    self._opened_at, self.failures, self._pause = 0.0, 0, self.cooldown
+                else:
+                    self._opened_at = time.monotonic()
+                    self._pause = min(self._pause * 2, self.cooldown * 10)
+        if not ok:
+            raise PortalUnavailable(self.retry_in())
+
+    def probe(self) -> bool:
+        try:
+            with requests.get(self.url, timeout=self.probe_timeout, stream=True) as r:
+                return r.status_code < 500
+        except requests.RequestException as e:
+            log.info("Проверка портала: %s", e)
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+
+    def failure(self, e: BaseException):
+        with self._lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold and not self._opened_at:
+                self._opened_at = time.monotonic()
+                METRICS.inc("breaker_open")
+                log.warning("Портал: %d сбоя(ев) подряд (%s) — не хожу на него %d с",
+                            self.failures, e, self._pause)
+
+BREAKERS: Dict[str, CircuitBreaker] = {
+    key: CircuitBreaker(p.spec.login_url, BREAKER_FAILURES, BREAKER_COOLDOWN, BREAKER_PROBE_TIMEOUT)
+    for key, p in PROFILES.items()
+}
+
+def failure_text(e: BaseException, retry: str = "/start") -> str:
+    """Что сказать пользователю, когда сбор не удался."""
+    if isinstance(e, BadCredentials):
+        return f"Портал не принял логин или пароль. Проверьте их и попробуйте ещё раз ({retry})."
+    if isinstance(e, PortalUnavailable):
+        return (f"Портал сейчас недоступен — запрос не отправлял. "
+                f"Попробуйте через {max(1, math.ceil(e.retry_in / 60))} мин ({retry}).")
+    if portal_fault(e):
+        return f"Портал не отвечает или отвечает с ошибкой. Попробуйте позже ({retry})."
+    return f"Не удалось собрать данные. Попробуйте ещё раз ({retry})."
+
+def error_kind(e: BaseException) -> str:
+    """Вид ошибки для передачи между процессами: bad_credentials | unavailable | portal | other."""
+    if isinstance(e, BadCredentials):
+        return "bad_credentials"
+    if isinstance(e, PortalUnavailable):
+        return "unavailable"
+    return "portal" if portal_fault(e) else "other"
+
+def error_from_kind(kind: str, text: str, retry_in: float = 0.0) -> Exception:
+    """Обратное к error_kind: исключение того же типа в процессе, который ждал результат."""
+    if kind == "unavailable":
+        return PortalUnavailable(retry_in)
+    return {"bad_credentials": BadCredentials, "portal": PortalError}.get(kind, RuntimeError)(text)
+
+def failure_reason(e: BaseException) -> str:
+    """Короткая причина для статуса и таблицы /batch; пусто — прочая ошибка."""
+    if isinstance(e, BadCredentials):
+        return "неверный логин/пароль"
+    if isinstance(e, PortalUnavailable):
+        return "портал недоступен"
+    if portal_fault(e):
+        return "портал не ответил"
+    return ""
+
+# ── Кэш сессий портала ──
+@dataclass
+class _Session:
+    pwd_mac: bytes
+    cookies: list
+    url: str
+    created: float
+
+class SessionCache:
+    """
+    LRU-кэш авторизованных сессий: cookies и адрес страницы заявки по (оператор, логин).
+    Пароль не хранится — только HMAC с ключом, который живёт в памяти процесса.
+    """
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._key = os.urandom(32)
+        self._items: "OrderedDict[Tuple[str, str], _Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _mac(self, password: str) -> bytes:
+        return hmac.new(self._key, password.encode("utf-8"), hashlib.sha256).digest()
+
+    def get(self, operator: str, login: str, password: str) -> Optional[_Session]:
+        if not self.ttl:
+            return None
+        with self._lock:
+            s = self._items.get((operator, login))
+            if s and (time.monotonic() - s.created > self.ttl or not hmac.compare_digest(s.pwd_mac, self._mac(password))):
+                del self._items[(operator, login)]
+                s = None
+            if s:
+                self._items.move_to_end((operator, login))
+                self.hits += 1
+            else:
+                self.misses += 1
+            log.info("Кэш сессий: %s (hit=%d miss=%d)", "hit" if s else "miss", self.hits, self.misses)
+            return s
+
+    def put(self, operator: str, login: str, password: str, cookies: list, url: str):
+        if not self.ttl:
+            return
+        with self._lock:
+            self._items[(operator, login)] = _Session(self._mac(password), cookies, url, time.monotonic())
+            self._items.move_to_end((operator, login))
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def drop(self, operator: str, login: str):
+        with self._lock:
+            self._items.pop((operator, login), None)
+
+SESSIONS = SessionCache(SESSION_TTL_SEC, SESSION_CACHE_MAX)
+
+def _resume_session(driver, profile: "CompiledProfile", login: str, password: str) -> bool:
+    """Подставляет cookies сохранённой сессии и открывает страницу заявки без формы входа."""
+    s = SESSIONS.get(profile.key, login, password)
+    if not s:
+        return False
+    try:
+        driver.execute_cdp_cmd("Network.setCookies", {"cookies": s.cookies})
+        driver.get(s.url)
+        wait_ready(driver, "session", profile.spec.ready_marker, timeout=SESSION_CHECK_TIMEOUT)
+        return True
+    except Exception as e:
+        log.info("Сессия устарела, вхожу заново: %s", e)
+        SESSIONS.drop(profile.key, login)
+        return False
+
+# ── Основной сбор ──
+def extract_section(driver, sec: SectionSpec, fields: List[CompiledField]):
+    """Один общий движок: прогоняет поля секции по стратегиям и собирает модель."""
+    tables = {}
+    if sec.tables:
+        # таблицы (и раскрытие скрытых) — до снимка, чтобы раскрытые попали в него же
+        try:
+            tables = extract_tables(driver, sec.tables)
+        except Exception as e:
+            log.warning("Не удалось разобрать таблицы секции [%s]: %s", sec.name, e)
+    if EXTRACT_MODE == "snapshot":
+        snap = PageSnapshot.capture(driver)
+        values = _run_fields((snap, snap.active_panel() if sec.tab else None), _SNAPSHOT_STRATEGIES, fields)
+    else:
+        src = get_active_tab_panel(driver) if sec.tab else driver
+        values = _run_fields(src, _LIVE_STRATEGIES, fields)
+    return sec.model(**values, **tables)
+
+def extract_snapshot(snap: PageSnapshot, panel, sec: SectionSpec, fields: List[CompiledField]):
+    values = _run_fields((snap, panel), _SNAPSHOT_STRATEGIES, fields)
+    return sec.model(**values, **snap.tables(sec.tables))
+
+def _run_fields(src, strategies: Dict[str, Callable], fields: List[CompiledField]) -> dict:
+    values = {}
+    for f in fields:
+        val = "—"
+        for st in f.strategies:
+            v = strategies[st](src, f)
+            if v is not None:
+                val = v
+                break
+        else:
+            if log_sampled():
+                log.debug("Поле «%s» не найдено (%s)", f.label, ", ".join(f.strategies))
+        values[f.attr] = f.finish(val)
+    return values
+
+# ── Сбор без браузера (requests) ──
+# Один пул соединений на все сборы; cookies у каждого сбора свои (отдельная Session)
+_HTTP_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=max(4, SCRAPE_WORKERS * 2))
+
+def _http_session() -> requests.Session:
+    s = requests.Session()
+    s.mount("https://", _HTTP_ADAPTER)
+    s.mount("http://", _HTTP_ADAPTER)
+    s.headers["User-Agent"] = (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+    )
+    s.headers["Accept-Language"] = "ru-RU,ru;q=0.9"
+    return s
+
+def _http_login_form(snap: PageSnapshot, p: OperatorProfile, login: str, password: str):
+    """Метод, адрес и поля формы входа: те же «label → следующий input», что и в браузере."""
+    def input_after(label_text):
+        lbl = next((l for l in snap.soup.find_all("label") if label_text in l.get_text()), None)
+        return snap.following(snap.end(lbl), ("input",)) if lbl is not None else None
+
+    login_inp, pass_inp = input_after(p.login_label), input_after(p.password_label)
+    if login_inp is None or pass_inp is None or not login_inp.get("name") or not pass_inp.get("name"):
+        return None
+    form = pass_inp.find_parent("form")
+    if form is None:
+        return None
+    data = {}
+    for inp in form.find_all("input"):
+        name = inp.get("name")
+        if name and inp.get("type", "text").lower() not in ("submit", "button", "checkbox", "radio"):
+            data[name] = inp.get("value", "")
+    data[login_inp["name"]] = login
+    data[pass_inp["name"]] = password
+    return (form.get("method") or "post").lower(), form.get("action") or "", data
+
+def _http_tab_panel(sess: requests.Session, base_url: str, snap: PageSnapshot, title: str):
+    """Панель вкладки: из той же страницы (href="#id"/data-target) или по ссылке вкладки."""
+    link = next((a for a in snap.soup.find_all(["a", "button"]) if title in _xml_space(a.get_text())), None)
+    if link is None:
+        return None, None
+    ref = link.get("data-target") or link.get("data-bs-target") or link.get("href") or ""
+    if ref.startswith("#") and len(ref) > 1:
+        return snap, snap.soup.find(id=ref[1:])
+    if not ref or ref.startswith("javascript:"):
+        return None, None
+    r = sess.get(urljoin(base_url, ref), timeout=HTTP_TIMEOUT)
+    r.raise_for_status()
+    tab = PageSnapshot(r.text)
+    return tab, tab.active_panel()
+
+_SECRET_FIELDS = ("temp_password", "password")     # значения маскируются в логе и снимках страниц
+
+def _note_model(name: str, model):
+    """Пароли из модели — в маску лога запроса; сама модель — в отладку выборочных запросов."""
+    mask_secret(*(getattr(model, a, "") for a in _SECRET_FIELDS))
+    if log_sampled():
+        log.debug("Секция [%s]: %r", name, model)
+
+def collect_http(profile: CompiledProfile, login: str, password: str,
+                 on_section: Optional[Callable[[str, object], None]] = None) -> Optional[Collected]:
+    """
+    Лёгкий сбор: форма входа и страницы заявки через requests, разбор тем же PageSnapshot.
+    None — если портал требует браузер (JS-форма, вкладки без адресов) или обязательное поле пустое.
+    """
+    p = profile.spec
+    t0 = time.monotonic()
+    try:
+        with _http_session() as sess:
+            r = sess.get(p.login_url, timeout=HTTP_TIMEOUT)
+            r.raise_for_status()
+            form = _http_login_form(PageSnapshot(r.text), p, login, password)
+            if form is None:
+                log.info("HTTP-сбор: форма входа не найдена в HTML")
+                return None
+            method, action, data = form
+            url = urljoin(r.url, action)
+            if method == "get":
+                r = sess.get(url, params=data, timeout=HTTP_TIMEOUT)
+            else:
+                r = sess.post(url, data=data, timeout=HTTP_TIMEOUT)
+            r.raise_for_status()
+            if p.ready_text not in r.text:
+                if p.is_bad_login(r.text):
+                    raise BadCredentials("HTTP-сбор: портал отказал во входе")
+                log.info("HTTP-сбор: после входа нет «%s»", p.ready_text)
+                return None
+            page = PageSnapshot(r.text)
+            parts = {}
+            for sec, fields in profile.sections:
+                snap, panel = (page, None)
+                if sec.tab:
+                    snap, panel = _http_tab_panel(sess, r.url, page, sec.tab)
+                    if panel is None:
+                        log.info("HTTP-сбор: вкладка «%s» недоступна без браузера", sec.tab)
+                        return None
+                model = extract_snapshot(snap, panel, sec, fields)
+                _note_model(sec.name, model)
+                missing = [f.attr for f in fields if f.required and getattr(model, f.attr) == "—"]
+                if missing:
+                    log.info("HTTP-сбор: пустые обязательные поля %s", missing)
+                    return None
+                parts[sec.name] = model
+                if on_section:
+                    on_section(sec.name, model)
+        log.info("HTTP-сбор: готово за %.2f с", time.monotonic() - t0)
+        return Collected(**parts)
+    except BadCredentials:
+        raise
+    except Exception as e:
+        log.warning("HTTP-сбор не удался: %s", e)
+        return None
+
+def _login(driver, p: OperatorProfile, login: str, password: str):
+    driver.get(p.login_url)
+
+    login_input = _wait(driver).until(EC.presence_of_element_located((By.XPATH, p.login_xp)))
+    pass_input = _wait(driver).until(EC.presence_of_element_located((By.XPATH, p.password_xp)))
+    _record_fixture(driver, "login")
+    login_input.clear(); login_input.send_keys(login)
+    pass_input.clear(); pass_input.send_keys(password)
+
+    driver.execute_script(_MARK_FAIL_JS, p.bad_login_xp)
+    with METRICS.timed("login_submit"):
+        _wait(driver).until(EC.element_to_be_clickable((By.XPATH, p.submit_xp))).click()
+
+    try:
+        wait_ready(driver, "login", p.ready_marker, sleep_before=HARD_WAIT_AFTER_LOGIN_SEC, fail_marker=p.bad_login_xp)
+    except TimeoutException:
+        _dump_failure(driver, "login")
+        raise
+    _record_fixture(driver, "detail")
+
+def _timed_extract(driver, sec: SectionSpec, fields: List[CompiledField], on_section=None):
+    t0 = time.monotonic()
+    data = extract_section(driver, sec, fields)
+    dt = time.monotonic() - t0
+    _note_model(sec.name, data)
+    METRICS.observe(f"extract:{sec.name}", dt)
+    log.info("Секция [%s]: разбор %.2f с", sec.name, dt)
+    missing = [f.label for f in fields if f.required and getattr(data, f.attr) == "—"]
+    if missing:
+        log.warning("Секция [%s]: не найдены обязательные поля %s", sec.name, missing)
+        _dump_failure(driver, sec.name)
+    if on_section:
+        on_section(sec.name, data)
+    return data
+
+def _section(driver, sec: SectionSpec, fields: List[CompiledField], on_section=None):
+    try:
+        if sec.tab:
+            t0 = time.monotonic()
+            click_tab(driver, sec.tab, sec.marker, timeout=sec.timeout)
+            METRICS.observe(f"tab:{sec.name}", time.monotonic() - t0)
+            log.info("Вкладка [%s]: переход %.2f с", sec.tab, time.monotonic() - t0)
+            _record_fixture(driver, f"tab_{sec.name}")
+        return _timed_extract(driver, sec, fields, on_section)
+    except Exception:
+        _dump_failure(driver, sec.name)
+        raise
+
+def _collect_sequential(driver, profile: CompiledProfile, on_section=None) -> Collected:
+    parts = {}
+    for sec, fields in profile.sections:
+        parts[sec.name] = with_retries(sec.name, _section, driver, sec, fields, on_section)
+    return Collected(**parts)
+
+def _collect_parallel(driver, profile: CompiledProfile, on_section=None) -> Collected:
+    """
+    Каждая вкладка — в своём окне той же сессии: окна открываются сразу, пока разбирается
+    главная; клики по вкладкам идут подряд, и порталу не приходится ждать друг друга.
+    """
+    main_handle = driver.current_window_handle
+    url = driver.current_url
+    opened = []
+    try:
+        for sec, fields in profile.sections:
+            if not sec.tab:
+                continue
+            before = set(driver.window_handles)
+            driver.execute_script("window.open(arguments[0], '_blank');", url)
+            handle = next(h for h in driver.window_handles if h not in before)
+            if BLOCK_URLS:
+                driver.switch_to.window(handle)
+                _apply_blocking(driver)
+            opened.append((handle, sec, fields, time.monotonic()))
+        driver.switch_to.window(main_handle)
+
+        parts = {}
+        for sec, fields in profile.sections:
+            if not sec.tab:
+                parts[sec.name] = _timed_extract(driver, sec, fields, on_section)
+        for handle, sec, _, _ in opened:
+            driver.switch_to.window(handle)
+            wait_ready(driver, f"окно:{sec.tab}", profile.spec.ready_marker)
+            _click_tab_button(driver, sec.tab)
+        for handle, sec, fields, t0 in opened:
+            driver.switch_to.window(handle)
+            wait_ready(driver, sec.tab, sec.marker, sec.timeout)
+            _wait(driver).until(lambda d: get_active_tab_panel(d))
+            METRICS.observe(f"tab:{sec.name}", time.monotonic() - t0)
+            log.info("Вкладка [%s]: готова через %.2f с после открытия окна", sec.tab, time.monotonic() - t0)
+            _record_fixture(driver, f"tab_{sec.name}")
+            parts[sec.name] = _timed_extract(driver, sec, fields, on_section)
+        return Collected(**parts)
+    finally:
+        for handle, *_ in opened:
+            try:
+                driver.switch_to.window(handle)
+                driver.close()
+            except Exception:
+                pass
+        driver.switch_to.window(main_handle)
+
+def collect(profile: CompiledProfile, login: str, password: str,
+            on_section: Optional[Callable[[str, object], None]] = None) -> Collected:
+    """
+    on_section(name, model) вызывается сразу после разбора каждой секции (main, client, pppoe…),
+    не дожидаясь остальных. При повторном сборе (откат с HTTP или с параллельных окон)
+    секция может прийти ещё раз — получатель просто перерисовывает её.
+    Пока автомат портала разомкнут — сразу PortalUnavailable; неверные логин/пароль — BadCredentials.
+    """
+    breaker = BREAKERS[profile.key]
+    breaker.before()
+    try:
+        with METRICS.timed("collect"):
+            if REMOTE is not None:
+                data = REMOTE.run(profile.key, login, password, on_section)
+            elif SCRAPE_ISOLATION == "process" and not _IN_WORKER:
+                data = WORKER_PROCS.run(profile.key, login, password, on_section)
+            else:
+                data = _collect(profile, login, password, on_section)
+    except BadCredentials:
+        METRICS.inc("bad_credentials")
+        breaker.success()          # портал ответил, просто отказал
+        raise
+    except Exception as e:
+        if portal_fault(e):
+            breaker.failure(e)
+        raise
+    breaker.success()
+    return data
+
+def _collect(profile: CompiledProfile, login: str, password: str, on_section=None) -> Collected:
+    if COLLECTOR == "http":
+        with METRICS.timed("collect_http"):
+            data = collect_http(profile, login, password, on_section)
+        if data is not None:
+            METRICS.inc("http_ok")
+            return data
+        METRICS.inc("http_fallback")
+        log.info("HTTP-сбор не справился, переключаюсь на браузер")
+    p = profile.spec
+    with DRIVER_POOL.lease() as driver:
+        if _resume_session(driver, profile, login, password):
+            METRICS.inc("session_resumed")
+        else:
+            with METRICS.timed("login"):
+                with_retries("login", _login, driver, p, login, password)
+            if SESSIONS.ttl:
+                try:
+                    cookies = driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+                    SESSIONS.put(profile.key, login, password, cookies, driver.current_url)
+                except Exception as e:
+                    log.warning("Не удалось сохранить сессию: %s", e)
+
+        t0 = time.monotonic()
+        data, mode = None, "по очереди"
+        if PARALLEL_TABS and sum(1 for sec, _ in profile.sections if sec.tab) > 1:
+            try:
+                data, mode = _collect_parallel(driver, profile, on_section), "параллельно"
+            except Exception as e:
+                log.warning("Параллельный сбор вкладок не удался, собираю по очереди: %s", e)
+        if data is None:
+            data = _collect_sequential(driver, profile, on_section)
+        METRICS.observe("sections", time.monotonic() - t0)
+        log.info("Секции собраны за %.2f с (%s)", time.monotonic() - t0, mode)
+        return data
+
+def collect_megafon(login: str, password: str, on_section=None) -> Collected:
+    return collect(PROFILES["megafon"], login, password, on_section)
+
+# ── Процессы-воркеры (SCRAPE_ISOLATION=process) ──
+_IN_WORKER = False
+
+def _worker_main(conn, index: int, log_queue=None):
+    """
+    Тело процесса-воркера: своя группа процессов (её целиком убивают при зависании),
+    свой пул из одного браузера. Задачи и ответы — через Pipe: ("section", имя, модель)
+    по мере сбора, затем ("done", Collected.to_bytes(), метрики) или ("error", текст, метрики, вид, retry_in),
+    где вид — error_kind(): по нему основной процесс восстанавливает тип ошибки.
+    """
+    global DRIVER_POOL, METRICS, _IN_WORKER
+    try:
+        os.setsid()
+    except (AttributeError, OSError):
+        pass
+    if log_queue is not None:
+        _log_to_parent(log_queue)
+    _IN_WORKER = True
+    DRIVER_POOL = DriverPool(1, DRIVER_MAX_USES, DRIVER_MAX_AGE_SEC)
+    log.info("Воркер-процесс %d запущен (pid %d)", index, os.getpid())
+    if DRIVER_WARMUP:
+        DRIVER_POOL.warm_up()
+    try:
+        while True:
+            try:
+                task = conn.recv()
+            except EOFError:
+                break
+            if task is None:
+                break
+            operator, login, password, rid = task
+            METRICS = Metrics(METRICS_WINDOW)     # замеры одной задачи уходят в основной процесс
+            try:
+                with log_context(rid, (password,)):
+                    data = _collect(PROFILES[operator], login, password,
+                                    lambda name, model: conn.send(("section", name, model)))
+                conn.send(("done", data.to_bytes(), METRICS.export()))
+            except Exception as e:
+                kind = error_kind(e)
+                if kind == "other":
+                    log.exception("Воркер-процесс %d: ошибка сбора", index)
+                else:
+                    log.warning("Воркер-процесс %d: %s: %s", index, type(e).__name__, e)
+                conn.send(("error", f"{type(e).__name__}: {e}", METRICS.export(), kind, getattr(e, "retry_in", 0.0)))
+    finally:
+        DRIVER_POOL.close()
+
+class ProcessWorker:
+    """Один процесс-воркер со своим браузером; перезапускается после падения, таймаута или превышения RSS."""
+    def __init__(self, index: int):
+        self.index = index
+        self.proc = None
+        self.conn = None
+        self.jobs = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.is_alive()
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        self.proc = ctx.Process(target=_worker_main, args=(child_conn, self.index, _worker_log_queue()),
+                                name=f"scrape-proc-{self.index}", daemon=True)
+        self.proc.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.jobs = 0
+        METRICS.inc("worker_starts")
+
+    def kill(self, reason: str):
+        """Жёстко: вся группа процесса (воркер, chromedriver, Chrome), затем join — без зомби."""
+        if self.proc is None:
+            return
+        log.warning("Воркер-процесс %d (pid %s) останавливается: %s", self.index, self.proc.pid, reason)
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            _kill_tree(self.proc.pid)
+            self.proc.kill()
+        self.proc.join(5)
+        self.conn.close()
+        self.proc = self.conn = None
+
+    def stop(self, timeout: float = 15.0):
+        """Мягко: воркер закрывает браузер сам; не успел — kill. Остатки группы добиваются в любом случае."""
+        if self.proc is None:
+            return
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.proc.join(timeout)
+        if self.proc.is_alive():
+            self.kill("не завершился вовремя")
+            return
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            pass
+        self.conn.close()
+        self.proc = self.conn = None
+
+    def run(self, operator: str, login: str, password: str, on_section=None, timeout: float = WORKER_JOB_TIMEOUT) -> Collected:
+        if not self.alive:
+            if self.proc is not None:
+                METRICS.inc("worker_crashes")
+                self.kill(f"упал между задачами (код {self.proc.exitcode})")
+            self.start()
+        deadline = time.monotonic() + timeout
+        try:
+            self.conn.send((operator, login, password, request_id()))
+            while True:
+                left = deadline - time.monotonic()
+                try:
+                    ready = left > 0 and self.conn.poll(left)
+                    msg = self.conn.recv() if ready else None
+                except (EOFError, OSError) as e:
+                    METRICS.inc("worker_crashes")
+                    self.kill(f"упал во время сбора: {e!r}")
+                    raise RuntimeError("Процесс-воркер упал во время сбора") from e
+                if msg is None:
+                    METRICS.inc("worker_timeouts")
+                    self.kill(f"сбор дольше {timeout} с")
+                    raise TimeoutError(f"Сбор не уложился в {timeout} с")
+                kind, *payload = msg
+                if kind == "section":
+                    if on_section:
+                        on_section(*payload)
+                    continue
+                METRICS.merge(*payload[1])
+                if kind == "done":
+                    return Collected.from_bytes(payload[0])
+                raise error_from_kind(payload[2], payload[0], payload[3])
+        finally:
+            self.jobs += 1
+            if self.alive and WORKER_MAX_RSS_MB:
+                rss = _tree_rss_mb(self.proc.pid)
+                if rss > WORKER_MAX_RSS_MB:
+                    METRICS.inc("worker_recycled")
+                    log.info("Воркер-процесс %d занял %.0f МБ (> %d), перезапускаю", self.index, rss, WORKER_MAX_RSS_MB)
+                    self.stop()
+
+class ProcessPool:
+    """Процессы-воркеры по числу браузеров; сбор берёт свободный воркер, как lease() у DriverPool."""
+    def __init__(self, size: int):
+        self.workers = [ProcessWorker(i) for i in range(size)]
+        self._free: List[ProcessWorker] = list(self.workers)
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def warm_up(self):
+        for w in self.workers:
+            with self._cond:
+                if self._closed:
+                    return
+            if not w.alive:
+                w.start()
+
+    def run(self, operator: str, login: str, password: str, on_section=None) -> Collected:
+        deadline = time.monotonic() + DRIVER_LEASE_TIMEOUT
+        with METRICS.timed("lease_wait"):
+            with self._cond:
+                while not self._free:
+                    left = deadline - time.monotonic()
+                    if self._closed or left <= 0:
+                        raise TimeoutError("Нет свободного процесса-воркера")
+                    self._cond.wait(left)
+                if self._closed:
+                    raise RuntimeError("Пул процессов закрыт")
+                w = self._free.pop()
+        try:
+            return w.run(operator, login, password, on_section)
+        finally:
+            with self._cond:
+                self._free.append(w)
+                self._cond.notify()
+
+    def stats(self) -> Tuple[int, int]:
+        """(живых процессов, свободных)."""
+        with self._cond:
+            return sum(1 for w in self.workers if w.alive), len(self._free)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for w in self.workers:
+            w.stop()
+
+WORKER_PROCS = ProcessPool(DRIVER_POOL_SIZE)
+
+# ── Брокер задач: бот и воркеры сбора в разных процессах (BROKER_URL) ──
+# Бот кладёт задачу в брокер и ждёт её события; воркеры (python main.py worker — сколько угодно,
+# на этой машине или на других) берут задачи в аренду, пока у них есть свободные места,
+# продлевают аренду пульсом и отвечают событиями: section — готовая секция, done — результат,
+# error — ошибка. Воркер пропал (аренда не продлена BROKER_LEASE сек) — задача снова в очереди.
+_BROKER_POLL_SEC = 0.2       # как часто опрашивать брокер, когда ждать блокирующе нечем
+_BROKER_EVENTS_TTL = 3600    # ответы, которые никто не забрал (бот перезапустился), живут час
+
+class _Broker:
+    """
+    Общее для брокеров: тела задач и ответов — JSON, зашифрованный Fernet (BROKER_KEY).
+    В них логин/пароль и пароли из результата, поэтому без ключа брокер не открывается.
+    """
+    def __init__(self, key: str):
+        if Fernet is None:
+            raise RuntimeError("для брокера нужен пакет cryptography (шифрование BROKER_KEY)")
+        if not key:
+            raise RuntimeError("не задан BROKER_KEY — логин/пароль в брокер открытым текстом не пишутся")
+        self._fernet = Fernet(key.encode("ascii"))
+
+    def seal(self, obj) -> bytes:
+        return self._fernet.encrypt(json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    def unseal(self, raw: bytes):
+        return json.loads(self._fernet.decrypt(bytes(raw)))
+
+    def _lost(self, attempts: int) -> bytes:
+        return self.seal({"kind": "lost", "text": f"воркер пропал во время сбора (выдач: {attempts})"})
+
+class SqliteBroker(_Broker):
+    """
+    Брокер в файле SQLite (WAL) — бот и воркеры на одной машине. tasks — очередь и аренды,
+    events — ответы воркеров по задачам, workers — пульс и ёмкость воркеров.
+    """
+    _SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY, body BLOB, status TEXT, worker TEXT, attempts INTEGER,
+            expires REAL, deadline REAL, created REAL)""",
+        "CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, created)",
+        """CREATE TABLE IF NOT EXISTS events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, task_id TEXT, kind TEXT, body BLOB, created REAL)""",
+        "CREATE INDEX IF NOT EXISTS events_task ON events (task_id, seq)",
+        "CREATE TABLE IF NOT EXISTS workers (name TEXT PRIMARY KEY, capacity INTEGER, busy INTEGER, info TEXT, seen REAL)",
+    )
+
+    def __init__(self, path: str, key: str):
+        super().__init__(key)
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for sql in self._SCHEMA:
+            self._db.execute(sql)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _tx(self):
+        """Транзакция с блокировкой на запись сразу: одну задачу не возьмут два воркера."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def put(self, task_id: str, body: bytes, ttl: float):
+        now = time.time()
+        with self._tx() as db:
+            db.execute("INSERT INTO tasks VALUES (?, ?, 'queued', NULL, 0, 0, ?, ?)", (task_id, body, now + ttl, now))
+
+    def lease(self, worker: str, lease_sec: float) -> Optional[Tuple[str, bytes]]:
+        with self._tx() as db:
+            row = db.execute("SELECT id, body FROM tasks WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+            if row:
+                db.execute("UPDATE tasks SET status = 'leased', worker = ?, attempts = attempts + 1, expires = ? "
+                           "WHERE id = ?", (worker, time.time() + lease_sec, row[0]))
+        return (row[0], bytes(row[1])) if row else None
+
+    def extend(self, task_ids: List[str], worker: str, lease_sec: float):
+        if not task_ids:
+            return
+        expires = time.time() + lease_sec
+        with self._tx() as db:
+            db.executemany("UPDATE tasks SET expires = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                           [(expires, task_id, worker) for task_id in task_ids])
+
+    def emit(self, task_id: str, kind: str, body: bytes):
+        with self._tx() as db:
+            db.execute("INSERT INTO events (task_id, kind, body, created) VALUES (?, ?, ?, ?)",
+                       (task_id, kind, body, time.time()))
+
+    def complete(self, task_id: str, worker: str, kind: str, body: bytes):
+        """Итоговое событие и снятие задачи — одной транзакцией."""
+        with self._tx() as db:
+            db.execute("INSERT INTO events (task_id, kind, body, created) VALUES (?, ?, ?, ?)",
+                       (task_id, kind, body, time.time()))
+            db.execute("DELETE FROM tasks WHERE id = ? AND worker = ?", (task_id, worker))
+
+    def events(self, task_id: str, timeout: float) -> List[Tuple[str, bytes]]:
+        """Новые события задачи (забираются из брокера); ждёт их до timeout сек."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                rows = self._db.execute("SELECT seq, kind, body FROM events WHERE task_id = ? ORDER BY seq",
+                                        (task_id,)).fetchall()
+                if rows:
+                    self._db.execute("DELETE FROM events WHERE task_id = ? AND seq <= ?", (task_id, rows[-1][0]))
+            if rows or time.monotonic() >= deadline:
+                return [(kind, bytes(body)) for _, kind, body in rows]
+            time.sleep(_BROKER_POLL_SEC)
+
+    def reap(self, max_attempts: int) -> int:
+        """Просроченные аренды — снова в очередь, после max_attempts выдач — ошибка lost; старый мусор — вон."""
+        now = time.time()
+        with self._tx() as db:
+            expired = db.execute("SELECT id, attempts FROM tasks WHERE status = 'leased' AND expires < ?",
+                                 (now,)).fetchall()
+            for task_id, attempts in expired:
+                if attempts >= max_attempts:
+                    db.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+                    db.execute("INSERT INTO events (task_id, kind, body, created) VALUES (?, 'error', ?, ?)",
+                               (task_id, self._lost(attempts), now))
+                else:
+                    db.execute("UPDATE tasks SET status = 'queued', worker = NULL WHERE id = ?", (task_id,))
+            db.execute("DELETE FROM tasks WHERE deadline < ?", (now,))
+            db.execute("DELETE FROM events WHERE created < ?", (now - _BROKER_EVENTS_TTL,))
+        return len(expired)
+
+    def cancel(self, task_id: str):
+        with self._tx() as db:
+            db.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+            db.execute("DELETE FROM events WHERE task_id = ?", (task_id,))
+
+    def heartbeat(self, worker: str, capacity: int, busy: int, info: dict):
+        with self._tx() as db:
+            db.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?, ?)",
+                       (worker, capacity, busy, json.dumps(info), time.time()))
+
+    def leave(self, worker: str):
+        with self._tx() as db:
+            db.execute("DELETE FROM workers WHERE name = ?", (worker,))
+
+    def workers(self, ttl: float) -> List[dict]:
+        """Воркеры с пульсом не старше ttl сек; совсем давно молчащие удаляются."""
+        now = time.time()
+        with self._tx() as db:
+            db.execute("DELETE FROM workers WHERE seen < ?", (now - 10 * ttl,))
+            rows = db.execute("SELECT name, capacity, busy, info, seen FROM workers WHERE seen >= ? ORDER BY name",
+                              (now - ttl,)).fetchall()
+        return [{"name": name, "capacity": capacity, "busy": busy, "info": json.loads(info), "age": now - seen}
+                for name, capacity, busy, info, seen in rows]
+
+    def counts(self) -> Tuple[int, int]:
+        """(в очереди, в аренде)."""
+        with self._lock:
+            rows = dict(self._db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return rows.get("queued", 0), rows.get("leased", 0)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class RedisBroker(_Broker):
+    """
+    То же на Redis — бот и воркеры на разных машинах. queue — список id задач, leased —
+    аренды (sorted set по сроку), task:<id> — тело и число выдач, ev:<id> — ответы воркеров,
+    workers — пульс. Выдача и возврат просроченных аренд — Lua-скриптами, атомарно.
+    """
+    _LEASE_LUA = """
+    while true do
+        local id = redis.call('RPOP', KEYS[1])
+        if not id then return false end
+        local key = KEYS[3] .. id
+        if redis.call('EXISTS', key) == 1 then
+            redis.call('ZADD', KEYS[2], ARGV[1], id)
+            redis.call('HSET', key, 'worker', ARGV[2])
+            redis.call('HINCRBY', key, 'attempts', 1)
+            return {id, redis.call('HGET', key, 'body')}
+        end
+    end
+    """
+    # возвращает {число просроченных, id потерянных задач (выдач не меньше ARGV[2]) и их выдачи…}
+    _REAP_LUA = """
+    local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    local out = {#ids}
+    for _, id in ipairs(ids) do
+        redis.call('ZREM', KEYS[1], id)
+        local key = KEYS[3] .. id
+        if redis.call('EXISTS', key) == 1 then
+            local attempts = tonumber(redis.call('HGET', key, 'attempts') or '0')
+            if attempts >= tonumber(ARGV[2]) then
+                redis.call('DEL', key)
+                table.insert(out, id)
+                table.insert(out, attempts)
+            else
+                redis.call('HDEL', key, 'worker')
+                redis.call('RPUSH', KEYS[2], id)
+            end
+        end
+    end
+    return out
+    """
+
+    def __init__(self, client, key: str, prefix: str = "okc:"):
+        super().__init__(key)
+        self._r = client
+        self.prefix = prefix
+        self._lease = client.register_script(self._LEASE_LUA)
+        self._reap = client.register_script(self._REAP_LUA)
+
+    def _k(self, *parts: str) -> str:
+        return self.prefix + ":".join(parts)
+
+    def put(self, task_id: str, body: bytes, ttl: float):
+        pipe = self._r.pipeline()
+        pipe.hset(self._k("task", task_id), mapping={"body": body, "attempts": 0})
+        pipe.expire(self._k("task", task_id), int(ttl) + 1)
+        pipe.lpush(self._k("queue"), task_id)
+        pipe.execute()
+
+    def lease(self, worker: str, lease_sec: float) -> Optional[Tuple[str, bytes]]:
+        res = self._lease(keys=[self._k("queue"), self._k("leased"), self._k("task", "")],
+                          args=[time.time() + lease_sec, worker])
+        return (res[0].decode(), res[1]) if res else None
+
+    def extend(self, task_ids: List[str], worker: str, lease_sec: float):
+        if task_ids:
+            expires = time.time() + lease_sec
+            self._r.zadd(self._k("leased"), {task_id: expires for task_id in task_ids}, xx=True)
+
+    def emit(self, task_id: str, kind: str, body: bytes):
+        pipe = self._r.pipeline()
+        pipe.rpush(self._k("ev", task_id), kind.encode() + b"\n" + body)
+        pipe.expire(self._k("ev", task_id), _BROKER_EVENTS_TTL)
+        pipe.execute()
+
+    def complete(self, task_id: str, worker: str, kind: str, body: bytes):
+        pipe = self._r.pipeline()
+        pipe.zrem(self._k("leased"), task_id)
+        pipe.delete(self._k("task", task_id))
+        pipe.rpush(self._k("ev", task_id), kind.encode() + b"\n" + body)
+        pipe.expire(self._k("ev", task_id), _BROKER_EVENTS_TTL)
+        pipe.execute()
+
+    def events(self, task_id: str, timeout: float) -> List[Tuple[str, bytes]]:
+        key = self._k("ev", task_id)
+        first = self._r.blpop([key], timeout=max(timeout, 0.01))
+        if first is None:
+            return []
+        raws = [first[1]]
+        while True:
+            raw = self._r.lpop(key)
+            if raw is None:
+                break
+            raws.append(raw)
+        out = []
+        for raw in raws:
+            kind, _, body = raw.partition(b"\n")
+            out.append((kind.decode(), body))
+        return out
+
+    def reap(self, max_attempts: int) -> int:
+        res = self._reap(keys=[self._k("leased"), self._k("queue"), self._k("task", "")],
+                         args=[time.time(), max_attempts])
+        for i in range(1, len(res), 2):
+            self.emit(res[i].decode(), "error", self._lost(int(res[i + 1])))
+        return int(res[0])
+
+    def cancel(self, task_id: str):
+        pipe = self._r.pipeline()
+        pipe.lrem(self._k("queue"), 0, task_id)
+        pipe.zrem(self._k("leased"), task_id)
+        pipe.delete(self._k("task", task_id), self._k("ev", task_id))
+        pipe.execute()
+
+    def heartbeat(self, worker: str, capacity: int, busy: int, info: dict):
+        self._r.hset(self._k("workers"), worker, json.dumps(
+            {"capacity": capacity, "busy": busy, "info": info, "seen": time.time()}))
+
+    def leave(self, worker: str):
+        self._r.hdel(self._k("workers"), worker)
+
+    def workers(self, ttl: float) -> List[dict]:
+        now = time.time()
+        out = []
+        for name, raw in self._r.hgetall(self._k("workers")).items():
+            d = json.loads(raw)
+            age = now - d["seen"]
+            if age > 10 * ttl:
+                self._r.hdel(self._k("workers"), name)
+            elif age <= ttl:
+                out.append({"name": name.decode(), "capacity": d["capacity"], "busy": d["busy"],
+                            "info": d["info"], "age": age})
+        return sorted(out, key=lambda w: w["name"])
+
+    def counts(self) -> Tuple[int, int]:
+        pipe = self._r.pipeline()
+        pipe.llen(self._k("queue"))
+        pipe.zcard(self._k("leased"))
+        queued, leased = pipe.execute()
+        return queued, leased
+
+    def close(self):
+        self._r.close()
+
+def open_broker(url: str, key: str) -> _Broker:
+    """sqlite:///абсолютный/путь, sqlite://имя.db (рядом с main.py) или redis://host:6379/0."""
+    scheme, _, rest = url.partition("://")
+    if scheme == "sqlite":
+        return SqliteBroker(rest if os.path.isabs(rest) else str(Path(__file__).parent / rest), key)
+    if scheme in ("redis", "rediss", "unix"):
+        if redis is None:
+            raise RuntimeError("для BROKER_URL=redis://… нужен пакет redis")
+        return RedisBroker(redis.Redis.from_url(url), key)
+    raise ValueError(f"BROKER_URL: неизвестная схема «{scheme}» (нужно sqlite:// или redis://)")
+
+def require_broker_key():
+    """С BROKER_URL ключ обязателен: без него (или без cryptography) бот и воркер не стартуют."""
+    try:
+        _Broker(BROKER_KEY)
+    except Exception as e:
+        log.error("BROKER_URL задан, но шифровать задачи нечем: %s. Ключ: python -c \"from cryptography.fernet "
+                  "import Fernet; print(Fernet.generate_key().decode())\" — одинаковый у бота и воркеров", e)
+        raise SystemExit(1)
+
+def _note_reaped(n: int):
+    if n:
+        METRICS.inc("broker_reaped", n)
+        log.warning("Брокер: %d задач(и) без пульса воркера вернулись в очередь или отменены", n)
+
+class BrokerClient:
+    """Сторона бота: сбор уходит воркерам через брокер — как WORKER_PROCS.run, только процессы где угодно."""
+    def __init__(self, broker: _Broker, wait_sec: int = BROKER_WAIT_SEC):
+        self.broker = broker
+        self.wait_sec = wait_sec
+        self._workers: List[dict] = []
+        self._checked = -math.inf
+        self._reaped = -math.inf
+        self._lock = threading.Lock()
+
+    def workers(self) -> List[dict]:
+        """Живые воркеры (пульс не старше трёх интервалов); брокер спрашиваем не чаще раза в BROKER_HEARTBEAT."""
+        with self._lock:
+            if time.monotonic() - self._checked >= BROKER_HEARTBEAT_SEC:
+                self._checked = time.monotonic()
+                try:
+                    self._workers = self.broker.workers(3 * BROKER_HEARTBEAT_SEC)
+                except Exception as e:
+                    log.warning("Брокер: не удалось получить список воркеров: %s", e)
+            return self._workers
+
+    def capacity(self) -> int:
+        """Сколько сборов живые воркеры берут одновременно (по их пульсу)."""
+        return sum(w["capacity"] for w in self.workers())
 
-def get_pass_and_run(update: Update, context: CallbackContext) -> int:
+    def stats(self) -> Tuple[int, int]:
+        """(мест у живых воркеров, свободных) — как stats() у пулов."""
+        ws = self.workers()
+        return sum(w["capacity"] for w in ws), sum(max(0, w["capacity"] - w["busy"]) for w in ws)
+
+    def _reap(self):
+        """Просроченные аренды возвращает и бот: если упали все воркеры, задачи не висят до BROKER_WAIT."""
+        with self._lock:
+            if time.monotonic() - self._reaped < BROKER_HEARTBEAT_SEC:
+                return
+            self._reaped = time.monotonic()
+        _note_reaped(self.broker.reap(BROKER_MAX_ATTEMPTS))
+
+    def run(self, operator: str, login: str, password: str, on_section=None) -> Collected:
+        if not self.workers():
+            METRICS.inc("broker_no_workers")
+            log.warning("Брокер: живых воркеров нет, задача ждёт в очереди")
+        task_id = secrets.token_hex(8)
+        deadline = time.monotonic() + self.wait_sec
+        body = self.broker.seal({"op": operator, "login": login, "password": password, "rid": request_id()})
+        self.broker.put(task_id, body, self.wait_sec)
+        try:
+            while True:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    METRICS.inc("broker_timeouts")
+                    raise TimeoutError(f"Воркеры не ответили за {self.wait_sec} с")
+                for kind, raw in self.broker.events(task_id, min(left, 1.0)):
+                    msg = self.broker.unseal(raw)
+                    if kind == "section":
+                        if on_section:
+                            on_section(msg["name"], Collected.section_from_list(msg["name"], msg["values"]))
+                        continue
+                    METRICS.merge({k: [v] for k, v in msg.get("stages", {}).items()}, {})
+                    if kind == "done":
+                        return Collected.from_bytes(msg["result"])
+                    raise error_from_kind(msg["kind"], msg["text"], msg.get("retry_in", 0.0))
+                self._reap()
+        finally:
+            self.broker.cancel(task_id)
+
+class BrokerWorker:
+    """
+    python main.py worker: берёт задачи из брокера, пока занято меньше capacity мест, собирает
+    их тем же collect(), что и бот, и отвечает событиями. Пульс раз в BROKER_HEARTBEAT: ёмкость
+    и занятость — боту, продление аренды — своим задачам, возврат чужих просроченных — в очередь.
+    """
+    def __init__(self, broker: _Broker, name: str, capacity: int):
+        self.broker = broker
+        self.name = name
+        self.capacity = capacity
+        self._held: Dict[str, threading.Thread] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._done = threading.Event()
+
+    def stop(self):
+        """Больше не брать задачи; взятые дорабатываются (run() вернётся после них)."""
+        self._stop.set()
+
+    def _pulse(self):
+        with self._lock:
+            held = list(self._held)
+        try:
+            # на остановке ёмкость 0: бот не считает этого воркера свободным
+            self.broker.heartbeat(self.name, 0 if self._stop.is_set() else self.capacity, len(held),
+                                  {"host": socket.gethostname(), "pid": os.getpid()})
+            self.broker.extend(held, self.name, BROKER_LEASE_SEC)
+            _note_reaped(self.broker.reap(BROKER_MAX_ATTEMPTS))
+        except Exception as e:
+            log.warning("Брокер: пульс не прошёл: %s", e)
+
+    def _heartbeat_loop(self):
+        while not self._done.wait(BROKER_HEARTBEAT_SEC):
+            self._pulse()
+
+    def run(self):
+        """Блокирует до stop(); затем ждёт взятые задачи не дольше SCRAPE_DRAIN_TIMEOUT."""
+        self._pulse()
+        threading.Thread(target=self._heartbeat_loop, name="broker-heartbeat", daemon=True).start()
+        log.info("Воркер %s: жду задачи (мест: %d)", self.name, self.capacity)
+        while not self._stop.is_set():
+            with self._lock:
+                free = len(self._held) < self.capacity
+            task = None
+            if free:
+                try:
+                    task = self.broker.lease(self.name, BROKER_LEASE_SEC)
+                except Exception as e:
+                    log.warning("Брокер: не удалось взять задачу: %s", e)
+            if task is None:
+                self._stop.wait(_BROKER_POLL_SEC)
+                continue
+            task_id, body = task
+            t = threading.Thread(target=self._handle, args=(task_id, body), name=f"broker-{task_id}", daemon=True)
+            with self._lock:
+                self._held[task_id] = t
+            t.start()
+
+        deadline = time.monotonic() + SCRAPE_DRAIN_TIMEOUT
+        with self._lock:
+            threads = list(self._held.values())
+        for t in threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        self._done.set()
+        with self._lock:
+            left = len(self._held)
+        if left:
+            log.warning("Воркер %s: остановка, не дождались %d задач(и) — их возьмут другие воркеры", self.name, left)
+        try:
+            self.broker.leave(self.name)
+        except Exception as e:
+            log.warning("Брокер: не удалось сняться с учёта: %s", e)
+
+    def _section(self, task_id: str, name: str, model):
+        try:
+            self.broker.emit(task_id, "section", self.broker.seal({"name": name, "values": astuple(model)}))
+        except Exception as e:
+            log.warning("Брокер: секция %s задачи %s не отправлена: %s", name, task_id, e)
+
+    def _handle(self, task_id: str, body: bytes):
+        t0 = time.monotonic()
+        try:
+            try:
+                job = self.broker.unseal(body)
+            except Exception as e:
+                log.error("Брокер: задачу %s не прочитать (%s) — BROKER_KEY у бота и воркеров должен совпадать",
+                          task_id, e)
+                self.broker.complete(task_id, self.name, "error",
+                                     self.broker.seal({"kind": "other", "text": "воркер не смог прочитать задачу"}))
+                return
+            with log_context(job["rid"], (job["password"],)), METRICS.capture() as stages:
+                try:
+                    data = collect(PROFILES[job["op"]], job["login"], job["password"],
+                                   on_section=lambda name, model: self._section(task_id, name, model))
+                    kind, msg = "done", {"result": data.to_bytes().decode("utf-8")}
+                    METRICS.inc("broker_jobs_ok")
+                except Exception as e:
+                    METRICS.inc("broker_jobs_failed")
+                    if error_kind(e) == "other":
+                        log.exception("Воркер %s: ошибка сбора", self.name)
+                    else:
+                        log.warning("Воркер %s: %s: %s", self.name, type(e).__name__, e)
+                    kind, msg = "error", {"kind": error_kind(e), "text": f"{type(e).__name__}: {e}",
+                                          "retry_in": getattr(e, "retry_in", 0.0)}
+                stages.pop("collect", None)     # общую длительность бот меряет сам
+                msg["stages"] = dict(stages)
+                self.broker.complete(task_id, self.name, kind, self.broker.seal(msg))
+                log.info("Воркер %s: задача %s — %s за %.2f с", self.name, task_id, kind, time.monotonic() - t0)
+        except ConnectionError as e:    # в т.ч. BrokenPipeError: брокер или портал оборвал соединение
+            log.info("Воркер %s: связь потеряна (%s), аренда задачи %s истечёт и её возьмёт другой воркер",
+                     self.name, e, task_id)
+        except Exception as e:
+            log.error("Брокер: не удалось отдать ответ по задаче %s: %s", task_id, e)
+        finally:
+            with self._lock:
+                self._held.pop(task_id, None)
+
+REMOTE: Optional[BrokerClient] = None     # бот с BROKER_URL: сбор через брокер (подключается в _post_init)
+
+# ── Форматирование ──
+def render_main(m: MainPageData) -> str:
+    services_lines = []
+    if m.services:
+        for i, line in enumerate(SERVICES_TABLE.lines(m.services), 1):
+            services_lines.append(f"{i}) {line}")
+    else:
+        services_lines.append("—")
+    return (
+        f"• Номер заявки: <b>{m.request_number}</b>\n"
+        f"• Лицевой счёт: <b>{m.account_number}</b>\n"
+        f"• Адрес подключения: <b>{m.address}</b>\n"
+        f"• Временный пароль: <b>{m.temp_password}</b>\n"
+        f"• Услуги:\n" + "\n".join(services_lines)
+        + "".join(
+            f"\n• {spec.title}:\n" + "\n".join(f"{i}) {html_escape(line)}" for i, line in enumerate(spec.lines(rows), 1))
+            for spec, rows in ((REMOVED_TABLE, m.removed), (HISTORY_TABLE, m.history)) if rows
+        )
+    )
+
+def render_client(c: ClientData) -> str:
+    return (
+        f"• Абонентский номер: <b>{c.abonent_number}</b>\n"
+        f"• Контактный мобильный телефон: <b>{c.contact_mobile}</b>\n"
+        f"• Мобильный телефон клиента: <b>{c.client_mobile}</b>\n"
+        f"• Фамилия: <b>{c.lastname}</b>\n"
+        f"• Имя: <b>{c.firstname}</b>\n"
+        f"• Отчество: <b>{c.middlename}</b>"
+    )
+
+def render_pppoe(p: PppoeData) -> str:
+    return (
+        f"• Логин PPPoE: <b>{p.login}</b>\n"
+        f"• Пароль PPPoE: <b>{p.password}</b>"
+    )
+
+# Имя секции → (заголовок блока, рендерер); порядок блоков в ответе — порядок секций профиля
+SECTION_RENDERERS: Dict[str, Tuple[str, Callable]] = {
+    "main": ("📌 <b>Детализация заявки</b>", render_main),
+    "client": ("👤 <b>Данные клиента</b>", render_client),
+    "pppoe": ("🌐 <b>PPPoE</b>", render_pppoe),
+}
+
+def format_sections(parts: Dict[str, object], order: List[str], pending: bool = True) -> str:
+    """Собранные секции — блоками; ещё не готовые — строкой «загружаю…» (pending=False — пропустить)."""
+    blocks = []
+    for name in order:
+        title, render = SECTION_RENDERERS[name]
+        if name in parts:
+            blocks.append(f"{title}\n{render(parts[name])}")
+        elif pending:
+            blocks.append(f"{title}\n⏳ загружаю…")
+    return "\n\n".join(blocks)
+
+def format_collected(data: Collected) -> str:
+    return format_sections(
+        {name: getattr(data, name) for name in SECTION_RENDERERS}, list(SECTION_RENDERERS)
+    )
+
+# ── Кэш результатов ──
+class ResultCache:
+    """
+    Готовые Collected по HMAC учётных данных (key()): TTL + ограничение размера (LRU).
+    По умолчанию в памяти, HMAC-ключ случайный на процесс. С RESULT_CACHE_DB и RESULT_CACHE_KEY
+    дублируется в SQLite и переживает перезапуск: записи зашифрованы Fernet (в них пароли PPPoE
+    и временный), HMAC-ключ выводится из того же ключа — без него по файлу пароль не подобрать.
+    """
+    def __init__(self, ttl: int, max_size: int, db_path: str = "", key: str = ""):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: "OrderedDict[str, Tuple[float, Collected]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._fernet = None
+        if ttl and db_path:
+            if Fernet is None:
+                log.warning("RESULT_CACHE_DB задан, но пакет cryptography не установлен — кэш результатов только в памяти")
+            elif not key:
+                log.warning("RESULT_CACHE_DB задан без RESULT_CACHE_KEY — кэш результатов только в памяти")
+            else:
+                try:
+                    self._fernet = Fernet(key.encode("ascii"))
+                except Exception as e:
+                    log.warning("RESULT_CACHE_KEY не подходит для Fernet (%s) — кэш результатов только в памяти", e)
+        self._secret = (hashlib.sha256(b"okcbot-result-cache\0" + key.encode("ascii")).digest()
+                        if self._fernet is not None else secrets.token_bytes(32))
+        if self._fernet is not None:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, ts REAL, data BLOB)")
+            self._db.commit()
+
+    def key(self, operator: str, login: str, password: str) -> str:
+        return hmac.new(self._secret, f"{operator}\0{login}\0{password}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[Collected, float]]:
+        """(данные, возраст в секундах) или None."""
+        if not self.ttl:
+            return None
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is None and self._db is not None:
+                row = self._db.execute("SELECT ts, data FROM results WHERE key = ?", (key,)).fetchone()
+                if row:
+                    try:
+                        item = (row[0], Collected.from_bytes(self._fernet.decrypt(bytes(row[1]))))
+                    except Exception as e:
+                        log.warning("Битая запись в кэше результатов: %s", e)
+                    else:
+                        self._items[key] = item
+            if item is None:
+                return None
+            ts, data = item
+            if now - ts > self.ttl:
+                self._items.pop(key, None)
+                return None
+            self._items.move_to_end(key)
+            return data, now - ts
+
+    def put(self, key: str, data: Collected):
+        if not self.ttl:
+            return
+        now = time.time()
+        with self._lock:
+            self._items[key] = (now, data)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, now, self._fernet.encrypt(data.to_bytes())))
+                    self._db.execute("DELETE FROM results WHERE ts < ?", (now - self.ttl,))
+                    self._db.commit()
+                except Exception as e:
+                    log.warning("Не удалось записать кэш результатов: %s", e)
+
+RESULTS = ResultCache(RESULT_TTL_SEC, RESULT_CACHE_MAX, RESULT_CACHE_DB, RESULT_CACHE_KEY)
+
+def _age_text(sec: float) -> str:
+    sec = int(sec)
+    return f"{sec} сек" if sec < 60 else f"{sec // 60} мин"
+
+# ── Журнал задач ──
+class JobJournal:
+    """
+    Журнал сборов в SQLite (WAL): чаты, статус, время постановки/начала/конца, длительности
+    стадий и ошибка. Записи копятся в памяти и уходят в базу пачкой из фонового потока раз
+    в JOURNAL_FLUSH_MS — запрос пользователя диска не ждёт. Логин и пароль незавершённой
+    задачи хранятся зашифрованными (Fernet, JOURNAL_KEY) в отдельной таблице и удаляются,
+    как только задача закончилась. Без ключа после перезапуска задачу не продолжить —
+    пользователю уходит извинение.
+
+    Статусы: queued → running → done | failed; после перезапуска — resumed (продолжена
+    новой задачей) или abandoned (пользователю написали, что запрос потерян).
+    """
+    _SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, operator TEXT, chat_ids TEXT, status TEXT,
+            created REAL, started REAL, finished REAL, stages TEXT, error TEXT)""",
+        "CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created)",
+        "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)",
+        "CREATE TABLE IF NOT EXISTS credentials (job_id TEXT PRIMARY KEY, blob BLOB)",
+    )
+    OPEN = ("queued", "running")
+
+    def __init__(self, path: str, flush_ms: int, key: str = "", keep_days: int = 30):
+        self.path = path
+        self.flush_sec = max(0.01, flush_ms / 1000)
+        self.keep_days = keep_days
+        self._fernet = None
+        self._pending: List[Tuple[str, tuple]] = []
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._closing = False
+        self._db = None
+        self._thread = None
+        if not path:
+            return
+        if key:
+            if Fernet is None:
+                log.warning("JOURNAL_KEY задан, но пакет cryptography не установлен — логин/пароль в журнал не пишутся")
+            else:
+                try:
+                    self._fernet = Fernet(key.encode("ascii"))
+                except (ValueError, TypeError) as e:
+                    log.warning("JOURNAL_KEY не подходит для Fernet (%s) — логин/пароль в журнал не пишутся", e)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def start(self):
+        if not self.path or self._db is not None:
+            return
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for sql in self._SCHEMA:
+            self._db.execute(sql)
+        if self.keep_days:
+            self._db.execute("DELETE FROM jobs WHERE created < ?", (time.time() - self.keep_days * 86400,))
+        self._db.execute("DELETE FROM credentials WHERE job_id NOT IN (SELECT id FROM jobs WHERE status IN ('queued', 'running'))")
+        self._db.commit()
+        self._thread = threading.Thread(target=self._loop, name="journal", daemon=True)
+        self._thread.start()
+
+    # запись: всё через очередь, пишет один поток
+    def _write(self, sql: str, params: tuple):
+        if not self.path:
+            return
+        with self._cond:
+            self._pending.append((sql, params))
+            self._cond.notify()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if self._closing:
+                    return
+            time.sleep(self.flush_sec)     # копим пачку
+            self.flush()
+
+    def flush(self):
+        """Всё накопленное — одной транзакцией."""
+        with self._write_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            if not batch or self._db is None:
+                return
+            t0 = time.monotonic()
+            try:
+                with self._db:
+                    for sql, params in batch:
+                        self._db.execute(sql, params)
+            except Exception as e:
+                log.warning("Не удалось записать журнал задач (%d записей): %s", len(batch), e)
+            METRICS.observe("journal_flush", time.monotonic() - t0)
+
+    def close(self):
+        if self._db is None:
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(5)
+        self.flush()
+        with self._write_lock:
+            self._db.close()
+            self._db = None
+
+    def open(self, operator: str, chat_ids: List[int], login: str, password: str) -> str:
+        if not self.path:
+            return ""
+        job_id = secrets.token_hex(8)
+        self._write("INSERT INTO jobs (id, operator, chat_ids, status, created) VALUES (?, ?, ?, 'queued', ?)",
+                    (job_id, operator, json.dumps(chat_ids), time.time()))
+        if self._fernet is not None:
+            blob = self._fernet.encrypt(json.dumps([login, password]).encode("utf-8"))
+            self._write("INSERT OR REPLACE INTO credentials VALUES (?, ?)", (job_id, blob))
+        return job_id
+
+    def chats(self, job_id: str, chat_ids: List[int]):
+        if job_id:
+            self._write("UPDATE jobs SET chat_ids = ? WHERE id = ?", (json.dumps(chat_ids), job_id))
+
+    def started(self, job_id: str):
+        if job_id:
+            self._write("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), job_id))
+
+    def finished(self, job_id: str, ok: bool, stages: Dict[str, float] = None, error: str = ""):
+        if not job_id:
+            return
+        self._write("UPDATE jobs SET status = ?, finished = ?, stages = ?, error = ? WHERE id = ?",
+                    ("done" if ok else "failed", time.time(), json.dumps(stages or {}), error[:500] or None, job_id))
+        self._write("DELETE FROM credentials WHERE job_id = ?", (job_id,))
+
+    def close_open(self, job_id: str, status: str):
+        """resumed / abandoned — задачу из прошлого запуска больше не ждём."""
+        self._write("UPDATE jobs SET status = ?, finished = ? WHERE id = ?", (status, time.time(), job_id))
+        self._write("DELETE FROM credentials WHERE job_id = ?", (job_id,))
+
+    def unfinished(self) -> List[dict]:
+        """Задачи, не дошедшие до конца в прошлый запуск, с расшифрованными логином/паролем, если есть."""
+        if self._db is None:
+            return []
+        with self._write_lock:
+            rows = self._db.execute(
+                "SELECT j.id, j.operator, j.chat_ids, j.created, c.blob FROM jobs j "
+                "LEFT JOIN credentials c ON c.job_id = j.id WHERE j.status IN ('queued', 'running') ORDER BY j.created"
+            ).fetchall()
+        out = []
+        for job_id, operator, chat_ids, created, blob in rows:
+            creds = None
+            if blob is not None and self._fernet is not None:
+                try:
+                    creds = tuple(json.loads(self._fernet.decrypt(blob)))
+                except (InvalidToken, ValueError) as e:
+                    log.warning("Журнал: не расшифровать данные задачи %s (сменился JOURNAL_KEY?): %s", job_id, e)
+            out.append({"id": job_id, "operator": operator, "chat_ids": json.loads(chat_ids or "[]"),
+                        "created": created, "credentials": creds})
+        return out
+
+    def summary(self, since_sec: float) -> dict:
+        """
+        Сводка за последние since_sec секунд: задач по статусам, доля ошибок, перцентили
+        ожидания в очереди, полного времени и стадий, частые ошибки. Читает отдельным
+        соединением — WAL не блокирует запись.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return {"total": 0, "status": {}}
+        db = sqlite3.connect(self.path)
+        try:
+            rows = db.execute(
+                "SELECT status, created, started, finished, stages, error FROM jobs WHERE created >= ?",
+                (time.time() - since_sec,),
+            ).fetchall()
+        finally:
+            db.close()
+        status: Dict[str, int] = {}
+        wait, total, errors = [], [], {}
+        stages: Dict[str, List[float]] = {}
+        for st, created, started, finished, st_json, error in rows:
+            status[st] = status.get(st, 0) + 1
+            if started:
+                wait.append(started - created)
+            if st in ("done", "failed") and finished and started:
+                total.append(finished - created)
+                for k, v in json.loads(st_json or "{}").items():
+                    stages.setdefault(k, []).append(v)
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+
+        def pct(xs):
+            xs = sorted(xs)
+            return {"n": len(xs), "p50": Metrics._q(xs, 0.5), "p95": Metrics._q(xs, 0.95)} if xs else None
+
+        ended = status.get("done", 0) + status.get("failed", 0) + status.get("abandoned", 0)
+        return {
+            "total": len(rows),
+            "status": status,
+            "failure_rate": (status.get("failed", 0) + status.get("abandoned", 0)) / ended if ended else 0.0,
+            "wait": pct(wait),
+            "duration": pct(total),
+            "stages": {k: pct(v) for k, v in sorted(stages.items())},
+            "errors": sorted(errors.items(), key=lambda kv: -kv[1])[:5],
+        }
+
+JOURNAL = JobJournal(JOURNAL_DB, JOURNAL_FLUSH_MS, JOURNAL_KEY, JOURNAL_KEEP_DAYS)
+
+# ── Очередь задач ──
+@dataclass
+class ScrapeJob:
+    key: str
+    operator: str
+    login: str
+    password: str
+    chat_ids: List[int]                    # кому отвечать сообщением (пакетные строки — без сообщения)
+    owner: int = 0                         # чей лимит SCRAPE_PER_CHAT_MAX и чья очередь
+    enqueued: float = field(default_factory=time.monotonic)
+    journal_id: str = ""
+    listeners: List[Callable[["ScrapeJob"], None]] = field(default_factory=list)   # on_done из submit
+    result: Optional[Collected] = None
+    error: Optional[BaseException] = None
+
+@dataclass
+class SubmitResult:
+    accepted: bool
+    reason: str = ""          # full | limit | closed
+    position: int = 0         # 0 = сразу в работу
+    eta_sec: int = 0
+    duplicate: bool = False
+
+def _job_key(operator: str, login: str, password: str) -> str:
+    return RESULTS.key(operator, login, password)
+
+class ScrapeScheduler:
+    """
+    Ограниченная очередь сборов с постоянными воркерами:
+    - round-robin между чатами (один пользователь не занимает всех воркеров);
+    - одинаковые логин/пароль в работе не дублируются — ответ получат все ждущие чаты;
+    - on_done(job) — без сообщения в чат: результат в job.result или ошибка в job.error (так идёт /batch);
+    - при остановке новые задачи не принимаются, очередь дорабатывается.
+    """
+    def __init__(self, workers: int, max_queue: int, per_chat: int, journal: Optional[JobJournal] = None):
+        self.workers = workers
+        self.journal = journal
+        self.max_queue = max_queue
+        self.per_chat = per_chat
+        self._handler = None
+        self._queues: "OrderedDict[int, deque]" = OrderedDict()
+        self._inflight: Dict[str, ScrapeJob] = {}
+        self._per_chat: Dict[int, int] = {}
+        self._queued = 0
+        self._running = 0
+        self._avg_sec = float(HARD_WAIT_AFTER_LOGIN_SEC + 15)
+        self._stopping = False
+        self._threads: List[threading.Thread] = []
+        self._cond = threading.Condition()
+        self.capacity: Optional[Callable[[], int]] = None    # с брокером — места у живых воркеров (для ETA)
+
+    def start(self, handler):
+        self._handler = handler
+        for i in range(self.workers):
+            t = threading.Thread(target=self._loop, name=f"scrape-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _order(self):
+        """Порядок, в котором будут взяты задачи из очереди (round-robin по чатам)."""
+        qs = [list(q) for q in self._queues.values()]
+        for i in range(max((len(q) for q in qs), default=0)):
+            for q in qs:
+                if i < len(q):
+                    yield q[i]
+
+    def _position(self, job: ScrapeJob) -> int:
+        for i, j in enumerate(self._order(), 1):
+            if j is job:
+                return i
+        return 0
+
+    def _eta(self, position: int) -> int:
+        if position <= 0:
+            return 0
+        slots = self.workers
+        if self.capacity is not None:
+            slots = max(1, min(slots, self.capacity()))
+        waves = math.ceil((position + self._running) / slots)
+        return int(waves * self._avg_sec)
+
+    def submit(self, chat_id: int, operator: str, login: str, password: str,
+               on_done: Optional[Callable[[ScrapeJob], None]] = None) -> SubmitResult:
+        key = _job_key(operator, login, password)
+        with self._cond:
+            if self._stopping:
+                return SubmitResult(False, "closed")
+            job = self._inflight.get(key)
+            if job is not None:
+                if on_done is not None:
+                    job.listeners.append(on_done)
+                elif chat_id not in job.chat_ids:
+                    job.chat_ids.append(chat_id)
+                    if self.journal:
+                        self.journal.chats(job.journal_id, job.chat_ids)
+                pos = self._position(job)
+                return SubmitResult(True, position=pos, eta_sec=self._eta(pos), duplicate=True)
+            if self._queued >= self.max_queue:
+                return SubmitResult(False, "full")
+            if self.per_chat and self._per_chat.get(chat_id, 0) >= self.per_chat:
+                return SubmitResult(False, "limit")
+            job = ScrapeJob(key, operator, login, password, [] if on_done else [chat_id], owner=chat_id,
+                            listeners=[on_done] if on_done else [])
+            if self.journal:
+                job.journal_id = self.journal.open(operator, job.chat_ids, login, password)
+            self._inflight[key] = job
+            self._per_chat[chat_id] = self._per_chat.get(chat_id, 0) + 1
+            self._queues.setdefault(chat_id, deque()).append(job)
+            self._queued += 1
+            busy = self._running + self._queued > self.workers
+            pos = self._position(job) if busy else 0
+            self._cond.notify()
+            return SubmitResult(True, position=pos, eta_sec=self._eta(pos))
+
+    def _take(self) -> ScrapeJob:
+        chat_id, q = next(iter(self._queues.items()))
+        job = q.popleft()
+        if q:
+            self._queues.move_to_end(chat_id)
+        else:
+            del self._queues[chat_id]
+        self._queued -= 1
+        self._running += 1
+        return job
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._queued and not self._stopping:
+                    self._cond.wait()
+                if not self._queued:
+                    return
+                job = self._take()
+            t0 = time.monotonic()
+            METRICS.observe("queue_wait", t0 - job.enqueued)
+            try:
+                self._handler(job)
+            except Exception:
+                log.exception("Необработанная ошибка в воркере очереди")
+            finally:
+                with self._cond:
+                    self._avg_sec = 0.8 * self._avg_sec + 0.2 * (time.monotonic() - t0)
+                    self._inflight.pop(job.key, None)
+                    self._per_chat[job.owner] -= 1
+                    if not self._per_chat[job.owner]:
+                        del self._per_chat[job.owner]
+                    self._running -= 1
+                    self._cond.notify_all()
+                    listeners = list(job.listeners)
+                for cb in listeners:
+                    try:
+                        cb(job)
+                    except Exception:
+                        log.exception("Ошибка в on_done задачи")
+
+    def stats(self) -> Tuple[int, int]:
+        """(в очереди, в работе)."""
+        with self._cond:
+            return self._queued, self._running
+
+    def shutdown(self, timeout: float):
+        """Перестаём принимать задачи и ждём, пока воркеры доработают очередь."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        with self._cond:
+            left = self._queued + self._running
+        if left:
+            log.warning("Остановка: не дождались %d задач(и) в очереди", left)
+
+SCHEDULER = ScrapeScheduler(SCRAPE_WORKERS, SCRAPE_QUEUE_MAX, SCRAPE_PER_CHAT_MAX, JOURNAL)
+
+# ── Исходящие сообщения ──
+class Outbox:
+    """
+    Очередь исходящих сообщений в event loop бота. Воркеры (потоки) кладут сообщения
+    потокобезопасно и не ждут сети; цикл отправки забирает пачку и шлёт её параллельно
+    по разным чатам, сохраняя порядок внутри чата.
+    """
+    def __init__(self, batch: int):
+        self.batch = batch
+        self._bot = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, bot):
+        self._bot = bot
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    def call(self, method: str, chat_id: int, **kwargs) -> concurrent.futures.Future:
+        """Потокобезопасно: вызвать bot.<method>(chat_id=..., **kwargs); результат — во Future."""
+        fut = concurrent.futures.Future()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (method, chat_id, kwargs, fut))
+        return fut
+
+    def send(self, chat_id: int, text: str, **kwargs) -> concurrent.futures.Future:
+        return self.call("send_message", chat_id, text=text, **kwargs)
+
+    async def _deliver(self, items):
+        for method, chat_id, kwargs, fut in items:
+            for attempt in (1, 2):
+                try:
+                    fut.set_result(await getattr(self._bot, method)(chat_id=chat_id, **kwargs))
+                    break
+                except RetryAfter as e:
+                    if attempt == 2:
+                        fut.set_exception(e)
+                        break
+                    await asyncio.sleep(e.retry_after)
+                except Exception as e:
+                    log.warning("Не удалось отправить сообщение в чат %s: %s", chat_id, e)
+                    fut.set_exception(e)
+                    break
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            by_chat: Dict[int, list] = {}
+            for item in batch:
+                by_chat.setdefault(item[1], []).append(item)
+            await asyncio.gather(*(self._deliver(items) for items in by_chat.values()))
+            for _ in batch:
+                self._queue.task_done()
+
+    async def stop(self):
+        if self._task:
+            await self._queue.join()
+            self._task.cancel()
+
+OUTBOX = Outbox(OUTBOX_BATCH)
+
+class LiveMessage:
+    """
+    Сообщение, которое правится на месте по мере работы: первый текст отправляется сразу,
+    дальше show() правит его (edit_message_text) не чаще раза в interval сек на чат — более
+    частые правки склеиваются в одну отложенную. Чатам без сообщения (присоединились позже)
+    отправляется новое с текущим текстом.
+    """
+    def __init__(self, chat_ids: List[int], interval: float = PROGRESS_EDIT_INTERVAL):
+        self.chat_ids = chat_ids
+        self.interval = interval
+        self._sent: Dict[int, concurrent.futures.Future] = {}
+        self._shown: Dict[int, str] = {}
+        self._waiting: Set[int] = set()   # чаты, где правка ждёт отправки первого сообщения
+        self._text: Optional[str] = None
+        self._pending: Optional[str] = None
+        self._last = 0.0
+        self._timer: Optional[threading.Timer] = None
+        # RLock: add_done_callback на уже готовом Future вызывает _sent_done сразу, под этим же замком
+        self._lock = threading.RLock()
+
+    def start(self, text: str):
+        with self._lock:
+            self._pending = text
+            self._flush()
+
+    def show(self, text: str):
+        with self._lock:
+            self._pending = text
+            wait = self._last + self.interval - time.monotonic()
+            if wait <= 0:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(wait, self._deferred)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def finish(self, text: str):
+        """Итоговый текст: правит сообщение во всех чатах, не дожидаясь интервала."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._pending = text
+            self._flush()
+
+    def _deferred(self):
+        with self._lock:
+            self._timer = None
+            if self._pending is not None:
+                self._flush()
+
+    def _flush(self):
+        self._text, self._pending = self._pending, None
+        self._last = time.monotonic()
+        for chat_id in list(self.chat_ids):
+            self._show_in(chat_id)
+
+    def _show_in(self, chat_id: int):
+        """Под self._lock и без ожидания сети: вызывается из потоков сбора."""
+        text = self._text
+        if self._shown.get(chat_id) == text:
+            return      # Telegram отвечает ошибкой на правку без изменений
+        kwargs = {"parse_mode": ParseMode.HTML, "disable_web_page_preview": True}
+        fut = self._sent.get(chat_id)
+        if fut is None or (fut.done() and fut.exception() is not None):
+            self._sent[chat_id] = OUTBOX.send(chat_id, text, **kwargs)
+        elif not fut.done():
+            # id сообщения ещё неизвестен: правка уйдёт, когда Outbox его отправит
+            if chat_id not in self._waiting:
+                self._waiting.add(chat_id)
+                fut.add_done_callback(lambda _f, c=chat_id: self._sent_done(c))
+            return
+        else:
+            OUTBOX.call("edit_message_text", chat_id, message_id=fut.result().message_id, text=text, **kwargs)
+        self._shown[chat_id] = text
+
+    def _sent_done(self, chat_id: int):
+        with self._lock:
+            self._waiting.discard(chat_id)
+            self._show_in(chat_id)
+
+class ProgressiveReply(LiveMessage):
+    """
+    Ответ на задачу, который дописывается по мере сбора: «Принято…» сразу, затем каждая
+    готовая секция появляется в том же сообщении, ещё не готовые помечены «загружаю…».
+    """
+    def __init__(self, chat_ids: List[int], order: List[str], interval: float = PROGRESS_EDIT_INTERVAL):
+        super().__init__(chat_ids, interval)
+        self.order = [name for name in order if name in SECTION_RENDERERS]
+        self._parts: Dict[str, object] = {}
+        self._t0 = time.monotonic()
+
+    def start(self, text: str = "Принято. Захожу в систему… Подождите некоторое время... ⏳"):
+        super().start(text)
+
+    def section(self, name: str, model):
+        """Колбэк для collect(on_section=...): вызывается из потока воркера."""
+        if not self._parts:
+            METRICS.observe("first_section", time.monotonic() - self._t0)
+        self._parts[name] = model
+        self.show(format_sections(self._parts, self.order))
+
+    def fail(self, text: str):
+        """Ошибка: убрать «загружаю…» у уже показанных секций и отдельно отправить text."""
+        if self._parts:
+            self.finish(format_sections(self._parts, self.order, pending=False))
+        _broadcast(self.chat_ids, text)
+
+# ── Пакетный режим (/batch) ──
+_BATCH_LINE_RE = re.compile(r"^\s*([^;,\s]+)\s*[;,\s]\s*(.+?)\s*$")
+
+def parse_batch(text: str) -> Tuple[List[Tuple[str, str]], int]:
+    """
+    Строки «логин;пароль» (также через запятую, табуляцию или пробел) → (пары, сколько строк не разобрано).
+    Пустые строки и заголовок «login;password» пропускаются, повторы убираются.
+    """
+    pairs, bad, seen = [], 0, set()
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        m = _BATCH_LINE_RE.match(line)
+        if not m:
+            bad += 1
+            continue
+        pair = (m.group(1), m.group(2))
+        if not pairs and not bad and pair[0].lower() in ("login", "логин"):
+            continue
+        if pair not in seen:
+            seen.add(pair)
+            pairs.append(pair)
+    return pairs, bad
+
+def _decode_upload(data: bytes) -> str:
+    for enc in ("utf-8-sig", "cp1251"):
+        try:
+            return data.decode(enc)
+        except UnicodeDecodeError:
+            pass
+    return data.decode("utf-8", "replace")
+
+def batch_columns(profile: CompiledProfile) -> List[str]:
+    cols = ["Логин", "Статус"]
+    for sec, fields in profile.sections:
+        cols.extend(f.label for f in fields)
+        cols.extend(t.title for t in sec.tables)
+    return cols
+
+def batch_row(profile: CompiledProfile, login: str, status: str, data: Optional[Collected]) -> List[str]:
+    row = [login, status]
+    for sec, fields in profile.sections:
+        model = getattr(data, sec.name) if data else None
+        row.extend(getattr(model, f.attr) if model else "" for f in fields)
+        row.extend(" | ".join(t.lines(getattr(model, t.name))) if model else "" for t in sec.tables)
+    return row
+
+def batch_file(columns: List[str], rows: List[List[str]]) -> Tuple[bytes, str]:
+    """Таблица результатов: XLSX, если установлен openpyxl, иначе CSV (UTF-8 с BOM и «;» — открывается в Excel)."""
+    if openpyxl is not None:
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.title = "Заявки"
+        ws.append(columns)
+        for row in rows:
+            ws.append(row)
+        buf = io.BytesIO()
+        wb.save(buf)
+        return buf.getvalue(), "xlsx"
+    buf = io.StringIO()
+    w = csv.writer(buf, delimiter=";")
+    w.writerow(columns)
+    w.writerows(rows)
+    return buf.getvalue().encode("utf-8-sig"), "csv"
+
+class BatchRun:
+    """
+    Пакет пар логин/пароль от одного чата. Идёт в своём потоке и подаёт строки в общую
+    очередь SCHEDULER по мере освобождения мест — не больше BATCH_CONCURRENCY (и SCRAPE_PER_CHAT_MAX)
+    сразу, так что пакет делит воркеров с остальными чатами по кругу, учитывается в лимите очереди
+    и ETA, пишется в журнал и в режиме брокера уходит воркерам. Очередь полна — строка ждёт.
+    Готовые ответы берутся из кэша результатов. Статус по каждой строке — в одном сообщении,
+    которое правится на месте; в конце — файл с таблицей.
+    """
+    _ICONS = {"wait": "▫️", "run": "⏳", "ok": "✅", "cache": "✅", "fail": "❌", "cancel": "⏭"}
+
+    def __init__(self, chat_id: int, operator: str, pairs: List[Tuple[str, str]]):
+        self.chat_id = chat_id
+        self.operator = operator
+        self.pairs = pairs
+        self.state = ["wait"] * len(pairs)
+        self.results: List[Optional[Collected]] = [None] * len(pairs)
+        self.errors: List[str] = [""] * len(pairs)
+        self._msg = LiveMessage([chat_id])
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._slots = threading.Condition(self._lock)
+        self._active = 0                  # строк в очереди SCHEDULER или в сборе
+        self._thread = threading.Thread(target=self._run, name=f"batch-{chat_id}", daemon=True)
+
+    def start(self):
+        self._msg.start(self._status())
+        self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+        with self._slots:
+            self._slots.notify_all()
+
+    def join(self, timeout: float):
+        self._thread.join(timeout)
+
+    @property
+    def done(self) -> bool:
+        return not self._thread.is_alive()
+
+    def _status(self) -> str:
+        counts = {k: self.state.count(k) for k in self._ICONS}
+        finished = counts["ok"] + counts["cache"] + counts["fail"] + counts["cancel"]
+        head = f"📦 <b>Пакет: {finished}/{len(self.pairs)}</b>"
+        if counts["fail"]:
+            head += f", ошибок: {counts['fail']}"
+        lines = [head]
+        for i, ((login, _), st) in enumerate(zip(self.pairs, self.state), 1):
+            line = f"{self._ICONS[st]} {i}. {html_escape(login)}"
+            data = self.results[i - 1]
+            if data is not None:
+                line += f" — {html_escape(data.main.request_number)}"
+                if st == "cache":
+                    line += " (кэш)"
+            elif self.errors[i - 1]:
+                line += f" — {self.errors[i - 1]}"
+            lines.append(line)
+        return "\n".join(lines)[:4000]
+
+    def _set(self, i: int, state: str, data: Optional[Collected] = None):
+        with self._lock:
+            self.state[i] = state
+            if data is not None:
+                self.results[i] = data
+            self._msg.show(self._status())
+
+    def _done(self, i: int, job: ScrapeJob):
+        """on_done из SCHEDULER: вызывается из потока воркера очереди."""
+        if job.result is not None:
+            METRICS.inc("batch_items_ok")
+            self._set(i, "ok", job.result)
+        else:
+            METRICS.inc("batch_items_failed")
+            log.warning("Пакет: не удалось собрать данные для строки %d: %s", i + 1, job.error)
+            self.errors[i] = failure_reason(job.error) if job.error else "внутренняя ошибка"
+            self._set(i, "fail")
+        with self._slots:
+            self._active -= 1
+            self._slots.notify_all()
+
+    def _submit(self, i: int) -> bool:
+        """Ставит строку в SCHEDULER, дожидаясь места в пакете и в очереди; False — пакет отменён."""
+        login, password = self.pairs[i]
+        window = max(1, min(BATCH_CONCURRENCY, SCRAPE_PER_CHAT_MAX or BATCH_CONCURRENCY))
+        with self._slots:
+            while True:
+                if self._cancel.is_set():
+                    return False
+                if self._active < window:
+                    res = SCHEDULER.submit(self.chat_id, self.operator, login, password,
+                                           on_done=lambda job: self._done(i, job))
+                    if res.accepted:
+                        # статус — под тем же замком: _done этой строки не успеет раньше
+                        self._active += 1
+                        self.state[i] = "run"
+                        self._msg.show(self._status())
+                        return True
+                    if res.reason == "closed":
+                        return False
+                # full / limit (заняты обычными запросами этого чата) — ждём, пока что-то освободится
+                self._slots.wait(1.0)
+
+    def _run(self):
+        t0 = time.monotonic()
+        try:
+            for i, (login, password) in enumerate(self.pairs):
+                hit = RESULTS.get(_job_key(self.operator, login, password))
+                if hit:
+                    self._set(i, "cache", hit[0])
+                elif not self._submit(i):
+                    for j in range(i, len(self.pairs)):
+                        self._set(j, "cancel")
+                    break
+            with self._slots:
+                while self._active:
+                    self._slots.wait()
+            with self._lock:
+                text = self._status()
+            self._msg.finish(text)
+            profile = PROFILES[self.operator]
+            labels = {"ok": "готово", "cache": "готово (кэш)", "fail": "ошибка", "cancel": "отменено"}
+            rows = [batch_row(profile, login, f"{labels[st]}: {err}" if err else labels[st], data)
+                    for (login, _), st, data, err in zip(self.pairs, self.state, self.results, self.errors)]
+            payload, ext = batch_file(batch_columns(profile), rows)
+            OUTBOX.call("send_document", self.chat_id, document=payload,
+                        filename=f"batch_{time.strftime('%Y%m%d_%H%M')}.{ext}")
+            log.info("Пакет из %d строк для чата %s: %.1f с", len(self.pairs), self.chat_id, time.monotonic() - t0)
+        except Exception as e:
+            log.exception("Пакет: необработанная ошибка: %s", e)
+            OUTBOX.send(self.chat_id, "Не удалось завершить пакет. Попробуйте ещё раз (/batch).")
+
+BATCHES: Dict[int, BatchRun] = {}
+
+def shutdown_batches(timeout: float):
+    """Оставшиеся строки пакетов отменяются, начатые сборы дорабатывают; в чат уходит файл с тем, что успели."""
+    runs = list(BATCHES.values())
+    for run in runs:
+        run.cancel()
+    deadline = time.monotonic() + timeout
+    for run in runs:
+        run.join(max(0.0, deadline - time.monotonic()))
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """
+    Апдейты разных чатов обрабатываются параллельно (до max_concurrent_updates),
+    а апдейты одного чата — строго по очереди. Иначе при webhook нажатие кнопки может
+    прийти раньше, чем ConversationHandler сохранит состояние после предыдущего шага.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chats: Dict[int, list] = {}     # chat_id -> [lock, сколько апдейтов ждут/идут]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._chats.pop(chat.id, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# ── Telegram ──
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data.pop("refresh", None)
+    user = update.effective_user
+    name = user.first_name or user.username or "друг"
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🟢 Мегафон", callback_data="op_megafon"),
+         InlineKeyboardButton("🔴 МТС", callback_data="op_mts")],
+        [InlineKeyboardButton("🆘 Помощь /help", callback_data="op_help")]
+    ])
+    await (update.message or update.callback_query.message).reply_text(
+        f"Привет👋, {name}, какой оператор тебе нужен?",
+        reply_markup=kb
+    )
+    return OPERATOR
+
+async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await (update.message or update.callback_query.message).reply_text(
+        "Подсказки:\n"
+        "1️⃣ Нажмите на нужного оператора.\n"
+        "2️⃣ Введите логин и пароль, когда бот попросит.\n"
+        "3️⃣ Подождите ~10–15 секунд — бот соберёт данные и пришлёт ответ.\n"
+        "Команды: /start — начать заново, /refresh — собрать заново без кэша, /cancel — отмена.\n"
+        "/batch — много заявок сразу: список строк «логин;пароль» или файл CSV/TXT, ответ — таблицей."
+    )
+
+async def refresh_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Как /start, но следующий запрос идёт мимо кэша результатов."""
+    state = await start(update, context)
+    context.user_data["refresh"] = True
+    return state
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await (update.message or update.callback_query.message).reply_text("Ок, отменил. Наберите /start, чтобы начать заново.")
+    return ConversationHandler.END
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user or user.id not in ADMIN_IDS:
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+    summary, counters = METRICS.snapshot()
+    queued, running = SCHEDULER.stats()
+    pool = REMOTE if REMOTE is not None else WORKER_PROCS if SCRAPE_ISOLATION == "process" else DRIVER_POOL
+    total, idle = await asyncio.to_thread(pool.stats)
+    lines = [f"{'стадия':<22}{'n':>5}{'p50':>8}{'p95':>8}{'p99':>8}"]
+    for name, s in sorted(summary.items()):
+        fmt = "{:>8.0f}" if name == "webdriver_calls" else "{:>8.2f}"
+        lines.append(f"{name:<22}{s['n']:>5}" + "".join(fmt.format(s[q]) for q in ("p50", "p95", "p99")))
+    lines.append("")
+    lines += [f"{k}: {v}" for k, v in sorted(counters.items())]
+    lines.append(f"очередь: {queued}, в работе: {running}; браузеров: {total}, свободно: {idle}")
+    lines.append(f"сессии: hit={SESSIONS.hits} miss={SESSIONS.misses}")
+    if REMOTE is not None:
+        b_queued, b_leased = await asyncio.to_thread(REMOTE.broker.counts)
+        lines.append(f"брокер: в очереди {b_queued}, в аренде {b_leased}")
+        for w in await asyncio.to_thread(REMOTE.workers):
+            lines.append(f"воркер {w['name']}: занято {w['busy']}/{w['capacity']}, пульс {w['age']:.0f} с назад")
+    for key, b in BREAKERS.items():
+        left = b.retry_in()
+        lines.append(f"портал {key}: {b.state}" + (f", проверка через {left:.0f} с" if left else "")
+                     + f", сбоев подряд: {b.failures}")
+    text = "\n".join(lines)
+    await update.message.reply_text(f"<pre>{html_escape(text)}</pre>", parse_mode=ParseMode.HTML)
+
+async def jobs_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/jobs [часы] — сводка журнала задач: статусы, доля ошибок, перцентили, частые ошибки."""
+    user = update.effective_user
+    if not user or user.id not in ADMIN_IDS:
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+    if not JOURNAL.enabled:
+        await update.message.reply_text("Журнал задач выключен (JOURNAL_DB).")
+        return
+    arg = (context.args or ["24"])[0]
+    hours = float(arg) if arg.replace(".", "", 1).isdigit() else 24.0
+    await asyncio.to_thread(JOURNAL.flush)
+    s = await asyncio.to_thread(JOURNAL.summary, hours * 3600)
+    lines = [f"за {hours:g} ч: задач {s['total']}"]
+    if s["total"]:
+        lines.append(", ".join(f"{k}: {v}" for k, v in sorted(s["status"].items())))
+        lines.append(f"доля ошибок: {s['failure_rate']:.1%}")
+        lines.append("")
+        lines.append(f"{'':<22}{'n':>5}{'p50':>8}{'p95':>8}")
+        for name, p in [("ожидание в очереди", s["wait"]), ("всего", s["duration"]), *s["stages"].items()]:
+            if p:
+                lines.append(f"{name[:22]:<22}{p['n']:>5}{p['p50']:>8.2f}{p['p95']:>8.2f}")
+        if s["errors"]:
+            lines.append("")
+            lines += [f"{n} × {err[:80]}" for err, n in s["errors"]]
+    text = "\n".join(lines)
+    await update.message.reply_text(f"<pre>{html_escape(text)}</pre>", parse_mode=ParseMode.HTML)
+
+async def operator_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    data = query.data
+    if data == "op_help":
+        await help_cmd(update, context)
+        return ConversationHandler.END
+    operator = data[len("op_"):]
+    if operator not in PROFILES:
+        await query.edit_message_text("Профиль МТС пока в разработке.")
+        return ConversationHandler.END
+    context.user_data["operator"] = operator
+    await query.edit_message_text("Введите логин для входа.")
+    return LOGIN
+
+async def get_login(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data["login"] = update.message.text.strip()
+    await update.message.reply_text("Теперь введите временный пароль.")
+    return PASS
+
+def _broadcast(chat_ids: List[int], text: str, **kwargs):
+    for chat_id in list(chat_ids):
+        OUTBOX.send(chat_id, text, **kwargs)
+
+def scrape_worker(job: ScrapeJob):
+    """Выполняется в потоке воркера очереди: Selenium блокирует только его."""
+    with log_context(job.journal_id, (job.password,)):
+        profile = PROFILES[job.operator]
+        reply = ProgressiveReply(job.chat_ids, [sec.name for sec, _ in profile.sections])
+        JOURNAL.started(job.journal_id)
+        with METRICS.capture() as stages:
+            try:
+                reply.start()
+                with METRICS.timed("job"):
+                    data = collect(profile, job.login, job.password, on_section=reply.section)
+                METRICS.inc("jobs_ok")
+                RESULTS.put(job.key, data)
+                job.result = data
+                reply.finish(format_collected(data))
+            except Exception as e:
+                METRICS.inc("jobs_failed")
+                job.error = e
+                if isinstance(e, (BadCredentials, PortalError)):
+                    log.warning("Сбор не удался: %s: %s", type(e).__name__, e)
+                else:
+                    log.exception("Ошибка при сборе данных: %s", e)
+                JOURNAL.finished(job.journal_id, False, stages, f"{type(e).__name__}: {e}")
+                reply.fail(failure_text(e))
+            else:
+                JOURNAL.finished(job.journal_id, True, stages)
+
+def recover_jobs():
+    """
+    После перезапуска: задачи, которые прошлый процесс не доделал. Свежие и с логином/паролем
+    в журнале ставятся в очередь заново, остальным чатам приходит извинение.
+    """
+    for item in JOURNAL.unfinished():
+        age = time.time() - item["created"]
+        creds = item["credentials"]
+        chats = item["chat_ids"]
+        # строки /batch (без чатов) не продолжаются: пакет живёт только в памяти прошлого процесса
+        if creds and chats and age <= JOURNAL_RESUME_MAX_AGE and item["operator"] in PROFILES:
+            JOURNAL.close_open(item["id"], "resumed")
+            METRICS.inc("jobs_resumed")
+            for chat_id in chats:
+                res = SCHEDULER.submit(chat_id, item["operator"], *creds)
+                if res.accepted:
+                    OUTBOX.send(chat_id, "Бот перезапускался — продолжаю ваш запрос. ⏳")
+                else:
+                    OUTBOX.send(chat_id, "Бот перезапускался, и ваш запрос не удалось продолжить. Отправьте его ещё раз: /start")
+            log.info("Журнал: задача %s продолжена (%d чат(ов), возраст %.0f с)", item["id"], len(chats), age)
+        else:
+            JOURNAL.close_open(item["id"], "abandoned")
+            METRICS.inc("jobs_abandoned")
+            for chat_id in chats:
+                OUTBOX.send(chat_id, "Бот перезапускался, и ваш запрос не был выполнен. Отправьте его ещё раз: /start")
+            log.info("Журнал: задача %s не продолжена (%s), чатам отправлен отказ", item["id"],
+                     "нет логина/пароля" if not creds else f"возраст {age:.0f} с")
+
+async def get_pass_and_run(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     pwd = update.message.text.strip()
     login = context.user_data.get("login")
     if not login:
-        update.message.reply_text("Не вижу логина. Давайте заново: /start")
+        await update.message.reply_text("Не вижу логина. Давайте заново: /start")
         return ConversationHandler.END
-    t = threading.Thread(target=scrape_worker, args=(update.effective_chat.id, login, pwd, context), daemon=True)
-    t.start()
+    operator = context.user_data.get("operator", "megafon")
+    if not context.user_data.pop("refresh", False):
+        hit = await asyncio.to_thread(RESULTS.get, _job_key(operator, login, pwd))
+        METRICS.inc("result_cache_hit" if hit else "result_cache_miss")
+        if hit:
+            data, age = hit
+            await update.message.reply_text(
+                format_collected(data) + f"\n\nℹ️ Данные получены {_age_text(age)} назад. Обновить: /refresh",
+                parse_mode=ParseMode.HTML, disable_web_page_preview=True
+            )
+            return ConversationHandler.END
+    res = SCHEDULER.submit(update.effective_chat.id, operator, login, pwd)
+    if not res.accepted:
+        await update.message.reply_text({
+            "full": "Сейчас слишком много запросов. Попробуйте через пару минут (/start).",
+            "limit": "У вас уже есть запросы в работе — дождитесь ответа по ним.",
+            "closed": "Бот перезапускается. Попробуйте через минуту (/start).",
+        }[res.reason])
+    elif res.position or res.duplicate:
+        text = "Такой запрос уже выполняется, пришлю результат и вам." if res.duplicate else "Принято."
+        if res.position:
+            text += f" Место в очереди: {res.position}, ожидание ~{max(1, round(res.eta_sec / 60))} мин."
+        await update.message.reply_text(text + " ⏳")
     return ConversationHandler.END
 
-def main():
-    if not BOT_TOKEN:
-        log.error("BOT_TOKEN не найден. Проверьте файл .env рядом с main.py")
-        raise SystemExit(1)
+async def batch_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """/batch — список можно прислать сразу после команды или отдельным сообщением/файлом."""
+    parts = update.message.text.split(maxsplit=1)
+    rest = parts[1] if len(parts) > 1 else ""
+    if rest.strip():
+        return await _run_batch(update, context, rest)
+    await update.message.reply_text(
+        f"Пришлите список заявок (до {BATCH_MAX}): по строке «логин;пароль» "
+        "или файл CSV/TXT в таком же виде. Отмена: /cancel"
+    )
+    return BATCH
 
-    updater = Updater(BOT_TOKEN, use_context=True)
-    dp = updater.dispatcher
+async def batch_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    doc = update.message.document
+    if doc is None:
+        return await _run_batch(update, context, update.message.text)
+    if doc.file_size and doc.file_size > BATCH_FILE_MAX:
+        await update.message.reply_text("Файл слишком большой. Нужен CSV/TXT со строками «логин;пароль».")
+        return BATCH
+    tg_file = await doc.get_file()
+    data = await tg_file.download_as_bytearray()
+    return await _run_batch(update, context, _decode_upload(bytes(data)))
+
+async def _run_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> int:
+    chat_id = update.effective_chat.id
+    pairs, bad = parse_batch(text)
+    if not pairs:
+        await update.message.reply_text("Не нашёл ни одной строки «логин;пароль». Пришлите список ещё раз или /cancel.")
+        return BATCH
+    if len(pairs) > BATCH_MAX:
+        await update.message.reply_text(f"В списке {len(pairs)} строк, за раз можно до {BATCH_MAX}. Разбейте на части.")
+        return BATCH
+    run = BATCHES.get(chat_id)
+    if run is not None and not run.done:
+        await update.message.reply_text("Предыдущий пакет ещё в работе — дождитесь файла с результатами.")
+        return ConversationHandler.END
+    if bad:
+        await update.message.reply_text(f"Пропущено строк без пары логин/пароль: {bad}.")
+    METRICS.inc("batches")
+    run = BatchRun(chat_id, context.user_data.get("operator", "megafon"), pairs)
+    BATCHES[chat_id] = run
+    run.start()
+    return ConversationHandler.END
+
+def _prepare_scraping():
+    """В фоне после старта: найти Chrome/chromedriver (или взять из кэша) и прогреть браузеры."""
+    try:
+        resolve_browser()      # в режиме process воркеры потом возьмут результат из кэша
+    except Exception as e:
+        log.warning("Не удалось подготовить Chrome/chromedriver: %s", e)
+    if SCRAPE_ISOLATION == "process":
+        # процессы поднимаются всегда: импорт и запуск воркера не должны доставаться первому запросу
+        WORKER_PROCS.warm_up()
+    elif DRIVER_WARMUP:
+        DRIVER_POOL.warm_up()
+
+async def _post_init(app: Application):
+    global REMOTE
+    await OUTBOX.start(app.bot)
+    # Меню команд для кнопки "Menu"
+    await app.bot.set_my_commands([
+        BotCommand("start", "Начать заново / выбор оператора"),
+        BotCommand("refresh", "Собрать данные заново, без кэша"),
+        BotCommand("batch", "Много заявок сразу (список или файл)"),
+        BotCommand("help",  "Подсказки по работе с ботом"),
+        BotCommand("cancel","Отменить текущий шаг"),
+    ])
+    if BROKER_URL:
+        # собирают воркеры (python main.py worker): браузеры в этом процессе не нужны
+        REMOTE = BrokerClient(await asyncio.to_thread(open_broker, BROKER_URL, BROKER_KEY))
+        SCHEDULER.capacity = REMOTE.capacity
+        log.info("Сбор через брокер %s, воркеров на связи: %d", urlsplit(BROKER_URL).scheme,
+                 len(await asyncio.to_thread(REMOTE.workers)))
+    else:
+        threading.Thread(target=_prepare_scraping, name="prepare", daemon=True).start()
+    SCHEDULER.start(scrape_worker)
+    await asyncio.to_thread(JOURNAL.start)
+    await asyncio.to_thread(recover_jobs)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_HOST, METRICS_PORT)
+    startup = time.perf_counter() - _T_START
+    METRICS.observe("startup", startup)
+    log.info("Бот запущен за %.2f с.", startup)
+
+async def _post_stop(app: Application):
+    # event loop ещё жив: воркеры дорабатывают очередь и успевают отправить ответы
+    # пакеты первыми: новые строки не подаются, поданные дорабатывает очередь
+    await asyncio.to_thread(shutdown_batches, SCRAPE_DRAIN_TIMEOUT)
+    await asyncio.to_thread(SCHEDULER.shutdown, SCRAPE_DRAIN_TIMEOUT)
+    if REMOTE is not None:
+        await asyncio.to_thread(REMOTE.broker.close)
+    # недоделанные задачи остаются в журнале queued/running и подхватываются при следующем запуске
+    await asyncio.to_thread(JOURNAL.close)
+    await OUTBOX.stop()
+    await asyncio.to_thread(WORKER_PROCS.close)
+    await asyncio.to_thread(DRIVER_POOL.close)
+
+def build_application() -> Application:
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(ChatOrderedProcessor(max(1, UPDATE_CONCURRENCY)))
+        .post_init(_post_init)
+        .post_stop(_post_stop)
+    )
+    if TELEGRAM_API_URL:
+        api = TELEGRAM_API_URL.rstrip("/")
+        builder = builder.base_url(f"{api}/bot").base_file_url(f"{api}/file/bot")
+    app = builder.build()
 
     conv = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[
+            CommandHandler("start", start),
+            CommandHandler("refresh", refresh_cmd),
+            CommandHandler("batch", batch_cmd),
+        ],
         states={
             OPERATOR: [CallbackQueryHandler(operator_choice)],
-            LOGIN: [MessageHandler(Filters.text & ~Filters.command, get_login)],
-            PASS: [MessageHandler(Filters.text & ~Filters.command, get_pass_and_run)],
+            LOGIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_login)],
+            PASS: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_pass_and_run)],
+            BATCH: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, batch_input)],
         },
         fallbacks=[CommandHandler("cancel", cancel), CommandHandler("help", help_cmd)],
         conversation_timeout=300
     )
-    dp.add_handler(conv)
-    dp.add_handler(CommandHandler("help", help_cmd))
-    dp.add_handler(CommandHandler("cancel", cancel))
+    app.add_handler(conv)
+    app.add_handler(CommandHandler("help", help_cmd))
+    app.add_handler(CommandHandler("cancel", cancel))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(CommandHandler("jobs", jobs_cmd))
+    return app
 
-    # Меню команд для кнопки "Menu"
-    updater.bot.set_my_commands([
-        BotCommand("start", "Начать заново / выбор оператора"),
-        BotCommand("help",  "Подсказки по работе с ботом"),
-        BotCommand("cancel","Отменить текущий шаг"),
-    ])
+def worker_main():
+    """python main.py worker — только сбор: задачи из BROKER_URL, без Telegram. Остановка — SIGTERM/SIGINT."""
+    if not BROKER_URL:
+        log.error("Режим worker: не задан BROKER_URL")
+        raise SystemExit(1)
+    require_broker_key()
+    try:
+        broker = open_broker(BROKER_URL, BROKER_KEY)
+    except Exception as e:
+        log.error("Брокер %s недоступен: %s", urlsplit(BROKER_URL).scheme, e)
+        raise SystemExit(1)
+    worker = BrokerWorker(broker, WORKER_NAME or f"{socket.gethostname()}:{os.getpid()}", WORKER_CAPACITY)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: worker.stop())
+    threading.Thread(target=_prepare_scraping, name="prepare", daemon=True).start()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_HOST, METRICS_PORT)
+    try:
+        worker.run()
+    finally:
+        WORKER_PROCS.close()
+        DRIVER_POOL.close()
+        broker.close()
 
-    log.info("Бот запущен.")
-    updater.start_polling()
-    updater.idle()
+def main():
+    if not BOT_TOKEN:
+        log.error("BOT_TOKEN не найден. Проверьте файл .env рядом с main.py")
+        raise SystemExit(1)
+    if BROKER_URL:
+        require_broker_key()
+
+    app = build_application()
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            log.error("BOT_MODE=webhook, но WEBHOOK_URL не задан")
+            raise SystemExit(1)
+        secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        log.info("Webhook: слушаю %s:%d/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        # секрет проверяется по заголовку X-Telegram-Bot-Api-Secret-Token, чужие запросы получают 403
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=secret,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ["worker"]:
+        worker_main()
+    else:
+        main()
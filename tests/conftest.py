@@ -0,0 +1,62 @@
+"""
+Тесты импортируют main как есть. Окружение задаётся до импорта: лог, кэш браузера — во
+временном каталоге, без журнала задач, кэша результатов на диске и прогрева Chrome.
+Запуск из корня репозитория: python -m pytest -q (нужны пакеты из requirements.txt и pytest).
+"""
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))     # standin
+
+_TMP = tempfile.mkdtemp(prefix="okcbot-tests-")
+os.environ.update({
+    "LOG_FILE": os.path.join(_TMP, "bot.log"),
+    "BROWSER_CACHE_FILE": os.path.join(_TMP, "browser_cache.json"),
+    "JOURNAL_DB": "",
+    "RESULT_CACHE_DB": "",
+    "BROKER_URL": "",
+    "METRICS_PORT": "0",
+    "DRIVER_POOL_SIZE": "1",
+    "DRIVER_WARMUP": "0",
+    "HISTORY_TABLES": "0",
+})
+
+_stdout, _stderr = sys.stdout, sys.stderr
+import main  # noqa: E402
+sys.stdout, sys.stderr = _stdout, _stderr     # main уводит stdout/stderr в лог, pytest они нужны свои
+
+
+class FakeClock:
+    """Вместо модуля time в main: time() и monotonic() стоят на месте, sleep() только сдвигает часы."""
+    def __init__(self):
+        self.now = 1_000_000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.slept.append(sec)
+        self.now += sec
+
+    def advance(self, sec):
+        self.now += sec
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = FakeClock()
+    monkeypatch.setattr(main, "time", c)
+    return c
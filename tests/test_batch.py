@@ -0,0 +1,36 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("line", ["login;pass", "login,pass", "login\tpass", "login pass", "  login ;  pass  "])
+def test_separators(line):
+    assert main.parse_batch(line) == ([("login", "pass")], 0)
+
+
+def test_header_blank_lines_and_repeats_are_skipped():
+    text = "login;password\r\n\r\nl1;p1\n   \nl2;p2\nl1;p1\n"
+    assert main.parse_batch(text) == ([("l1", "p1"), ("l2", "p2")], 0)
+    assert main.parse_batch("Логин;Пароль\nl1;p1") == ([("l1", "p1")], 0)
+
+
+def test_header_only_on_first_line():
+    assert main.parse_batch("l1;p1\nlogin;secret") == ([("l1", "p1"), ("login", "secret")], 0)
+
+
+def test_bad_lines_are_counted():
+    assert main.parse_batch("l1;p1\nonly-login\n;p2\nl3;p3") == ([("l1", "p1"), ("l3", "p3")], 2)
+
+
+def test_password_keeps_inner_spaces():
+    assert main.parse_batch("l1;pass with spaces ") == ([("l1", "pass with spaces")], 0)
+
+
+def test_nothing_to_parse():
+    assert main.parse_batch("") == ([], 0)
+
+
+@pytest.mark.parametrize("encoding", ["utf-8-sig", "utf-8", "cp1251"])
+def test_upload_encodings(encoding):
+    text = "логин;пароль\nабонент;секрет"
+    assert main.parse_batch(main._decode_upload(text.encode(encoding))) == ([("абонент", "секрет")], 0)
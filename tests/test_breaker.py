@@ -0,0 +1,140 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def breaker(clock):
+    return main.CircuitBreaker("http://portal.invalid/loginTemp", threshold=2, cooldown=10, probe_timeout=1)
+
+
+def trip(b):
+    for _ in range(b.threshold):
+        b.failure(main.PortalError("timeout"))
+    assert b.state == "open"
+
+
+def test_opens_after_threshold_failures_in_a_row(breaker):
+    breaker.failure(main.PortalError("timeout"))
+    breaker.success()
+    breaker.failure(main.PortalError("timeout"))
+    assert breaker.state == "closed"
+    breaker.before()
+
+    breaker.failure(main.PortalError("timeout"))
+    assert breaker.state == "open"
+    with pytest.raises(main.PortalUnavailable) as e:
+        breaker.before()
+    assert e.value.retry_in == 10
+
+
+def test_no_probe_before_cooldown(breaker, clock):
+    trip(breaker)
+    breaker.probe = lambda: pytest.fail("проверка до конца паузы")
+    clock.advance(9)
+    with pytest.raises(main.PortalUnavailable):
+        breaker.before()
+
+
+def test_successful_probe_closes(breaker, clock):
+    trip(breaker)
+    clock.advance(10)
+    breaker.probe = lambda: True
+    breaker.before()
+    assert breaker.state == "closed" and breaker.failures == 0 and breaker.retry_in() == 0
+
+
+def test_failed_probe_doubles_pause_up_to_ten_cooldowns(breaker, clock):
+    trip(breaker)
+    breaker.probe = lambda: False
+    for pause in (20, 40, 80, 100, 100):
+        clock.advance(breaker.retry_in())
+        with pytest.raises(main.PortalUnavailable) as e:
+            breaker.before()
+        assert e.value.retry_in == pause
+        assert breaker.state == "open"
+
+
+def test_only_one_request_probes(breaker, clock):
+    trip(breaker)
+    clock.advance(10)
+    seen = []
+
+    def probe():
+        with pytest.raises(main.PortalUnavailable):
+            breaker.before()          # второй запрос, пока первый проверяет портал
+        seen.append(True)
+        return True
+
+    breaker.probe = probe
+    breaker.before()
+    assert seen and breaker.state == "closed"
+
+
+def test_probe_error_keeps_breaker_open(breaker, clock):
+    trip(breaker)
+    clock.advance(10)
+
+    def probe():
+        raise RuntimeError("boom")
+
+    breaker.probe = probe
+    with pytest.raises(RuntimeError):
+        breaker.before()
+    assert breaker.state == "open" and breaker.retry_in() == 20
+
+    clock.advance(20)
+    breaker.probe = lambda: True
+    breaker.before()
+    assert breaker.state == "closed"
+
+
+def test_zero_threshold_disables_breaker(clock):
+    b = main.CircuitBreaker("http://portal.invalid/loginTemp", threshold=0, cooldown=10, probe_timeout=1)
+    for _ in range(10):
+        b.failure(main.PortalError("timeout"))
+    b.before()
+    assert b.state == "closed"
+
+
+@pytest.fixture
+def retries(monkeypatch, clock):
+    monkeypatch.setattr(main, "PORTAL_RETRIES", 2)
+    monkeypatch.setattr(main, "PORTAL_RETRY_BASE", 1.0)
+    return clock
+
+
+def flaky(errors, result="ok"):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return fn, calls
+
+
+def test_transient_errors_are_retried_with_jitter(retries):
+    fn, calls = flaky([main.TimeoutException("slow"), main.StaleElementReferenceException("gone")])
+    assert main.with_retries("login", fn) == "ok"
+    assert len(calls) == 3
+    assert len(retries.slept) == 2
+    assert 0 <= retries.slept[0] <= 1 and 0 <= retries.slept[1] <= 2
+
+
+def test_retries_give_up(retries):
+    fn, calls = flaky([main.requests.Timeout("slow")] * 5)
+    with pytest.raises(main.requests.Timeout):
+        main.with_retries("login", fn)
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize("error", [main.BadCredentials("Неверный пароль"), ValueError("parse"),
+                                   main.PortalUnavailable(10)])
+def test_other_errors_are_not_retried(retries, error):
+    fn, calls = flaky([error])
+    with pytest.raises(type(error)):
+        main.with_retries("login", fn)
+    assert len(calls) == 1 and not retries.slept
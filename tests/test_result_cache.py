@@ -0,0 +1,77 @@
+import hashlib
+
+import pytest
+
+import main
+
+
+def collected(number="Req0012345"):
+    return main.Collected(main.MainPageData(request_number=number), main.ClientData(),
+                          main.PppoeData(login="ppp_test", password="Pp0012345"))
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = main.ResultCache(ttl=60, max_size=8)
+    key = cache.key("megafon", "login", "pass")
+    cache.put(key, collected())
+
+    clock.advance(30)
+    data, age = cache.get(key)
+    assert data == collected() and age == 30
+
+    clock.advance(31)
+    assert cache.get(key) is None
+
+
+def test_zero_ttl_disables_cache():
+    cache = main.ResultCache(ttl=0, max_size=8)
+    key = cache.key("megafon", "login", "pass")
+    cache.put(key, collected())
+    assert cache.get(key) is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = main.ResultCache(ttl=60, max_size=2)
+    a, b, c = (cache.key("megafon", login, "pass") for login in "abc")
+    cache.put(a, collected("a"))
+    cache.put(b, collected("b"))
+    assert cache.get(a)
+    cache.put(c, collected("c"))
+    assert cache.get(b) is None
+    assert cache.get(a) and cache.get(c)
+
+
+def test_key_is_hmac_of_credentials():
+    cache = main.ResultCache(ttl=60, max_size=8)
+    key = cache.key("megafon", "login", "secret1")
+    assert key == cache.key("megafon", "login", "secret1")
+    assert key != cache.key("megafon", "login", "secret2")
+    assert key != cache.key("mts", "login", "secret1")
+    assert key != hashlib.sha256(b"megafon\0login\0secret1").hexdigest()
+    # без RESULT_CACHE_KEY секрет свой у каждого процесса (и экземпляра)
+    assert key != main.ResultCache(ttl=60, max_size=8).key("megafon", "login", "secret1")
+
+
+def test_db_without_key_stays_in_memory(tmp_path):
+    db = tmp_path / "results.db"
+    cache = main.ResultCache(ttl=60, max_size=8, db_path=str(db))
+    cache.put(cache.key("megafon", "login", "pass"), collected())
+    assert not db.exists()
+
+
+def test_db_records_survive_restart_and_are_encrypted(tmp_path):
+    fernet = pytest.importorskip("cryptography.fernet")
+    db, secret = str(tmp_path / "results.db"), fernet.Fernet.generate_key().decode()
+    first = main.ResultCache(ttl=60, max_size=8, db_path=db, key=secret)
+    key = first.key("megafon", "login", "pass")
+    first.put(key, collected())
+
+    second = main.ResultCache(ttl=60, max_size=8, db_path=db, key=secret)
+    assert second.key("megafon", "login", "pass") == key
+    assert second.get(key)[0] == collected()
+    raw = (tmp_path / "results.db").read_bytes()
+    assert b"Pp0012345" not in raw and b"Req0012345" not in raw
+
+    other = main.ResultCache(ttl=60, max_size=8, db_path=db, key=fernet.Fernet.generate_key().decode())
+    assert other.key("megafon", "login", "pass") != key
+    assert other.get(key) is None          # чужой ключ не расшифрует запись
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+
+import main
+
+
+class Gate:
+    """Обработчик задач очереди: запоминает задачи и держит воркера, пока тест не откроет."""
+    def __init__(self):
+        self.jobs = []
+        self.started = threading.Semaphore(0)
+        self.opened = threading.Event()
+
+    def __call__(self, job):
+        self.jobs.append(job)
+        self.started.release()
+        self.opened.wait(10)
+
+
+@pytest.fixture
+def gate():
+    g = Gate()
+    yield g
+    g.opened.set()
+
+
+@pytest.fixture
+def scheduler(gate):
+    made = []
+
+    def make(workers=1, max_queue=10, per_chat=0):
+        s = main.ScrapeScheduler(workers, max_queue, per_chat)
+        s.start(gate)
+        made.append(s)
+        return s
+
+    yield make
+    gate.opened.set()
+    for s in made:
+        s.shutdown(5)
+
+
+def wait_for(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, "не дождались"
+        time.sleep(0.01)
+
+
+def wait_idle(s):
+    wait_for(lambda: s.stats() == (0, 0))
+
+
+def test_same_credentials_are_merged(scheduler, gate):
+    s = scheduler()
+    assert s.submit(1, "megafon", "login", "pass").accepted
+    assert gate.started.acquire(timeout=5)
+    res = s.submit(2, "megafon", "login", "pass")
+    assert res.accepted and res.duplicate
+    assert gate.jobs[0].chat_ids == [1, 2]
+
+    gate.opened.set()
+    wait_idle(s)
+    assert len(gate.jobs) == 1
+
+
+def test_merged_batch_rows_notify_every_listener(scheduler, gate):
+    s = scheduler()
+    s.submit(1, "megafon", "busy", "pass")
+    assert gate.started.acquire(timeout=5)
+    done = []
+    for _ in range(2):
+        assert s.submit(7, "megafon", "login", "pass", on_done=done.append).accepted
+
+    gate.opened.set()
+    wait_for(lambda: len(done) == 2)     # on_done зовётся уже после того, как задача снята с учёта
+    assert [j.login for j in gate.jobs] == ["busy", "login"]
+    assert len(done) == 2 and done[0] is done[1]
+    assert done[0].chat_ids == []          # on_done: в чат сама очередь не пишет
+
+
+def test_per_chat_cap(scheduler, gate):
+    s = scheduler(per_chat=2)
+    assert s.submit(1, "megafon", "a", "p").accepted
+    assert s.submit(1, "megafon", "b", "p").accepted
+    assert s.submit(1, "megafon", "c", "p").reason == "limit"
+    assert s.submit(2, "megafon", "d", "p").accepted
+
+    gate.opened.set()
+    wait_idle(s)
+    assert s.submit(1, "megafon", "c", "p").accepted
+
+
+def test_queue_limit(scheduler, gate):
+    s = scheduler(max_queue=1)
+    assert s.submit(1, "megafon", "a", "p").accepted
+    assert gate.started.acquire(timeout=5)
+    res = s.submit(2, "megafon", "b", "p")
+    assert res.accepted and res.position == 1
+    assert s.submit(3, "megafon", "c", "p").reason == "full"
+
+
+def test_round_robin_between_chats(scheduler, gate):
+    s = scheduler()
+    s.submit(1, "megafon", "x", "p")
+    assert gate.started.acquire(timeout=5)
+    for chat_id, login in ((1, "a"), (1, "b"), (2, "c")):
+        s.submit(chat_id, "megafon", login, "p")
+
+    gate.opened.set()
+    wait_idle(s)
+    assert [j.login for j in gate.jobs] == ["x", "a", "c", "b"]
+
+
+def test_shutdown_drains_queue(scheduler, gate):
+    gate.opened.set()
+    s = scheduler()
+    for login in ("a", "b", "c"):
+        assert s.submit(1, "megafon", login, "p").accepted
+    s.shutdown(5)
+    assert sorted(j.login for j in gate.jobs) == ["a", "b", "c"]
+    assert s.stats() == (0, 0)
+    assert s.submit(1, "megafon", "d", "p").reason == "closed"
+
+
+def test_shutdown_stops_waiting_after_drain_timeout(scheduler, gate):
+    s = scheduler()
+    s.submit(1, "megafon", "a", "p")
+    s.submit(1, "megafon", "b", "p")
+    assert gate.started.acquire(timeout=5)
+
+    t0 = time.monotonic()
+    s.shutdown(0.3)
+    assert 0.3 <= time.monotonic() - t0 < 3
+    assert s.stats() == (1, 1)
@@ -0,0 +1,81 @@
+import dataclasses
+import os
+
+import pytest
+
+import main
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench", "fixtures")
+PAGES = {"main": ("detail.html", "/detail"), "client": ("tab_client.html", "/tab/client"),
+         "pppoe": ("tab_pppoe.html", "/tab/pppoe")}
+
+EXPECTED = main.Collected(
+    main.MainPageData(
+        request_number="Req0012345",
+        account_number="770012345",
+        address="г. Москва, ул. Тестовая, д. 1, кв. 2",
+        temp_password="TmpPass42",
+        services=(main.ServiceRow("Домашний интернет", "Интернет 500"),
+                  main.ServiceRow("Цифровое ТВ", "Базовый пакет"),
+                  main.ServiceRow("Аренда роутера", "Роутер Wi-Fi 6")),
+    ),
+    main.ClientData("9000012345", "+7 (900) 000-00-01", "+7 (900) 000-00-02", "Тестов", "Тест", "Тестович"),
+    main.PppoeData("ppp_test_0012345", "Pp0012345"),
+)
+
+
+def section(name):
+    return next((sec, fields) for sec, fields in main.PROFILES["megafon"].sections if sec.name == name)
+
+
+def from_fixture(name):
+    sec, fields = section(name)
+    with open(os.path.join(FIXTURES, PAGES[name][0]), encoding="utf-8") as f:
+        snap = main.PageSnapshot(f.read())
+    return main.extract_snapshot(snap, snap.active_panel() if sec.tab else None, sec, fields)
+
+
+@pytest.mark.parametrize("name", sorted(PAGES))
+def test_snapshot_reads_fixture(name):
+    assert from_fixture(name) == getattr(EXPECTED, name)
+
+
+def test_history_tables(monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_TABLES", True)
+    m = from_fixture("main")
+    assert m.services == EXPECTED.main.services
+    assert m.removed == (main.RemovedConnection("Домашний телефон", "Городской безлимит", "10.01.2022"),)
+    assert m.history == (main.RequestRow("Req0012345", "01.09.2024", "Подключение", "В работе"),
+                         main.RequestRow("Req0011111", "15.03.2023", "Смена тарифа", "Выполнена"))
+
+
+def test_http_collector_matches_snapshot():
+    from standin import StandIn
+
+    with StandIn(FIXTURES) as srv:
+        profile = main.CompiledProfile(dataclasses.replace(main.MEGAFON_PROFILE, login_url=srv.login_url))
+        assert main.collect_http(profile, "bench", "bench") == EXPECTED
+
+
+@pytest.fixture(scope="module")
+def live():
+    """Браузер из пула на стенде bench/standin.py; без Chrome/chromedriver тесты пропускаются."""
+    from standin import StandIn
+
+    try:
+        main.resolve_browser()
+    except Exception as e:
+        pytest.skip(f"Chrome/chromedriver недоступны: {e}")
+    with StandIn(FIXTURES) as srv, main.DRIVER_POOL.lease() as driver:
+        yield srv, driver
+    main.DRIVER_POOL.close()
+
+
+@pytest.mark.parametrize("name", sorted(PAGES))
+@pytest.mark.parametrize("mode", ["live", "snapshot"])
+def test_browser_extraction_matches_fixture_snapshot(live, monkeypatch, name, mode):
+    srv, driver = live
+    monkeypatch.setattr(main, "EXTRACT_MODE", mode)
+    driver.get(srv.base_url + PAGES[name][1])
+    sec, fields = section(name)
+    assert main.extract_section(driver, sec, fields) == from_fixture(name)